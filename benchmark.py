@@ -0,0 +1,464 @@
+"""
+Нагрузочный тест обработчиков бота
+
+Генерирует поток синтетических апдейтов (/start с реферальными ссылками,
+save_wishes, reserve_wish, create_santa_group, shuffle_santa) и прогоняет
+его через настоящие обработчики bot.py. Кнопки админки - отдельный
+последовательный поток: админ один, его апдейты идут через очередь одного
+чата, и в общем потоке они мерили бы ожидание этой очереди, а не
+обработчик. Уведомления жеребьёвки (фоновые задачи) меряются отдельно -
+santa_notify. Вместо Telegram - имитация Bot API в том же процессе:
+задержка ответа и ошибки 429 с заданной вероятностью.
+
+Каждый размер базы запускается в отдельном процессе на сгенерированном
+data.json. Результат - пропускная способность и p50/p95/p99 задержки по
+видам апдейтов - сохраняется в JSON для сравнения между версиями:
+
+    python benchmark.py --users 1000,10000,100000 --out before.json
+    python benchmark.py --users 1000,10000,100000 --out after.json --compare before.json
+
+1M пользователей - это около 1 ГБ памяти и нескольких минут на генерацию.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import defaultdict
+from telegram.request import BaseRequest
+
+ADMIN_ID = 7086128174
+FIRST_USER_ID = 10 ** 9
+MAX_WISHES = 8
+
+# Доля каждого вида апдейтов в потоке
+MIX = {
+    'start': 10,
+    'start_ref': 10,
+    'save_wishes': 25,
+    'reserve_wish': 20,
+    'create_santa_group': 10,
+    'shuffle_santa': 10,
+}
+ADMIN_CALLBACKS = ('admin_stats', 'admin_users', 'admin_users:w', 'admin_users:n')
+
+
+class FakeTelegram(BaseRequest):
+    """Имитация Bot API: ответ через latency ± jitter секунд, 429 с вероятностью rate_limit"""
+
+    def __init__(self, latency=0.03, jitter=0.02, rate_limit=0.01, retry_after=1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.limited = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        await asyncio.sleep(max(0.0, self.rng.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+
+        if api_method != 'getMe' and self.rng.random() < self.rate_limit:
+            self.limited += 1
+            return 429, json.dumps({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+        return 200, json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    def _result(self, api_method, params):
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Giftly', 'username': 'giftl_robot'}
+        if api_method in ('sendMessage', 'sendPhoto', 'editMessageText'):
+            self._message_id += 1
+            chat_id = params.get('chat_id', 0)
+            message = {
+                'message_id': self._message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, 'type': 'private'},
+                'text': params.get('text') or '',
+            }
+            if api_method == 'sendPhoto':
+                message['photo'] = [{'file_id': f"photo{self._message_id}", 'file_unique_id': 'u', 'width': 1, 'height': 1}]
+            return message
+        if api_method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'U'}}
+        return True
+
+
+# ===== Данные =====
+
+def wish_count(uid):
+    """Число желаний пользователя - детерминированно, чтобы генератор апдейтов его знал"""
+    return uid * 2654435761 % (MAX_WISHES + 1)
+
+
+def make_wishes(uid, count, rng, reserved_share=0.2):
+    return [
+        {
+            'id': f"w{uid}_{j}",
+            'name': f"Подарок {j}",
+            'price': rng.randrange(100, 10000),
+            'reserved': rng.random() < reserved_share,
+        }
+        for j in range(count)
+    ]
+
+
+def generate_snapshot(path, users, seed=0):
+    """data.json на users пользователей, users/50 групп и 10% рефералов.
+
+    Возвращает {номер группы: id админа} для генератора апдейтов.
+    """
+    rng = random.Random(seed)
+    admins = {}
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"users": {')
+        for i in range(users):
+            uid = FIRST_USER_ID + i
+            record = {
+                'name': f"User{i}",
+                'username': f"user{i}" if i % 3 else None,
+                'wishes': make_wishes(uid, wish_count(uid), rng),
+                'joined': f"2025-{1 + i % 12:02d}-{1 + i % 28:02d} 12:00:00+00:00",
+            }
+            f.write(('' if i == 0 else ',') + f'"{uid}":' + json.dumps(record, ensure_ascii=False))
+        f.write('}, "groups": {')
+        for g in range(max(1, users // 50)):
+            members = [str(FIRST_USER_ID + rng.randrange(users)) for _ in range(rng.randrange(2, 11))]
+            members = list(dict.fromkeys(members))
+            admins[g] = members[0]
+            group = {'name': f"Group{g}", 'admin_id': members[0], 'participants': members,
+                     'budget': 1000, 'date': '2025-12-25', 'shuffled': False, 'assignments': {}}
+            f.write(('' if g == 0 else ',') + f'"g{g}":' + json.dumps(group, ensure_ascii=False))
+        f.write('}, "referrals": {')
+        first = True
+        for i in range(0, users, 10):
+            referral = {'referrer': str(FIRST_USER_ID + rng.randrange(users)), 'rewarded': False}
+            f.write(('' if first else ',') + f'"{FIRST_USER_ID + i}":' + json.dumps(referral))
+            first = False
+        f.write('}}')
+    return admins
+
+
+def generate_updates(count, users, group_admins, seed=0):
+    """Список (вид, словарь апдейта) в порядке отправки"""
+    rng = random.Random(seed + 1)
+    kinds = list(MIX)
+    weights = list(MIX.values())
+    groups = len(group_admins)
+    new_user = FIRST_USER_ID + users
+    now = int(time.time())
+    updates = []
+
+    for update_id in range(1, count + 1):
+        kind = rng.choices(kinds, weights)[0]
+        uid = FIRST_USER_ID + rng.randrange(users)
+        if kind in ('start', 'start_ref'):
+            new_user += 1
+            text = '/start' if kind == 'start' else f"/start ref_{uid}"
+            update = {'message': _message(update_id, new_user, now, text=text,
+                                          entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])}
+        else:
+            sender = uid
+            if kind == 'save_wishes':
+                data = {'action': 'save_wishes', 'wishes': make_wishes(uid, rng.randrange(MAX_WISHES + 1), rng),
+                        'privacy': 'public'}
+            elif kind == 'reserve_wish':
+                owner = uid
+                data = {'action': 'reserve_wish', 'owner_id': str(owner),
+                        'wish_id': f"w{owner}_{rng.randrange(max(1, wish_count(owner)))}"}
+                sender = FIRST_USER_ID + rng.randrange(users)
+            elif kind == 'create_santa_group':
+                data = {'action': 'create_santa_group', 'group_id': f"bench{update_id}", 'name': 'Bench',
+                        'budget': 1000, 'date': '2025-12-25'}
+            else:
+                g = rng.randrange(groups)
+                sender = int(group_admins.get(g, uid))
+                data = {'action': 'shuffle_santa', 'group_id': f"g{g}"}
+            update = {'message': _message(update_id, sender, now, web_app_data={
+                'data': json.dumps(data, ensure_ascii=False), 'button_text': 'Giftly'})}
+        update['update_id'] = update_id
+        updates.append((kind, update))
+    return updates
+
+
+def generate_admin_updates(count, first_update_id, seed=0):
+    """Нажатия кнопок админки - отправляются по одному, после ответа на предыдущее"""
+    rng = random.Random(seed + 2)
+    now = int(time.time())
+    updates = []
+    for update_id in range(first_update_id, first_update_id + count):
+        updates.append(('admin_callback', {'update_id': update_id, 'callback_query': {
+            'id': str(update_id),
+            'from': _user(ADMIN_ID),
+            'chat_instance': 'bench',
+            'data': rng.choice(ADMIN_CALLBACKS),
+            'message': _message(update_id, ADMIN_ID, now, text='admin'),
+        }}))
+    return updates
+
+
+def _user(uid):
+    return {'id': uid, 'is_bot': False, 'first_name': f"User{uid - FIRST_USER_ID}"}
+
+
+def _message(message_id, uid, date, **fields):
+    return dict({'message_id': message_id, 'date': date, 'chat': {'id': uid, 'type': 'private'},
+                 'from': _user(uid)}, **fields)
+
+
+# ===== Прогон =====
+
+def percentile(values, q):
+    """Перцентиль методом ближайшего ранга, values отсортированы"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))]
+
+
+async def run_single(users, updates_count, admin_count, concurrency, telegram, workdir, seed=0):
+    """Один прогон в текущем процессе; bot импортируется после настройки окружения"""
+    os.environ.update({
+        'DATA_FILE': os.path.join(workdir, 'data.json'),
+        'STORAGE': 'journal',
+        'MEDIA_CACHE_FILE': os.path.join(workdir, 'media_cache.json'),
+        'BROADCAST_DIR': os.path.join(workdir, 'broadcasts'),
+        'STORY_CACHE_DIR': os.path.join(workdir, 'stories'),
+        'REMINDERS_FILE': os.path.join(workdir, 'reminders.jsonl'),
+        'METRICS_PORT': '0',
+        # Меряются обработчики, а не лимит частоты пользователя; ограничение
+        # очереди чата (CHAT_QUEUE_LIMIT) - как в продакшене
+        'FLOOD_RATE': '0',
+    })
+    started = time.perf_counter()
+    group_admins = generate_snapshot(os.environ['DATA_FILE'], users, seed)
+    generate_seconds = time.perf_counter() - started
+
+    import logging
+    import bot
+    from telegram import Update
+    logging.getLogger().setLevel(logging.WARNING)
+
+    request = FakeTelegram(seed=seed, **telegram)
+    application = bot.build_application(request=request)
+    errors = defaultdict(int)
+    kinds = {}
+    latencies = defaultdict(list)
+
+    # Уведомления жеребьёвки идут фоновой задачей после ответа обработчика
+    notify_santa_draw = bot.notify_santa_draw
+
+    async def timed_notify(*args):
+        begin = time.perf_counter()
+        try:
+            return await notify_santa_draw(*args)
+        finally:
+            latencies['santa_notify'].append(time.perf_counter() - begin)
+
+    bot.notify_santa_draw = timed_notify
+
+    async def on_error(update, context):
+        errors[kinds.get(getattr(update, 'update_id', None), 'other')] += 1
+
+    application.add_error_handler(on_error)
+
+    started = time.perf_counter()
+    bot.store.open()
+    # Как run_polling: без start() задачи application.create_task не ждут
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    startup_seconds = time.perf_counter() - started
+
+    generated = generate_updates(updates_count, users, group_admins, seed)
+    generated += generate_admin_updates(admin_count, updates_count + 1, seed)
+    stream = [(kind, Update.de_json(data, application.bot)) for kind, data in generated]
+    for kind, update in stream:
+        kinds[update.update_id] = kind
+    admin_stream = stream[updates_count:]
+    stream = stream[:updates_count]
+
+    in_flight = asyncio.Semaphore(concurrency)
+    processor = application.update_processor
+
+    async def one(kind, update):
+        begin = time.perf_counter()
+        try:
+            await processor.process_update(update, application.process_update(update))
+        finally:
+            latencies[kind].append(time.perf_counter() - begin)
+
+    async def concurrent(kind, update):
+        try:
+            await one(kind, update)
+        finally:
+            in_flight.release()
+
+    async def serial():
+        for kind, update in admin_stream:
+            await one(kind, update)
+
+    tasks = []
+    started = time.perf_counter()
+    admin = asyncio.create_task(serial())
+    for kind, update in stream:
+        # Задачи создаются в порядке поступления - как из очереди апдейтов
+        await in_flight.acquire()
+        tasks.append(asyncio.create_task(concurrent(kind, update)))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+    await admin
+    # stop() дожидается фоновых задач (уведомлений жеребьёвки)
+    await application.stop()
+    background_seconds = time.perf_counter() - started - duration
+
+    await application.shutdown()
+    bot.store.close()
+    bot.stories.close()
+
+    handlers = {}
+    for kind, values in sorted(latencies.items()):
+        values.sort()
+        handlers[kind] = {
+            'count': len(values),
+            'errors': errors.get(kind, 0),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2),
+        }
+    return {
+        'users': users,
+        'updates': updates_count,
+        'generate_s': round(generate_seconds, 3),
+        'startup_s': round(startup_seconds, 3),
+        'duration_s': round(duration, 3),
+        'background_s': round(background_seconds, 3),
+        'throughput': round(updates_count / duration, 1) if duration else None,
+        'dropped': processor.dropped,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'telegram_calls': dict(request.calls),
+        'telegram_429': request.limited,
+        'handlers': handlers,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Сравнение двух результатов: строки отчёта, регрессии отмечены ⚠️"""
+    lines = []
+    old_runs = {run['users']: run for run in old.get('runs', [])}
+    for run in new.get('runs', []):
+        before = old_runs.get(run['users'])
+        if not before:
+            continue
+        lines.append(f"users={run['users']}")
+        pairs = [('throughput', before['throughput'], run['throughput'], True)]
+        for kind, stats in run['handlers'].items():
+            if kind in before['handlers']:
+                pairs.append((f"{kind} p95_ms", before['handlers'][kind]['p95_ms'], stats['p95_ms'], False))
+        for name, was, now, higher_is_better in pairs:
+            if not was or now is None:
+                continue
+            change = (now - was) / was
+            worse = -change if higher_is_better else change
+            mark = '⚠️ ' if worse > threshold else '   '
+            lines.append(f"  {mark}{name}: {was} -> {now} ({change:+.1%})")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', default='1000,10000,100000', help="размеры базы через запятую")
+    parser.add_argument('--updates', type=int, default=5000, help="апдейтов на прогон")
+    parser.add_argument('--admin-updates', type=int, default=100, help="нажатий кнопок админки (последовательно)")
+    parser.add_argument('--concurrency', type=int, default=1000, help="апдейтов в обработке одновременно")
+    parser.add_argument('--latency', type=float, default=0.03, help="задержка Bot API, с")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--rate-limit', type=float, default=0.01, help="доля ответов 429")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='benchmark-results.json')
+    parser.add_argument('--compare', help="прошлый результат для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.1, help="порог регрессии")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    telegram = {'latency': args.latency, 'jitter': args.jitter, 'rate_limit': args.rate_limit}
+
+    if args.single:
+        # Дочерний процесс: один размер базы, результат - в stdout
+        with tempfile.TemporaryDirectory() as workdir:
+            result = asyncio.run(run_single(args.single, args.updates, args.admin_updates, args.concurrency,
+                                            telegram, workdir, args.seed))
+        print(json.dumps(result))
+        return
+
+    runs = []
+    for users in [int(u) for u in args.users.split(',') if u.strip()]:
+        print(f"⏳ users={users}...", file=sys.stderr)
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--single', str(users), '--updates', str(args.updates),
+             '--admin-updates', str(args.admin_updates),
+             '--concurrency', str(args.concurrency), '--latency', str(args.latency), '--jitter', str(args.jitter),
+             '--rate-limit', str(args.rate_limit), '--seed', str(args.seed)],
+            capture_output=True, text=True
+        )
+        if child.returncode != 0:
+            print(child.stderr, file=sys.stderr)
+            sys.exit(f"❌ Прогон users={users} завершился с ошибкой")
+        run = json.loads(child.stdout.strip().splitlines()[-1])
+        runs.append(run)
+        print(f"✅ users={users}: {run['throughput']} апдейтов/с, старт {run['startup_s']} с", file=sys.stderr)
+
+    result = {
+        'version': git_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'config': {'updates': args.updates, 'admin_updates': args.admin_updates, 'concurrency': args.concurrency,
+                   'mix': MIX, 'telegram': telegram},
+        'runs': runs,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"📄 Результат: {args.out}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        print('\n'.join(compare(old, result, args.threshold)))
+
+
+if __name__ == '__main__':
+    main()
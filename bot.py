@@ -7,14 +7,60 @@ Giftly - Telegram Bot
 """
 
 import os
+import sys
 import json
+import asyncio
 import logging
-from telegram import Update, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, MenuButtonWebApp
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from datetime import datetime, timezone
+from storage import create_storage
+from webhook import allowed_updates_for, serve_webhook, webhook_secret
+from broadcast import BroadcastEngine, SharedTokenBucket
+from delivery import DeliveryStatus
+from media import MediaCache, content_hash, decode_data_url
+from stories import StoryRenderer
+from concurrency import ChatOrderedUpdateProcessor, KeyedLocks, ProcessKeyedLocks
+from flood import FloodControl
+from indexes import ReferralGraph, Segments, Stats, TicketCounts, UserBrowser, WishIndex, WishPreviews
+from raffle import RaffleError, export_csv, protocol, run_raffle
+from referrals import ReferralRewards, parse_user_id
+from reminders import SantaReminders
+from reservations import ReservationError, Reservations
+from wishlist import APPLIED, CONFLICT, DUPLICATE, INVALID, merge_full_list, plan_ops
+from subscriptions import SubscriptionCache
+from transfer import TransferError, run_command
+from workers import Dispatcher, serve_dispatcher, serve_worker, worker_command
+from metrics import (
+    Registry, MetricsServer, SamplingProfiler, InstrumentedRequest, instrument_handlers,
+    application_collector, broadcast_collector, flood_collector, storage_collector,
+)
+from santa import SantaDrawError, build_exclusions, draw, notify_all, valid_group_id
+from telegram import (
+    Update, WebAppInfo, InlineKeyboardButton, InlineKeyboardMarkup, MenuButtonWebApp,
+    InlineQueryResultArticle, InputTextMessageContent,
+)
+from telegram.request import HTTPXRequest
+from telegram.ext import (
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler,
+    ContextTypes, filters,
+)
+
+# Несколько процессов (workers.py): WORKERS > 1 - этот процесс диспетчер,
+# воркерам он сам выставляет WORKER_ID (0..WORKERS-1) и WORKER_SOCKET
+WORKERS = int(os.getenv('WORKERS', '1'))
+WORKER_ID = os.getenv('WORKER_ID')
+# Фоновые задачи над общими данными - в одном процессе
+IS_LEADER = WORKER_ID in (None, '0')
+
+
+def worker_path(path):
+    """Локальные файлы процесса (кэши, рассылки) - у каждого воркера свои"""
+    return path if WORKER_ID is None else f"{path}.worker{WORKER_ID}"
+
 
 # Настройка логирования
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format=('%(asctime)s - %(name)s - %(levelname)s - %(message)s' if WORKER_ID is None
+            else f'%(asctime)s - worker {WORKER_ID} - %(name)s - %(levelname)s - %(message)s'),
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
@@ -23,21 +69,124 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN', '8464473630:AAECaHY01t2lwqlKk33RlfdZrKPAJwWz_NU')
 WEBAPP_URL = os.getenv('WEBAPP_URL', 'https://wishlist-app-vert.vercel.app')
 
-# Простое хранилище данных (в продакшене используйте базу данных)
-DATA_FILE = 'data.json'
+# Режим приёма апдейтов: "polling" или "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+# Апдейтов одного чата в очереди, сверх - отбрасываются (0 - без ограничения)
+CHAT_QUEUE_LIMIT = int(os.getenv('CHAT_QUEUE_LIMIT', '16'))
 
-def load_data():
-    """Загрузка данных из файла"""
-    try:
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {'users': {}, 'groups': {}}
+# Хранилище: "journal" - данные в памяти с журналом data.json.journal,
+# "sqlite:giftly.db" - SQLite-база по схеме supabase-schema.sql
+DATA_FILE = os.getenv('DATA_FILE', 'data.json')
+STORAGE = os.getenv('STORAGE', 'journal')
+store = create_storage(STORAGE, DATA_FILE)
+
+# Апдейты обрабатываются параллельно: "прочитать - изменить - записать"
+# выполняется под блокировкой ключа записи, например locks('users', user_id).
+# У воркеров база общая: блокировки межпроцессные, события - из ленты изменений
+if WORKER_ID is None:
+    locks = KeyedLocks()
+else:
+    store.follow_changes(int(WORKER_ID))
+    locks = ProcessKeyedLocks(STORAGE.removeprefix('sqlite:') + '.locks')
+
+# Счётчики админ-панели обновляются при каждой записи
+stats = Stats()
+store.subscribe(stats.on_change)
+
+# Индексы для постраничного просмотра пользователей в админке
+browser = UserBrowser()
+store.subscribe(browser.on_change)
+USERS_PAGE_SIZE = 20
+
+# Превью желаний для inline-режима, сбрасываются при изменении вишлиста
+inline_previews = WishPreviews()
+store.subscribe(inline_previews.on_change)
+INLINE_PAGE_SIZE = 20
+INLINE_CACHE_TIME = 30  # секунд - кэш Telegram нельзя сбросить, поэтому короткий
+
+# Резервы желаний: поиск по индексу id желания, резерв истекает через
+# RESERVATION_TTL_DAYS дней (0 - бессрочно)
+wish_index = WishIndex()
+store.subscribe(wish_index.on_change)
+RESERVATION_TTL_DAYS = float(os.getenv('RESERVATION_TTL_DAYS', '30'))
+reservations = Reservations(store, locks, wish_index, ttl=RESERVATION_TTL_DAYS * 24 * 3600 or None)
+
+# file_id загруженных картинок - одна картинка загружается один раз
+MEDIA_CACHE_FILE = worker_path(os.getenv('MEDIA_CACHE_FILE', 'media_cache.json'))
+media = MediaCache(MEDIA_CACHE_FILE)
+
+# Рассылки: задания и прогресс доставки хранятся в BROADCAST_DIR, кто
+# заблокировал бота или удалил аккаунт - в DELIVERY_STATUS_FILE. У воркеров
+# статус доставки и лимит отправки (30 сообщений/с на бота) - в общей базе
+BROADCAST_DIR = worker_path(os.getenv('BROADCAST_DIR', 'broadcasts'))
+if WORKER_ID is None:
+    DELIVERY_STATUS_FILE = os.getenv('DELIVERY_STATUS_FILE', 'delivery_status.bin')
+    delivery = DeliveryStatus(DELIVERY_STATUS_FILE)
+    broadcasts = BroadcastEngine(BROADCAST_DIR, media, status=delivery)
+else:
+    delivery = DeliveryStatus(store=store)
+    store.subscribe(delivery.on_change)
+    broadcasts = BroadcastEngine(BROADCAST_DIR, media, status=delivery, bucket=SharedTokenBucket(store, 30))
+
+# Аудитории рассылок (/broadcast #сегмент текст)
+segments = Segments(browser)
+store.subscribe(segments.on_change)
+SEGMENT_LABELS = {
+    'all': "все",
+    'wishes': "с желаниями",
+    'santa': "участники Тайного Санты",
+}
+
+# Граф приглашений и награды: билеты за приглашённых начисляются пачками в фоне
+referral_graph = ReferralGraph()
+store.subscribe(referral_graph.on_change)
+referral_rewards = ReferralRewards(store, locks, referral_graph, bucket=broadcasts.bucket)
+LEADERBOARD_SIZE = 10
+
+# Розыгрыши: веса - число неиспользованных билетов, протоколы в RAFFLE_DIR
+ticket_counts = TicketCounts()
+store.subscribe(ticket_counts.on_change)
+RAFFLE_DIR = os.getenv('RAFFLE_DIR', 'raffles')
+
+# Напоминания о дате обмена Тайного Санты (за неделю, накануне, в день
+# обмена) и просьбы провести жеребьёвку - в REMINDER_HOUR часов по
+# UTC+REMINDER_UTC_OFFSET, таймеры групп хранятся в REMINDERS_FILE
+REMINDERS_FILE = os.getenv('REMINDERS_FILE', 'reminders.jsonl')
+reminders = SantaReminders(
+    REMINDERS_FILE, store, bucket=broadcasts.bucket, status=delivery,
+    hour=int(os.getenv('REMINDER_HOUR', '10')), utc_offset=float(os.getenv('REMINDER_UTC_OFFSET', '3')),
+)
+if IS_LEADER:
+    store.subscribe(reminders.on_change)
 
-def save_data(data):
-    """Сохранение данных в файл"""
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+# Картинки для Stories рисуются на сервере (нужен cairosvg) и кэшируются
+# в STORY_CACHE_DIR; картинка из приложения - только если рисовать нечем
+STORY_CACHE_DIR = worker_path(os.getenv('STORY_CACHE_DIR', 'stories'))
+stories = StoryRenderer(STORY_CACHE_DIR, media)
+MAX_STORY_PAYLOAD = 8 * 1024 * 1024  # base64 картинки из приложения, символов
+
+# Проверка подписки на каналы заданий: статусы кэшируются, запросы к Telegram
+# ограничены по частоте. TASK_CHANNELS - каналы через запятую для /check
+subscriptions = SubscriptionCache()
+TASK_CHANNELS = [c.strip() for c in os.getenv('TASK_CHANNELS', '').split(',') if c.strip()]
+
+# Метрики Prometheus на METRICS_LISTEN:METRICS_PORT (/metrics), 0 - выключено.
+# PROFILER=1 - семплирующий профайлер с самого старта, результат - /profile/stop
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9090'))
+if WORKER_ID is not None and METRICS_PORT:
+    # Воркер i - на METRICS_PORT + 1 + i
+    METRICS_PORT += 1 + int(WORKER_ID)
+metrics = Registry()
+metrics.collector(storage_collector(store))
+metrics.collector(broadcast_collector(broadcasts))
+metrics_server = MetricsServer(metrics, SamplingProfiler())
 
 # Команды бота
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -45,34 +194,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Сохраняем пользователя в базу
-    db = load_data()
     user_id = str(user.id)
-    if user_id not in db['users']:
-        db['users'][user_id] = {
-            'name': user.first_name,
-            'username': user.username,
-            'wishes': [],
-            'joined': str(update.message.date)
-        }
-        save_data(db)
+    # /start после блокировки - бот снова может писать в этот чат
+    delivery.seen(user_id)
+    async with locks('users', user_id):
+        if await store.get_user(user_id) is None:
+            await store.put_user(user_id, {
+                'name': user.first_name,
+                'username': user.username,
+                'wishes': [],
+                'joined': str(update.message.date)
+            })
     
     # Проверяем параметры (для deep linking)
     args = context.args
     
     # Обработка реферальной ссылки
     if args and args[0].startswith('ref_'):
-        referrer_id = args[0].replace('ref_', '')
-        if referrer_id != user_id:
+        referrer_id = parse_user_id(args[0][len('ref_'):])
+        # Пригласивший - существующий пользователь и не сам приглашённый
+        if referrer_id and referrer_id != user_id and await store.get_user(referrer_id) is not None:
             # Сохраняем реферала
-            if 'referrals' not in db:
-                db['referrals'] = {}
-            if user_id not in db['referrals']:
-                db['referrals'][user_id] = {
-                    'referrer': referrer_id,
-                    'rewarded': False
-                }
-                save_data(db)
-                logger.info(f"New referral: {user_id} from {referrer_id}")
+            async with locks('referrals', user_id):
+                if await store.get_referral(user_id) is None:
+                    await store.put_referral(user_id, {
+                        'referrer': referrer_id,
+                        'rewarded': False
+                    })
+                    logger.info(f"New referral: {user_id} from {referrer_id}")
     
     # Создаём клавиатуру с WebApp кнопками
     keyboard = [
@@ -93,6 +242,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если есть параметр приглашения в группу
     if args and args[0].startswith('santa_'):
         group_id = args[0].replace('santa_', '')
+        # Пришедший по приглашению - участник будущей жеребьёвки
+        async with locks('groups', group_id):
+            group = await store.get_group(group_id)
+            if group and not group.get('shuffled') and user_id not in group.get('participants', []):
+                await store.put_group(group_id, dict(group, participants=group.get('participants', []) + [user_id]))
         keyboard.append([InlineKeyboardButton(
             "🎄 Присоединиться к группе",
             web_app=WebAppInfo(url=f"{WEBAPP_URL}/santa.html?invite={group_id}")
@@ -201,6 +355,22 @@ async def share_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Админские команды
 ADMIN_ID = 7086128174
 
+# Лимит частоты запросов пользователя (кроме админа): FLOOD_RATE токенов в
+# секунду (0 - без лимита), запас FLOOD_BURST. Апдейт стоит 1 токен, у дорогих действий -
+# свой bucket на пользователя с ценой из FLOOD_COSTS
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '1'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '20'))
+FLOOD_COSTS = {
+    'start': 2,
+    'send_story_image': 10,
+    'broadcast': 10,
+    'shuffle_santa': 10,
+    'create_santa_group': 5,
+    'check': 5,
+}
+flood = FloodControl(FLOOD_RATE, FLOOD_BURST, FLOOD_COSTS, exempt=(ADMIN_ID,))
+metrics.collector(flood_collector(flood))
+
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Админ-панель в боте"""
     user = update.effective_user
@@ -208,25 +378,24 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Нет доступа")
         return
     
-    db = load_data()
-    users = db.get('users', {})
-    groups = db.get('groups', {})
-    total_wishes = sum(len(u.get('wishes', [])) for u in users.values())
+    counts = stats.snapshot()
     
     keyboard = [
         [InlineKeyboardButton("📢 Рассылка", callback_data="admin_broadcast")],
         [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton("📊 Подробная статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("🤝 Рефералы", callback_data="admin_referrals")],
         [InlineKeyboardButton("🌐 Открыть админку", web_app=WebAppInfo(url=f"{WEBAPP_URL}/admin.html"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text(
         f"⚙️ Админ-панель Giftly\n\n"
-        f"👥 Пользователей: {len(users)}\n"
-        f"🎁 Желаний: {total_wishes}\n"
-        f"🎅 Групп Санты: {len(groups)}\n\n"
+        f"👥 Пользователей: {counts['users']}\n"
+        f"🎁 Желаний: {counts['wishes']}\n"
+        f"🎅 Групп Санты: {counts['groups']}\n\n"
         f"📢 Рассылка: /broadcast текст\n"
+        f"🔍 Поиск: /users имя или @username\n"
         f"📷 С фото: ответь на фото командой",
         reply_markup=reply_markup
     )
@@ -241,69 +410,194 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
         await update.message.reply_text(
             "📢 Использование:\n"
-            "/broadcast Текст сообщения\n\n"
+            "/broadcast Текст сообщения\n"
+            "/broadcast #сегмент Текст сообщения\n\n"
+            f"Сегменты: {', '.join(f'#{name} - {label}' for name, label in SEGMENT_LABELS.items())}, "
+            "#since:ГГГГ-ММ-ДД - зарегистрированные с даты\n\n"
             "Или ответьте на фото с командой /broadcast для рассылки с фото"
         )
         return
     
-    message_text = ' '.join(context.args)
-    db = load_data()
-    users = db.get('users', {})
+    args = context.args
+    segment = 'all'
+    if args[0].startswith('#'):
+        segment, args = args[0][1:], args[1:]
+    audience = select_audience(segment)
+    if audience is None:
+        await update.message.reply_text(f"❌ Неизвестный сегмент: #{segment}")
+        return
+    
+    message_text = ' '.join(args)
+    if not message_text:
+        await update.message.reply_text("❌ Пустое сообщение")
+        return
+    
+    # Заблокировавшие бота и удалённые аккаунты не получают рассылку
+    users = delivery.reachable(audience)
     
     if not users:
         await update.message.reply_text("❌ Нет пользователей для рассылки")
         return
     
-    sent = 0
-    failed = 0
-    blocked = 0
-    
     # Проверяем есть ли фото в ответе
     photo = None
     if update.message.reply_to_message and update.message.reply_to_message.photo:
         photo = update.message.reply_to_message.photo[-1].file_id
     
-    status_msg = await update.message.reply_text(f"⏳ Начинаю рассылку {len(users)} пользователям...")
+    status_msg = await update.message.reply_text(
+        f"⏳ Начинаю рассылку {len(users)} пользователям "
+        f"(недоступных пропущено: {len(audience) - len(users)})..."
+    )
     
-    for user_id in users.keys():
-        try:
-            if photo:
-                await context.bot.send_photo(
-                    chat_id=int(user_id),
-                    photo=photo,
-                    caption=message_text,
-                    parse_mode='HTML'
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=int(user_id),
-                    text=message_text,
-                    parse_mode='HTML'
-                )
-            sent += 1
-            
-            # Обновляем статус каждые 10 сообщений
-            if sent % 10 == 0:
-                try:
-                    await status_msg.edit_text(f"⏳ Отправлено: {sent}/{len(users)}...")
-                except:
-                    pass
-                    
-        except Exception as e:
-            error_str = str(e).lower()
-            if 'blocked' in error_str or 'deactivated' in error_str:
-                blocked += 1
-            else:
-                failed += 1
-            logger.error(f"Failed to send to {user_id}: {e}")
-    
-    await status_msg.edit_text(
-        f"✅ Рассылка завершена!\n\n"
-        f"📨 Отправлено: {sent}\n"
-        f"🚫 Заблокировали: {blocked}\n"
-        f"❌ Ошибок: {failed}"
+    # Рассылка идёт в фоне, прогресс обновляется в status_msg
+    broadcasts.submit(
+        context.bot,
+        recipients=users,
+        text=message_text,
+        photo=photo,
+        parse_mode='HTML',
+        status_chat_id=status_msg.chat_id,
+        status_message_id=status_msg.message_id
     )
 
+async def raffle_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Розыгрыш по билетикам: /raffle <победителей> [название]"""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("🎰 Использование: /raffle число_победителей [название]")
+        return
+    
+    winners = int(context.args[0])
+    title = ' '.join(context.args[1:]) or "Розыгрыш"
+    # Снимок весов; дерево Фенвика и розыгрыш - в отдельном потоке, не на event loop
+    counts = dict(ticket_counts.counts)
+    try:
+        result = await asyncio.to_thread(run_raffle, counts, winners)
+    except RaffleError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    
+    created_at = datetime.now(timezone.utc)
+    # Младшие биты случайного seed - два розыгрыша в одну секунду не перезапишут друг друга
+    raffle_id = f"raffle_{created_at.strftime('%Y%m%d%H%M%S')}_{result['seed'] & 0xffffffff:08x}"
+    # seed и хэш участников сохраняются - по ним результат можно проверить;
+    # билеты снимка той же транзакцией отмечаются использованными
+    await store.complete_raffle(raffle_id, dict(
+        protocol(result),
+        title=title,
+        status='completed',
+        winner_id=result['winners'][0]['user_id'],
+        created_at=created_at.isoformat()
+    ), counts)
+    logger.info(f"Raffle {raffle_id}: seed {result['seed']}, {result['total_tickets']} tickets")
+    
+    users = await store.get_users([w['user_id'] for w in result['winners']])
+    lines = '\n'.join(
+        f"{place}. {users.get(w['user_id'], {}).get('name', w['user_id'])} - {w['tickets']} 🎟️"
+        for place, w in enumerate(result['winners'], 1)
+    )
+    await update.message.reply_text(
+        f"🎰 {title}\n\n"
+        f"👥 Участников: {result['participants']}\n"
+        f"🎟️ Билетиков: {result['total_tickets']}\n\n"
+        f"🏆 Победители:\n{lines}\n\n"
+        f"🔑 seed: {result['seed']}\n"
+        f"🧾 sha256: {result['snapshot_sha256']}"
+    )
+    
+    # Полный протокол - файлом, запись идёт построчно в отдельном потоке
+    os.makedirs(RAFFLE_DIR, exist_ok=True)
+    path = await asyncio.to_thread(export_csv, os.path.join(RAFFLE_DIR, f"{raffle_id}.csv"), raffle_id, result)
+    with open(path, 'rb') as f:
+        await update.message.reply_document(f, filename=f"{raffle_id}.csv")
+    
+    messages = {
+        w['user_id']: f"🎉 Поздравляем! Ты выиграл(а) в розыгрыше «{title}» (место {place})!\n\nСкоро мы свяжемся с тобой 🎁"
+        for place, w in enumerate(result['winners'], 1)
+    }
+    await notify_all(context.bot, messages, bucket=broadcasts.bucket)
+
+def select_audience(segment):
+    """Получатели сегмента: 'all', 'wishes', 'santa' или 'since:ГГГГ-ММ-ДД'"""
+    if segment.startswith('since:'):
+        day = segment[len('since:'):]
+        try:
+            datetime.strptime(day, '%Y-%m-%d')
+        except ValueError:
+            return None
+        return segments.joined_since(day)
+    if segment in SEGMENT_LABELS:
+        return list(segments.get(segment))
+    return None
+
+def parse_page_cursor(parts):
+    """Курсор из callback_data: ['n'|'p', 'id.номер_ключа'] -> (after, before)"""
+    if len(parts) != 2 or '.' not in parts[1]:
+        return None, None
+    uid, k = parts[1].rsplit('.', 1)
+    cursor = (uid, int(k)) if k.isdigit() else None
+    return (cursor, None) if parts[0] == 'n' else (None, cursor)
+
+async def render_users_page(page, callback_prefix, sort=None, prefix=None):
+    """Текст и кнопки страницы списка пользователей"""
+    cursors, has_prev, has_next = page
+    uids = list(dict.fromkeys(uid for uid, _ in cursors))
+    users = await store.get_users(uids)
+    
+    if prefix is not None:
+        text = f"🔍 Поиск «{prefix}»:\n\n" if uids else f"🔍 По запросу «{prefix}» никого не нашлось"
+    else:
+        text = f"👥 Пользователи ({stats.counters['users']}):\n\n"
+    for uid in uids:
+        udata = users.get(uid, {})
+        name = udata.get('name', 'Без имени')
+        username = f"@{udata['username']}, " if udata.get('username') else ""
+        wishes = len(udata.get('wishes', []))
+        text += f"• {name} ({username}ID: {uid}) - {wishes} желаний\n"
+    
+    def nav(direction, cursor):
+        uid, k = cursor
+        if prefix is not None:
+            # callback_data ограничена 64 байтами - префикс идёт последним и обрезается
+            return f"{callback_prefix}:{direction}:{uid}.{k}:{prefix}".encode()[:64].decode(errors='ignore')
+        return f"{callback_prefix}:{direction}:{uid}.{k}"
+    
+    keyboard = []
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton("⬅️ Назад", callback_data=nav('p', cursors[0])))
+    if has_next:
+        row.append(InlineKeyboardButton("Вперёд ➡️", callback_data=nav('n', cursors[-1])))
+    if row:
+        keyboard.append(row)
+    if sort is not None:
+        keyboard.append([
+            InlineKeyboardButton(("• " if key == sort else "") + label, callback_data=f"admin_users:{key}")
+            for key, (label, _, _) in UserBrowser.SORTS.items()
+        ])
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск пользователей по началу имени или username"""
+    user = update.effective_user
+    if user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("🔍 Использование: /users начало имени или @username")
+        return
+    
+    # Префикс попадает в callback_data кнопок, поэтому ограничиваем длину
+    prefix = ' '.join(context.args)[:16]
+    page = browser.find(prefix, USERS_PAGE_SIZE)
+    text, reply_markup = await render_users_page(page, "admin_find", prefix=prefix)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
 async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кнопок админ-панели"""
     query = update.callback_query
@@ -315,53 +609,121 @@ async def admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await query.answer()
     data = query.data
-    db = load_data()
     
     if data == "admin_broadcast":
         await query.edit_message_text(
             "📢 Рассылка\n\n"
             "Используйте команду:\n"
-            "/broadcast Текст сообщения\n\n"
+            "/broadcast Текст сообщения\n"
+            "/broadcast #сегмент Текст сообщения\n\n"
             "Для рассылки с фото - ответьте на фото командой /broadcast"
         )
     
-    elif data == "admin_users":
-        users = db.get('users', {})
-        if not users:
+    elif data == "admin_users" or data.startswith("admin_users:"):
+        # admin_users[:<сортировка>[:<n|p>:<курсор>]]
+        if not stats.counters['users']:
             await query.edit_message_text("👥 Пользователей пока нет")
             return
         
-        text = "👥 Пользователи:\n\n"
-        for uid, udata in list(users.items())[:20]:  # Первые 20
-            name = udata.get('name', 'Без имени')
-            wishes = len(udata.get('wishes', []))
-            text += f"• {name} (ID: {uid}) - {wishes} желаний\n"
-        
-        if len(users) > 20:
-            text += f"\n... и ещё {len(users) - 20}"
-        
-        await query.edit_message_text(text)
+        parts = data.split(':')
+        sort = parts[1] if len(parts) > 1 and parts[1] in UserBrowser.SORTS else 'j'
+        after, before = parse_page_cursor(parts[2:4])
+        page = browser.page(sort, USERS_PAGE_SIZE, after, before)
+        text, reply_markup = await render_users_page(page, f"admin_users:{sort}", sort)
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
+    elif data.startswith("admin_find:"):
+        # admin_find:<n|p>:<курсор>:<префикс>
+        _, direction, cursor, prefix = data.split(':', 3)
+        after, before = parse_page_cursor([direction, cursor])
+        page = browser.find(prefix, USERS_PAGE_SIZE, after, before)
+        text, reply_markup = await render_users_page(page, "admin_find", prefix=prefix)
+        await query.edit_message_text(text, reply_markup=reply_markup)
     
     elif data == "admin_stats":
-        users = db.get('users', {})
-        groups = db.get('groups', {})
-        total_wishes = sum(len(u.get('wishes', [])) for u in users.values())
+        counts = stats.snapshot()
+        dead = delivery.counts()
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        keyboard = [[InlineKeyboardButton("🔄 Сверить счётчики", callback_data="admin_audit")]]
         
         await query.edit_message_text(
             f"📊 Статистика\n\n"
-            f"👥 Пользователей: {len(users)}\n"
-            f"🎁 Всего желаний: {total_wishes}\n"
-            f"🎅 Групп Санты: {len(groups)}"
+            f"👥 Пользователей: {counts['users']}\n"
+            f"🆕 Сегодня: {counts['joins'].get(today, 0)}\n"
+            f"🎁 Всего желаний: {counts['wishes']}\n"
+            f"🔒 Зарезервировано: {counts['reserved']}\n"
+            f"🎅 Групп Санты: {counts['groups']}\n"
+            f"🎲 Жеребьёвок: {counts['shuffled']}\n"
+            f"🤝 Рефералов: {counts['referrals']} (без награды: {counts['referrals_pending']})\n"
+            f"🚫 Заблокировали бота: {dead['blocked']}, удалили аккаунт: {dead['deactivated']}",
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
+    
+    elif data == "admin_referrals":
+        # Топ пригласивших - из кучи индекса, без обхода базы
+        top = referral_graph.top(LEADERBOARD_SIZE)
+        users = await store.get_users([referrer for referrer, _ in top])
+        lines = '\n'.join(
+            f"{place}. {users.get(referrer, {}).get('name', referrer)} - {count}"
+            for place, (referrer, count) in enumerate(top, 1)
+        ) or "Пока никого"
+        keyboard = []
+        if referral_graph.pending:
+            keyboard.append([InlineKeyboardButton("🎟️ Выдать награды", callback_data="admin_reward")])
+        
+        await query.edit_message_text(
+            f"🤝 Рефералы\n\n"
+            f"🏆 Топ пригласивших:\n{lines}\n\n"
+            f"⏳ Без награды: {len(referral_graph.pending)}",
+            reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None
+        )
+    
+    elif data == "admin_reward":
+        credited = await referral_rewards.reward_pending(context.bot)
+        await query.edit_message_text(
+            f"🎟️ Награды выданы: {sum(credited.values())} билетиков, получателей: {len(credited)}"
+        )
+    
+    elif data == "admin_audit":
+        # Полный пересчёт статистики и сверка со счётчиками
+        fresh = await store.counts()
+        drift = stats.drift(fresh)
+        stats.load(fresh)
+        
+        if drift:
+            lines = '\n'.join(f"• {field}: {was} → {actual}" for field, (was, actual) in sorted(drift.items()))
+            text = f"⚠️ Счётчики расходились и пересчитаны:\n\n{lines}"
+            logger.warning(f"Stats drift: {drift}")
+        else:
+            text = "✅ Счётчики совпадают с базой"
+        await query.edit_message_text(text)
+
+async def notify_santa_draw(bot, group, status_msg):
+    """Уведомления участникам жеребьёвки, итог - в сообщение со статусом"""
+    assignments = group['assignments']
+    # Имена получателей - одним пакетным запросом по id
+    users = await store.get_users(group['participants'])
+    messages = {
+        giver_id: f"🎅 Жеребьёвка в группе \"{group['name']}\" проведена!\n\n"
+                  f"Ты даришь подарок: {users.get(receiver_id, {}).get('name', 'участник')}\n\n"
+                  f"Открой приложение, чтобы посмотреть желания!"
+        for giver_id, receiver_id in assignments.items()
+    }
+    failed = await notify_all(bot, messages, bucket=broadcasts.bucket)
+    
+    if failed:
+        names = ', '.join(users.get(uid, {}).get('name', uid) for uid in failed)
+        text = (f"🎉 Жеребьёвка проведена! Уведомления получили {len(messages) - len(failed)} из {len(messages)}.\n\n"
+                f"Не удалось уведомить: {names}")
+    else:
+        text = "🎉 Жеребьёвка проведена! Все участники получили уведомления."
+    await status_msg.edit_text(text)
 
 async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка данных из WebApp"""
     data = json.loads(update.effective_message.web_app_data.data)
     user_id = str(update.effective_user.id)
     
-    # Загружаем данные
-    db = load_data()
-    
     action = data.get('action')
     
     if action == 'broadcast':
@@ -374,68 +736,98 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         photo = data.get('photo')  # base64 encoded image
         recipients = data.get('recipients', [])
         
-        sent_count = 0
-        for recipient_id in recipients:
-            try:
-                if photo:
-                    # Декодируем base64 фото
-                    import base64
-                    photo_data = photo.split(',')[1] if ',' in photo else photo
-                    photo_bytes = base64.b64decode(photo_data)
-                    await context.bot.send_photo(
-                        chat_id=int(recipient_id),
-                        photo=photo_bytes,
-                        caption=message
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=int(recipient_id),
-                        text=message
-                    )
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send to {recipient_id}: {e}")
+        if photo:
+            # Декодируем base64 фото один раз, загрузится оно тоже один раз
+            photo = decode_data_url(photo)
         
-        await update.message.reply_text(f"✅ Рассылка отправлена: {sent_count} получателей")
+        status_msg = await update.message.reply_text(f"⏳ Начинаю рассылку {len(recipients)} получателям...")
+        broadcasts.submit(
+            context.bot,
+            recipients=recipients,
+            text=message,
+            photo=photo,
+            status_chat_id=status_msg.chat_id,
+            status_message_id=status_msg.message_id
+        )
         return
     
-    if action == 'save_wishes':
-        # Сохранение вишлиста
-        db['users'][user_id] = {
-            'wishes': data.get('wishes', []),
-            'privacy': data.get('privacy', 'public'),
-            'name': update.effective_user.first_name
-        }
-        save_data(db)
+    if action == 'patch_wishes':
+        # Изменения вишлиста операциями: пишутся только затронутые желания
+        async with locks('users', user_id):
+            user = await store.get_user(user_id)
+            delta, results = plan_ops(user, data.get('ops', []))
+            fields = {'name': update.effective_user.first_name}
+            if data.get('privacy'):
+                fields['privacy'] = data['privacy']
+            changed = {k: v for k, v in fields.items() if (user or {}).get(k) != v}
+            if changed:
+                delta['set'] = changed
+            if delta:
+                await store.patch_user(user_id, delta)
+        
+        conflicts = sum(1 for r in results if r['status'] == CONFLICT)
+        invalid = sum(1 for r in results if r['status'] == INVALID)
+        if conflicts or invalid:
+            text = f"⚠️ Сохранено изменений: {sum(1 for r in results if r['status'] in (APPLIED, DUPLICATE))}."
+            if conflicts:
+                text += f" Не применено: {conflicts} - вишлист изменён в другом окне, обнови приложение."
+            if invalid:
+                text += f" Отклонено некорректных изменений: {invalid}."
+            await update.message.reply_text(text)
+        else:
+            await update.message.reply_text("✅ Вишлист сохранён!")
+    
+    elif action == 'save_wishes':
+        # Сохранение вишлиста целиком (старые версии приложения): остальные поля
+        # записи и резервы желаний сохраняются
+        async with locks('users', user_id):
+            user = await store.get_user(user_id) or {}
+            await store.put_user(user_id, dict(
+                user,
+                wishes=merge_full_list(user.get('wishes', []), data.get('wishes', [])),
+                privacy=data.get('privacy', 'public'),
+                name=update.effective_user.first_name
+            ))
         await update.message.reply_text("✅ Вишлист сохранён!")
     
     elif action == 'reserve_wish':
-        # Резервирование подарка
-        owner_id = data.get('owner_id')
-        wish_id = data.get('wish_id')
-        
-        if owner_id in db['users']:
-            for wish in db['users'][owner_id].get('wishes', []):
-                if wish.get('id') == wish_id:
-                    wish['reserved'] = True
-                    wish['reserved_by'] = user_id
-                    save_data(db)
-                    await update.message.reply_text("🎁 Отлично! Ты зарезервировал(а) этот подарок!")
-                    break
+        # Резервирование подарка: занятый подарок повторно не резервируется
+        try:
+            await reservations.reserve(data.get('owner_id'), data.get('wish_id'), user_id)
+        except ReservationError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        await update.message.reply_text("🎁 Отлично! Ты зарезервировал(а) этот подарок!")
+    
+    elif action == 'unreserve_wish':
+        # Снятие своего резерва
+        try:
+            await reservations.unreserve(data.get('owner_id'), data.get('wish_id'), user_id)
+        except ReservationError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        await update.message.reply_text("↩️ Резерв снят")
     
     elif action == 'create_santa_group':
         # Создание группы Тайного Санты
         group_id = data.get('group_id')
-        db['groups'][group_id] = {
-            'name': data.get('name'),
-            'admin_id': user_id,
-            'participants': [user_id],
-            'budget': data.get('budget'),
-            'date': data.get('date'),
-            'shuffled': False,
-            'assignments': {}
-        }
-        save_data(db)
+        if not valid_group_id(group_id):
+            await update.message.reply_text("❌ Некорректный id группы")
+            return
+        async with locks('groups', group_id):
+            # Существующую группу не перезаписываем - иначе её админом стал бы любой
+            if await store.get_group(group_id) is not None:
+                await update.message.reply_text("❌ Группа с таким id уже существует")
+                return
+            await store.put_group(group_id, {
+                'name': data.get('name'),
+                'admin_id': user_id,
+                'participants': [user_id],
+                'budget': data.get('budget'),
+                'date': data.get('date'),
+                'shuffled': False,
+                'assignments': {}
+            })
         
         invite_link = f"https://t.me/{context.bot.username}?start=santa_{group_id}"
         await update.message.reply_text(
@@ -443,106 +835,137 @@ async def handle_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     
     elif action == 'shuffle_santa':
-        # Жеребьёвка
+        # Жеребьёвка проводится на сервере, присланные клиентом assignments не используются
         group_id = data.get('group_id')
-        assignments = data.get('assignments', {})
-        
-        if group_id in db['groups']:
-            db['groups'][group_id]['shuffled'] = True
-            db['groups'][group_id]['assignments'] = assignments
-            save_data(db)
+        async with locks('groups', group_id):
+            group = await store.get_group(group_id)
+            if not group:
+                return
+            if group.get('admin_id') != user_id:
+                await update.message.reply_text("❌ Жеребьёвку может провести только админ группы")
+                return
+            
+            # Участники: вступившие по приглашению + список из приложения, но только
+            # пользователи бота - иначе админ группы мог бы написать от бота кому угодно
+            requested = [str(p) for p in data.get('participants', []) if str(p).isdigit()]
+            known = await store.get_users(requested) if requested else {}
+            participants = list(dict.fromkeys(
+                group.get('participants', []) + [p for p in requested if p in known]
+            ))
+            previous = None
+            if data.get('previous_group_id'):
+                previous_group = await store.get_group(data['previous_group_id'])
+                previous = previous_group.get('assignments') if previous_group else None
+            excluded = build_exclusions(data.get('couples', []), previous)
             
-            # Отправляем уведомления участникам
-            group = db['groups'][group_id]
-            for giver_id, receiver_id in assignments.items():
-                try:
-                    receiver_name = "участник"
-                    for uid in db['users']:
-                        if uid == receiver_id:
-                            receiver_name = db['users'][uid].get('name', 'участник')
-                            break
-                    
-                    await context.bot.send_message(
-                        chat_id=int(giver_id),
-                        text=f"🎅 Жеребьёвка в группе \"{group['name']}\" проведена!\n\n"
-                             f"Ты даришь подарок: {receiver_name}\n\n"
-                             f"Открой приложение, чтобы посмотреть желания!"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify user {giver_id}: {e}")
+            try:
+                assignments = draw(participants, excluded)
+            except SantaDrawError as e:
+                await update.message.reply_text(f"❌ Не удалось провести жеребьёвку: {e}")
+                return
             
-            await update.message.reply_text("🎉 Жеребьёвка проведена! Все участники получили уведомления.")
+            group = dict(group, participants=participants, shuffled=True, assignments=assignments)
+            await store.put_group(group_id, group)
+        
+        # Уведомления уходят в фоне: при тысячах участников и лимите ~30 сообщений
+        # в секунду это минуты, обработчик не держит слот и очередь чата админа
+        status_msg = await update.message.reply_text(
+            f"🎉 Жеребьёвка проведена! Отправляю уведомления {len(assignments)} участникам..."
+        )
+        context.application.create_task(notify_santa_draw(context.bot, group, status_msg), update=update)
     
     elif action == 'send_story_image':
         # Отправка картинки для Stories пользователю
-        import base64
-        import io
-        
         image_data = data.get('image', '')
+        caption = "📸 Твоя картинка для Stories!\n\nСохрани её и добавь в Telegram Stories 🎄"
         
-        if image_data:
-            try:
-                # Убираем префикс data:image/png;base64,
-                if ',' in image_data:
-                    image_data = image_data.split(',')[1]
-                
-                # Декодируем base64
-                image_bytes = base64.b64decode(image_data)
+        try:
+            if stories.available:
+                # Картинка по вишлисту: рисуется в отдельном процессе, пока вишлист
+                # не изменился - отправляется по сохранённому file_id
+                user = await store.get_user(user_id)
+                await stories.send(context.bot, int(user_id), user, caption=caption)
+            elif image_data:
+                if len(image_data) > MAX_STORY_PAYLOAD:
+                    await update.message.reply_text("❌ Картинка слишком большая")
+                    return
+                # Декодирование и хэш мегабайтной картинки - не в цикле событий
+                image_bytes = await asyncio.to_thread(decode_data_url, image_data)
+                digest = await asyncio.to_thread(content_hash, image_bytes)
                 
-                # Отправляем фото пользователю
-                await context.bot.send_photo(
-                    chat_id=int(user_id),
-                    photo=io.BytesIO(image_bytes),
-                    caption="📸 Твоя картинка для Stories!\n\n"
-                            "Сохрани её и добавь в Telegram Stories 🎄"
-                )
-                await update.message.reply_text("✅ Картинка отправлена в чат!")
-            except Exception as e:
-                logger.error(f"Failed to send story image: {e}")
-                await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+                # Отправляем фото пользователю: та же картинка повторно не загружается
+                await media.send_photo(context.bot, int(user_id), image_bytes, digest, caption=caption)
+            else:
+                return
+            await update.message.reply_text("✅ Картинка отправлена в чат!")
+        except Exception as e:
+            logger.error(f"Failed to send story image: {e}")
+            await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка inline запросов для шаринга"""
-    from telegram import InlineQueryResultArticle, InputTextMessageContent
-    
-    query = update.inline_query.query
+    """Обработка inline запросов: ссылка на вишлист и желания пользователя"""
+    query = update.inline_query.query.strip().casefold()
     user = update.effective_user
+    offset = int(update.inline_query.offset) if update.inline_query.offset.isdigit() else 0
+    share_url = f"https://t.me/{context.bot.username}?start=wishlist_{user.id}"
     
-    results = [
-        InlineQueryResultArticle(
+    # Желания, в названии или описании которых есть текст запроса
+    previews = await inline_previews.get(store, str(user.id))
+    if query:
+        previews = [p for p in previews if query in p['search']]
+    page = previews[offset:offset + INLINE_PAGE_SIZE]
+    
+    results = []
+    if offset == 0:
+        results.append(InlineQueryResultArticle(
             id='share_wishlist',
             title='🎁 Поделиться вишлистом',
             description='Отправить ссылку на твой вишлист',
             input_message_content=InputTextMessageContent(
-                message_text=f"🎁 Посмотри мой вишлист!\n\n"
-                            f"https://t.me/{context.bot.username}?start=wishlist_{user.id}"
+                message_text=f"🎁 Посмотри мой вишлист!\n\n{share_url}"
             )
-        )
-    ]
+        ))
+    for preview in page:
+        results.append(InlineQueryResultArticle(
+            id=f"wish_{preview['id']}",
+            title=preview['title'],
+            description=preview['description'] or None,
+            url=preview['url'],
+            thumbnail_url=preview['thumbnail_url'],
+            input_message_content=InputTextMessageContent(
+                message_text='\n'.join(filter(None, [preview['title'], preview['description']])) +
+                             f"\n\nВесь вишлист: {share_url}"
+            )
+        ))
     
-    await update.inline_query.answer(results)
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(previews) else ''
+    await update.inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=True,
+        next_offset=next_offset
+    )
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Проверка подписки на канал"""
+    """Проверка подписки на каналы"""
     user = update.effective_user
     
-    if not context.args:
+    channels = context.args or TASK_CHANNELS
+    if not channels:
         await update.message.reply_text("Использование: /check @channel_username")
         return
     
-    channel = context.args[0]
+    results = await subscriptions.verify_many(context.bot, user.id, channels)
     
-    try:
-        member = await context.bot.get_chat_member(chat_id=channel, user_id=user.id)
-        status = member.status
-        
-        if status in ['member', 'administrator', 'creator']:
-            await update.message.reply_text(f"✅ Ты подписан на {channel}!")
+    lines = []
+    for channel, subscribed in results.items():
+        if subscribed is None:
+            lines.append(f"⚠️ Не удалось проверить {channel}")
+        elif subscribed:
+            lines.append(f"✅ Ты подписан на {channel}!")
         else:
-            await update.message.reply_text(f"❌ Ты не подписан на {channel}")
-    except Exception as e:
-        logger.error(f"Check subscription error: {e}")
-        await update.message.reply_text(f"❌ Ошибка проверки: {e}")
+            lines.append(f"❌ Ты не подписан на {channel}")
+    await update.message.reply_text("\n".join(lines))
 
 async def tickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать билетики пользователя"""
@@ -558,19 +981,63 @@ async def tickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
-def main():
-    """Запуск бота"""
-    if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
-        print("❌ Ошибка: Установите BOT_TOKEN!")
-        print("   Получите токен у @BotFather в Telegram")
-        print("   Затем установите переменную окружения:")
-        print("   export BOT_TOKEN='your_token_here'")
-        return
+def build_application(request=None):
+    """Приложение со всеми обработчиками.
+
+    request - свой транспорт к Bot API (например, имитация Telegram в benchmark.py)
+    """
+    async def post_init(application):
+        # Счётчики админ-панели - один полный подсчёт при старте
+        stats.load(await store.counts())
+        await browser.build(store)
+        await wish_index.build(store)
+        await referral_graph.build(store)
+        await ticket_counts.build(store)
+        await segments.build(store)
+        if WORKER_ID is not None:
+            await delivery.build(store)
+            # Изменения других воркеров - в индексы этого
+            application.bot_data['change_feed'] = asyncio.create_task(store.run_changes())
+            application.bot_data['delivery_sync'] = asyncio.create_task(delivery.run())
+        if IS_LEADER:
+            await reminders.open()
+            # Просроченные резервы снимаются в фоне
+            application.bot_data['reservation_sweeper'] = asyncio.create_task(reservations.run())
+            application.bot_data['referral_rewards'] = asyncio.create_task(referral_rewards.run(application.bot))
+            application.bot_data['santa_reminders'] = asyncio.create_task(reminders.run(application.bot))
+        # Продолжаем рассылки, прерванные перезапуском
+        broadcasts.resume(application.bot)
+        if METRICS_PORT:
+            await metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+            if os.getenv('PROFILER') == '1':
+                metrics_server.profiler.start()
     
-    # Создаём приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    async def post_shutdown(application):
+        for name in ('reservation_sweeper', 'referral_rewards', 'santa_reminders', 'change_feed', 'delivery_sync'):
+            task = application.bot_data.pop(name, None)
+            if task:
+                task.cancel()
+        reminders.close()
+        await metrics_server.stop()
+        await delivery.flush()
     
-    # Регистрируем обработчики
+    # Создаём приложение: апдейты разных чатов обрабатываются параллельно,
+    # апдейты одного чата - по очереди
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(ChatOrderedUpdateProcessor(max_pending_per_chat=CHAT_QUEUE_LIMIT or None))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Все вызовы Bot API (кроме getUpdates) проходят через счётчики метрик
+        .request(InstrumentedRequest(request or HTTPXRequest(connection_pool_size=256), metrics))
+        .build()
+    )
+    
+    # Регистрируем обработчики. Группа -1 - лимит частоты, до всех остальных
+    if FLOOD_RATE > 0:
+        application.add_handler(TypeHandler(Update, flood.check), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("wishlist", wishlist_command))
@@ -582,20 +1049,101 @@ def main():
     # Админские команды
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("users", users_command))
+    application.add_handler(CommandHandler("raffle", raffle_command))
     application.add_handler(CallbackQueryHandler(admin_callback, pattern="^admin_"))
     
     # Обработчик данных из WebApp
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
     
     # Inline режим
-    from telegram.ext import InlineQueryHandler
     application.add_handler(InlineQueryHandler(inline_query))
     
+    # Время и ошибки каждого обработчика, глубина очереди апдейтов
+    instrument_handlers(application, metrics)
+    metrics.collector(application_collector(application))
+    
+    return application
+
+def main():
+    """Запуск бота"""
+    # Перенос данных: python bot.py import|export источник назначение
+    if len(sys.argv) > 1:
+        try:
+            run_command(sys.argv[1:])
+        except TransferError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        return
+    
+    if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
+        print("❌ Ошибка: Установите BOT_TOKEN!")
+        print("   Получите токен у @BotFather в Telegram")
+        print("   Затем установите переменную окружения:")
+        print("   export BOT_TOKEN='your_token_here'")
+        return
+    
+    # Webhook без секрета принял бы поддельные апдейты от кого угодно
+    secret_token = None
+    if BOT_MODE == 'webhook' and WORKER_ID is None:
+        try:
+            secret_token = webhook_secret(WEBHOOK_SECRET, WEBHOOK_URL)
+        except ValueError:
+            print("❌ Ошибка: для BOT_MODE=webhook задайте WEBHOOK_SECRET")
+            print("   (или WEBHOOK_URL - тогда бот сам вызовет setWebhook со случайным секретом)")
+            return
+    
+    # Несколько процессов: этот - диспетчер, апдейты обрабатывают воркеры
+    if WORKERS > 1 and WORKER_ID is None:
+        if not STORAGE.startswith('sqlite:'):
+            print("❌ Для WORKERS > 1 нужна общая база: STORAGE=sqlite:путь")
+            return
+        application = build_application()
+        print(f"🚀 Диспетчер: {WORKERS} воркеров, режим {BOT_MODE}")
+        asyncio.run(serve_dispatcher(
+            Dispatcher(WORKERS, worker_command(__file__)),
+            application.bot,
+            BOT_MODE,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=secret_token,
+            webhook_url=WEBHOOK_URL,
+            allowed_updates=allowed_updates_for(application)
+        ))
+        return
+    
+    application = build_application()
+    
+    # Открываем хранилище (для journal - загрузка снапшота и журнала в память)
+    store.open()
+    
     print("🚀 Бот запущен!")
     print(f"📱 WebApp URL: {WEBAPP_URL}")
     
+    # Запрашиваем у Telegram только те апдейты, для которых есть обработчики
+    allowed_updates = allowed_updates_for(application)
+    
     # Запускаем бота
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if WORKER_ID is not None:
+            asyncio.run(serve_worker(application, os.environ['WORKER_SOCKET']))
+        elif BOT_MODE == 'webhook':
+            print(f"🌐 Webhook: {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            asyncio.run(serve_webhook(
+                application,
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret_token=secret_token,
+                webhook_url=WEBHOOK_URL,
+                allowed_updates=allowed_updates
+            ))
+        else:
+            application.run_polling(allowed_updates=allowed_updates)
+    finally:
+        store.close()
+        stories.close()
 
 if __name__ == '__main__':
     main()
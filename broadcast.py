@@ -0,0 +1,368 @@
+"""
+Движок рассылок
+
+Рассылка - это задание (job) со списком получателей. Сообщения уходят
+параллельно несколькими воркерами под общим token bucket (~30 сообщений
+в секунду - лимит Telegram) и с ограничением частоты на один чат.
+RetryAfter приостанавливает всю рассылку на указанное время, сетевые
+ошибки повторяются с экспоненциальной задержкой.
+
+Задание хранится в каталоге BROADCAST_DIR:
+    <id>.json - параметры и список получателей
+    <id>.done - журнал доставки, строка "<индекс получателя> <результат>"
+После перезапуска бота незавершённые задания продолжаются с места остановки.
+
+Фото, переданное байтами, загружается один раз (первому получателю),
+дальше рассылка идёт по file_id из общего MediaCache.
+
+Результаты доставки записываются в DeliveryStatus (если передан): кто
+заблокировал бота или удалил аккаунт, в следующие рассылки не попадает.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from media import content_hash
+
+logger = logging.getLogger(__name__)
+
+# Результаты доставки
+SENT = 's'
+BLOCKED = 'b'
+DEACTIVATED = 'd'
+FAILED = 'f'
+
+
+class TokenBucket:
+    """Глобальный лимит частоты запросов"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Пауза для всех отправителей (после RetryAfter)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket в общей SQLite-базе: один лимит Telegram на все процессы-воркеры"""
+
+    def __init__(self, store, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self.store = store
+        self._pauses = set()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                wait = await self.store.take_token(self.rate, self.capacity)
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        super().pause(seconds)
+        task = asyncio.get_running_loop().create_task(self._pause_shared(seconds))
+        self._pauses.add(task)
+        task.add_done_callback(self._pauses.discard)
+
+    async def _pause_shared(self, seconds):
+        try:
+            await self.store.pause_tokens(seconds)
+        except Exception as e:
+            logger.error(f"Shared rate limit pause failed: {e}")
+
+
+class ChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат"""
+
+    def __init__(self, interval=1.0, max_entries=10000):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._next = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        ready_at = self._next.get(chat_id, 0.0)
+        self._next[chat_id] = max(ready_at, now) + self.interval
+        if len(self._next) > self.max_entries:
+            self._next = {k: t for k, t in self._next.items() if t > now}
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+
+def _retry_delay(error):
+    """retry_after в секундах (в новых версиях PTB это timedelta)"""
+    delay = error.retry_after
+    if hasattr(delay, 'total_seconds'):
+        delay = delay.total_seconds()
+    return float(delay)
+
+
+class BroadcastEngine:
+    """Запуск, продолжение и учёт рассылок"""
+
+    def __init__(self, directory, media, rate=30, concurrency=20, chat_interval=1.0,
+                 max_retries=3, progress_interval=3.0, status=None, bucket=None):
+        self.directory = directory
+        self.media = media
+        self.status = status
+        self.bucket = bucket or TokenBucket(rate)
+        self.chats = ChatLimiter(chat_interval)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+        self.delivered = {SENT: 0, BLOCKED: 0, DEACTIVATED: 0, FAILED: 0}  # за всё время работы, для метрик
+        self.progress = {}  # id задания -> (счётчики, всего получателей)
+        self._tasks = set()
+
+    # ===== Задания =====
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.directory, f"{job_id}.{ext}")
+
+    def submit(self, bot, recipients, text, photo=None, parse_mode=None,
+               status_chat_id=None, status_message_id=None):
+        """Создание задания и запуск в фоне. Возвращает id задания"""
+        if isinstance(photo, bytes):
+            photo = self.media.get(content_hash(photo)) or photo
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'recipients': [str(r) for r in recipients],
+            'text': text,
+            'photo': photo,
+            'parse_mode': parse_mode,
+            'status_chat_id': status_chat_id,
+            'status_message_id': status_message_id,
+            'created': time.time(),
+        }
+        # Фото байтами сохраним после загрузки, когда появится file_id
+        if not isinstance(photo, bytes):
+            self._persist(job)
+        self._spawn(bot, job)
+        return job['id']
+
+    def _persist(self, job):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._path(job['id'], 'tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(job['id'], 'json'))
+        job['persisted'] = True
+
+    def resume(self, bot):
+        """Продолжение незавершённых заданий после перезапуска"""
+        if not os.path.isdir(self.directory):
+            return 0
+        resumed = 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Broken broadcast job {name}: {e}")
+                continue
+            job['persisted'] = True
+            self._spawn(bot, job)
+            resumed += 1
+        if resumed:
+            logger.info(f"Resumed {resumed} broadcast jobs")
+        return resumed
+
+    def _spawn(self, bot, job):
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _load_done(self, job):
+        """Уже обработанные получатели из журнала доставки"""
+        done = {}
+        try:
+            with open(self._path(job['id'], 'done'), 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        done[int(parts[0])] = parts[1]
+        except FileNotFoundError:
+            pass
+        return done
+
+    # ===== Выполнение =====
+
+    async def _run(self, bot, job):
+        done = self._load_done(job) if job.get('persisted') else {}
+        counts = {SENT: 0, BLOCKED: 0, DEACTIVATED: 0, FAILED: 0}
+        for code in done.values():
+            counts[code] = counts.get(code, 0) + 1
+        total = len(job['recipients'])
+        pending = [i for i in range(total) if i not in done]
+        self.progress[job['id']] = (counts, total)
+
+        # Фото байтами: отправляем по одному, пока загрузка не даст file_id
+        uploaded = []
+        while pending and isinstance(job['photo'], bytes):
+            index = pending.pop(0)
+            code = await self._deliver(bot, job, job['recipients'][index])
+            self._count(counts, job['recipients'][index], code)
+            uploaded.append((index, code))
+        if not job.get('persisted') and not isinstance(job['photo'], bytes):
+            self._persist(job)
+
+        persisted = job.get('persisted')
+        log = open(self._path(job['id'], 'done'), 'a', encoding='utf-8') if persisted else None
+        if log:
+            log.writelines(f"{index} {code}\n" for index, code in uploaded)
+            log.flush()
+        pending = iter(pending)
+
+        async def worker():
+            for index in pending:
+                code = await self._deliver(bot, job, job['recipients'][index])
+                self._count(counts, job['recipients'][index], code)
+                if log:
+                    log.write(f"{index} {code}\n")
+                    log.flush()
+
+        finished = asyncio.Event()
+
+        async def reporter():
+            reported = None
+            while not finished.is_set():
+                try:
+                    await asyncio.wait_for(finished.wait(), self.progress_interval)
+                except asyncio.TimeoutError:
+                    pass
+                progress = sum(counts.values())
+                if progress != reported and not finished.is_set():
+                    reported = progress
+                    await self._status(bot, job, f"⏳ Отправлено: {progress}/{total}...")
+
+        reporter_task = asyncio.create_task(reporter())
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.concurrency, total) or 1)))
+        finally:
+            finished.set()
+            await reporter_task
+            self.progress.pop(job['id'], None)
+            if log:
+                log.close()
+            if self.status:
+                await self.status.flush()
+
+        logger.info(f"Broadcast {job['id']} finished: {counts}")
+        await self._status(
+            bot, job,
+            f"✅ Рассылка завершена!\n\n"
+            f"📨 Отправлено: {counts[SENT]}\n"
+            f"🚫 Заблокировали: {counts[BLOCKED]}\n"
+            f"👻 Удалили аккаунт: {counts[DEACTIVATED]}\n"
+            f"❌ Ошибок: {counts[FAILED]}"
+        )
+        if persisted:
+            for ext in ('json', 'done'):
+                try:
+                    os.remove(self._path(job['id'], ext))
+                except FileNotFoundError:
+                    pass
+
+    def _count(self, counts, chat_id, code):
+        counts[code] += 1
+        self.delivered[code] += 1
+        if self.status and code != FAILED:
+            self.status.record(chat_id, sent=code == SENT, blocked=code == BLOCKED,
+                               deactivated=code == DEACTIVATED)
+
+    async def _deliver(self, bot, job, chat_id):
+        """Отправка одному получателю с повторами"""
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            await self.chats.wait(chat_id)
+            try:
+                if isinstance(job['photo'], bytes):
+                    job['photo'] = await self.media.send_photo(
+                        bot,
+                        int(chat_id),
+                        job['photo'],
+                        caption=job['text'],
+                        parse_mode=job['parse_mode']
+                    )
+                elif job['photo']:
+                    await bot.send_photo(
+                        chat_id=int(chat_id),
+                        photo=job['photo'],
+                        caption=job['text'],
+                        parse_mode=job['parse_mode']
+                    )
+                else:
+                    await bot.send_message(
+                        chat_id=int(chat_id),
+                        text=job['text'],
+                        parse_mode=job['parse_mode']
+                    )
+                return SENT
+            except RetryAfter as e:
+                # Лимит превышен - притормаживаем всю рассылку, попытку не считаем
+                self.bucket.pause(_retry_delay(e))
+            except Forbidden as e:
+                return DEACTIVATED if 'deactivated' in str(e).lower() else BLOCKED
+            except BadRequest as e:
+                error_str = str(e).lower()
+                if 'deactivated' in error_str:
+                    return DEACTIVATED
+                if 'blocked' in error_str:
+                    return BLOCKED
+                logger.error(f"Failed to send to {chat_id}: {e}")
+                return FAILED
+            except NetworkError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"Failed to send to {chat_id}: {e}")
+                    return FAILED
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.error(f"Failed to send to {chat_id}: {e}")
+                return FAILED
+
+    async def _status(self, bot, job, text):
+        """Обновление сообщения со статусом рассылки"""
+        if not job.get('status_message_id'):
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=job['status_chat_id'],
+                message_id=job['status_message_id'],
+                text=text
+            )
+        except Exception:
+            pass
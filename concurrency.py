@@ -0,0 +1,146 @@
+"""
+Параллельная обработка апдейтов
+
+Бот обрабатывает апдейты параллельно (concurrent_updates), поэтому:
+- апдейты из одного чата выполняются строго по очереди (ChatOrderedUpdateProcessor),
+  а очередь одного чата ограничена, чтобы флудящий чат не занял все слоты
+  параллельной обработки своими ожидающими апдейтами;
+- участки "прочитать - изменить - записать" защищены блокировкой по ключу
+  записи (KeyedLocks): пользователю, группе и т.п.; если базу пишут
+  несколько процессов - ещё и между процессами (ProcessKeyedLocks).
+"""
+
+import os
+import zlib
+import fcntl
+import asyncio
+import logging
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLocks:
+    """Таблица асинхронных блокировок, разбитая на шарды по хэшу ключа.
+
+    Память не растёт с числом ключей; разные ключи изредка делят шард,
+    поэтому две блокировки из одной таблицы нельзя брать вложенно.
+    """
+
+    def __init__(self, shards=1024):
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    def __call__(self, *key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class _ProcessLock:
+    """Шард ProcessKeyedLocks: asyncio.Lock в процессе + fcntl-блокировка байта файла"""
+
+    MIN_DELAY = 0.001  # секунд между попытками, удваивается до MAX_DELAY
+    MAX_DELAY = 0.05
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+        self.local = asyncio.Lock()
+
+    def _unlock(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+
+    async def __aenter__(self):
+        # Внутри процесса шард ждут на asyncio.Lock, между процессами - опросом
+        # fcntl без блокировки: поток, ждущий в lockf, нельзя отменить, а
+        # fcntl-блокировки общие на процесс - отменённое ожидание в потоке
+        # взяло бы байт за спиной следующего владельца шарда
+        await self.local.acquire()
+        try:
+            delay = self.MIN_DELAY
+            while True:
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.offset)
+                    return self
+                except (BlockingIOError, PermissionError):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.MAX_DELAY)
+        except BaseException:
+            self.local.release()
+            raise
+
+    async def __aexit__(self, *exc):
+        self._unlock()
+        self.local.release()
+
+
+class ProcessKeyedLocks:
+    """KeyedLocks для нескольких процессов над одной базой.
+
+    Шард выбирается стабильным хэшем ключа (crc32, а не hash() - он
+    разный в разных процессах) и блокируется байтом общего файла через
+    fcntl.lockf. Занятая другим процессом блокировка ожидается опросом
+    с нарастающей паузой - без потоков, отмена ожидания ничего не держит.
+    """
+
+    def __init__(self, path, shards=1024):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._locks = [_ProcessLock(self._fd, i) for i in range(shards)]
+
+    def __call__(self, *key):
+        return self._locks[zlib.crc32('\0'.join(map(str, key)).encode()) % len(self._locks)]
+
+
+def update_chat_key(update):
+    """Ключ очереди апдейта: чат, а если его нет (inline) - пользователь"""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, 'effective_user', None)
+    return user.id if user is not None else None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка с сохранением порядка внутри чата.
+
+    asyncio.Lock отдаёт блокировку в порядке ожидания, а задачи апдейтов
+    создаются в порядке поступления - поэтому апдейты одного чата
+    выполняются в том же порядке, в каком пришли.
+
+    Ожидающий своей очереди апдейт держит слот из max_concurrent_updates,
+    поэтому апдейты сверх max_pending_per_chat в очереди одного чата
+    отбрасываются, не дожидаясь её (None - без ограничения).
+    """
+
+    def __init__(self, max_concurrent_updates=256, shards=4096, max_pending_per_chat=16):
+        super().__init__(max_concurrent_updates)
+        self.chat_locks = KeyedLocks(shards)
+        self.max_pending_per_chat = max_pending_per_chat
+        self.pending = {}  # чат -> апдейтов в очереди и в обработке
+        self.dropped = 0
+
+    async def do_process_update(self, update, coroutine):
+        key = update_chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        pending = self.pending.get(key, 0)
+        if self.max_pending_per_chat and pending >= self.max_pending_per_chat:
+            coroutine.close()
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Chat {key} flooding: {self.dropped} updates dropped so far")
+            return
+        self.pending[key] = pending + 1
+        try:
+            async with self.chat_locks(key):
+                await coroutine
+        finally:
+            if self.pending[key] == 1:
+                del self.pending[key]
+            else:
+                self.pending[key] -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,211 @@
+"""
+Статус доставки рассылок
+
+DeliveryStatus помнит, кто заблокировал бота или удалил аккаунт и когда
+пользователю последний раз что-то было доставлено. Каждому пользователю
+при первой записи выдаётся плотный номер, по номеру лежат байт флагов
+(bytearray) и время доставки (array('q')), поэтому на миллион
+пользователей уходит ~17 МБ. Недоступные чаты дополнительно лежат в
+множестве - фильтр получателей стоит один поиск на получателя.
+
+Файл статуса - бинарный снимок (заголовок, id, флаги, время) с атомарной
+заменой; пишется в отдельном потоке после рассылки и при остановке.
+Блокировка снимается, когда пользователь снова нажимает /start.
+
+С несколькими процессами (store=SqliteStore) статус общий: изменения
+копятся в _pending и пачкой уходят в таблицу delivery_status, чужие
+приходят событиями 'delivery' из ленты изменений (on_change).
+"""
+
+import os
+import sys
+import time
+import struct
+import asyncio
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+BLOCKED = 1
+DEACTIVATED = 2
+DEAD = BLOCKED | DEACTIVATED
+
+_HEADER = struct.Struct('<4sQ')
+_MAGIC = b'GDS1'
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class DeliveryStatus:
+    """Флаги и время последней доставки по плотному номеру пользователя"""
+
+    def __init__(self, path=None, store=None):
+        self.path = path
+        self.store = store
+        self._pending = set()  # id, ещё не записанные в store
+        self.ids = array('q')  # номер -> id пользователя
+        self.index = {}  # id пользователя (строка) -> номер
+        self.flags = bytearray()
+        self.delivered = array('q')  # unix-время последней доставки, 0 - не было
+        self.dead = set()  # id с флагом BLOCKED или DEACTIVATED
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                magic, count = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != _MAGIC:
+                    raise ValueError("bad header")
+                ids, delivered = array('q'), array('q')
+                ids.fromfile(f, count)
+                flags = bytearray(f.read(count))
+                delivered.fromfile(f, count)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, EOFError, struct.error) as e:
+            logger.error(f"Delivery status load failed: {e}")
+            return
+        self.ids, self.flags, self.delivered = _little_endian(ids), flags, _little_endian(delivered)
+        self.index = {str(user_id): i for i, user_id in enumerate(self.ids)}
+        self.dead = {str(self.ids[i]) for i, f in enumerate(flags) if f & DEAD}
+
+    def _slot(self, user_id):
+        user_id = str(user_id)
+        i = self.index.get(user_id)
+        if i is None:
+            i = self.index[user_id] = len(self.ids)
+            self.ids.append(int(user_id))
+            self.flags.append(0)
+            self.delivered.append(0)
+        return i
+
+    def record(self, user_id, sent=False, blocked=False, deactivated=False):
+        """Результат доставки одному пользователю"""
+        user_id = str(user_id)
+        i = self._slot(user_id)
+        if sent:
+            self.delivered[i] = int(time.time())
+            self.flags[i] = 0
+            self.dead.discard(user_id)
+        if blocked or deactivated:
+            self.flags[i] |= (BLOCKED if blocked else 0) | (DEACTIVATED if deactivated else 0)
+            self.dead.add(user_id)
+        self._changed(user_id)
+
+    def seen(self, user_id):
+        """Пользователь написал боту - значит, чат снова доступен"""
+        user_id = str(user_id)
+        if user_id in self.dead:
+            self.flags[self.index[user_id]] = 0
+            self.dead.discard(user_id)
+            self._changed(user_id)
+
+    def _changed(self, user_id):
+        self.dirty = True
+        if self.store is not None:
+            self._pending.add(user_id)
+
+    def _apply(self, user_id, flags, delivered):
+        i = self._slot(user_id)
+        self.flags[i] = flags
+        self.delivered[i] = delivered
+        if flags & DEAD:
+            self.dead.add(user_id)
+        else:
+            self.dead.discard(user_id)
+
+    def on_change(self, table, key, old, new):
+        """Статус, записанный другим процессом (своё незаписанное важнее)"""
+        if table != 'delivery' or key in self._pending:
+            return
+        self._apply(key, new['flags'], new['delivered'])
+
+    async def build(self, store):
+        async for user_id, flags, delivered in store.scan_delivery():
+            if user_id not in self._pending:
+                self._apply(user_id, flags, delivered)
+
+    def is_dead(self, user_id):
+        return str(user_id) in self.dead
+
+    def last_delivered(self, user_id):
+        i = self.index.get(str(user_id))
+        return self.delivered[i] if i is not None and self.delivered[i] else None
+
+    def reachable(self, user_ids):
+        """Получатели (строки id) без заблокировавших и удалённых - O(len(user_ids))"""
+        dead = self.dead
+        if not dead:
+            return list(user_ids)
+        return [user_id for user_id in user_ids if user_id not in dead]
+
+    def counts(self):
+        both = self.flags.count(BLOCKED | DEACTIVATED)
+        return {
+            'blocked': self.flags.count(BLOCKED) + both,
+            'deactivated': self.flags.count(DEACTIVATED) + both,
+        }
+
+    def _dump(self):
+        return b''.join((
+            _HEADER.pack(_MAGIC, len(self.ids)),
+            _little_endian(self.ids).tobytes(),
+            bytes(self.flags),
+            _little_endian(self.delivered).tobytes(),
+        ))
+
+    def _write(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def save(self):
+        if self.path and self.dirty:
+            self.dirty = False
+            self._write(self._dump())
+
+    async def flush(self):
+        """save() без блокировки event loop: снимок здесь, запись в потоке"""
+        if self.store is not None:
+            await self._flush_store()
+            return
+        if not self.path or not self.dirty:
+            return
+        self.dirty = False
+        try:
+            await asyncio.to_thread(self._write, self._dump())
+        except OSError as e:
+            self.dirty = True
+            logger.error(f"Delivery status save failed: {e}")
+
+    async def _flush_store(self):
+        if not self._pending:
+            return
+        user_ids, self._pending = self._pending, set()
+        self.dirty = False
+        items = []
+        for user_id in user_ids:
+            i = self.index[user_id]
+            items.append((user_id, self.flags[i], self.delivered[i]))
+        try:
+            await self.store.put_delivery(items)
+        except Exception as e:
+            self._pending |= user_ids
+            self.dirty = True
+            logger.error(f"Delivery status save failed: {e}")
+
+    async def run(self, interval=1.0):
+        """Фоновая задача режима store: периодическая запись изменений"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
@@ -0,0 +1,136 @@
+"""
+Ограничение частоты запросов пользователя
+
+Один клиент может завалить бота: /start читает и пишет хранилище,
+web_app_data запускает рассылку, жеребьёвку или декодирование мегабайтной
+картинки. FloodControl - middleware в группе обработчиков -1, до всех
+остальных:
+- общий token bucket пользователя - каждый апдейт стоит 1 токен;
+- отдельный bucket на каждое дорогое действие пользователя - действие
+  стоит costs[действие] токенов (дорогое действие не съедает лимит
+  обычных сообщений, а спам сообщениями не мешает ему);
+- отказ - ApplicationHandlerStop без обращения к хранилищу, сообщение
+  "слишком часто" - не больше одного, пока лимит не восстановится.
+
+Состояние - OrderedDict в порядке последнего обращения не больше max_users
+пользователей, вытесняются давно молчавшие. Их bucket'ы к этому времени
+уже полные, поэтому вытеснение ничего не меняет.
+"""
+
+import re
+import math
+import time
+import logging
+from collections import OrderedDict
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+# action из JSON web_app_data без разбора всего JSON (там может быть картинка)
+_WEB_APP_ACTION = re.compile(r'"action"\s*:\s*"(\w{1,64})"')
+
+# Поля состояния пользователя: [токены, время, предупреждён до, {действие: [токены, время]}]
+TOKENS, UPDATED, WARNED_UNTIL, ACTIONS = range(4)
+
+
+def update_action(update):
+    """Действие апдейта: команда, action из WebApp или тип апдейта"""
+    message = update.message
+    if message is not None:
+        if message.web_app_data is not None:
+            match = _WEB_APP_ACTION.search(message.web_app_data.data)
+            return match.group(1) if match else 'web_app_data'
+        text = message.text
+        if text and text[0] == '/' and len(text) > 1:
+            return text[1:].split(maxsplit=1)[0].partition('@')[0]
+        return 'message'
+    if update.callback_query is not None:
+        return 'callback_query'
+    if update.inline_query is not None:
+        return 'inline_query'
+    return 'other'
+
+
+class FloodControl:
+    """Token bucket'ы на пользователя и на (пользователь, дорогое действие)"""
+
+    def __init__(self, rate=1.0, burst=20, costs=None, max_users=50000, exempt=()):
+        self.rate = rate
+        self.burst = burst
+        # Дороже burst действие никогда бы не прошло
+        self.costs = {action: min(cost, burst) for action, cost in (costs or {}).items()}
+        self.max_users = max_users
+        self.exempt = frozenset(exempt)
+        self.rejected = {}  # действие -> отказов
+        self._users = OrderedDict()  # user_id -> состояние
+
+    def _refill(self, tokens, updated, now):
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def acquire(self, user_id, action, now=None):
+        """0, если апдейт можно обрабатывать, иначе - сколько секунд ждать"""
+        now = time.monotonic() if now is None else now
+        state = self._users.get(user_id)
+        if state is None:
+            state = [self.burst, now, 0.0, None]
+            self._users[user_id] = state
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+
+        tokens = state[TOKENS] = self._refill(state[TOKENS], state[UPDATED], now)
+        state[UPDATED] = now
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+
+        cost = self.costs.get(action)
+        if cost is not None:
+            actions = state[ACTIONS]
+            if actions is None:
+                actions = state[ACTIONS] = {}
+            bucket = actions.get(action)
+            action_tokens = self._refill(bucket[0], bucket[1], now) if bucket else self.burst
+            if action_tokens < cost:
+                actions[action] = [action_tokens, now]
+                return (cost - action_tokens) / self.rate
+            actions[action] = [action_tokens - cost, now]
+
+        state[TOKENS] = tokens - 1
+        return 0
+
+    def should_warn(self, user_id, wait, now=None):
+        """Предупреждать ли об отказе: один раз, пока лимит не восстановится"""
+        now = time.monotonic() if now is None else now
+        state = self._users.get(user_id)
+        if state is None or state[WARNED_UNTIL] > now:
+            return False
+        state[WARNED_UNTIL] = now + wait
+        return True
+
+    async def check(self, update, context):
+        """Middleware (TypeHandler, группа -1): лишние апдейты дальше не идут"""
+        user = update.effective_user
+        if user is None or user.id in self.exempt:
+            return
+        action = update_action(update)
+        wait = self.acquire(user.id, action)
+        if not wait:
+            return
+
+        label = action if action in self.costs else 'other'
+        self.rejected[label] = self.rejected.get(label, 0) + 1
+        if self.should_warn(user.id, wait):
+            logger.warning(f"Flood control: user {user.id} throttled on {action} for {wait:.1f}s")
+            text = f"⏳ Слишком много запросов, попробуй через {math.ceil(wait)} с"
+            try:
+                if update.callback_query is not None:
+                    await update.callback_query.answer(text)
+                elif update.effective_message is not None:
+                    await update.effective_message.reply_text(text)
+            except Exception as e:
+                logger.error(f"Flood control warning to {user.id} failed: {e}")
+        raise ApplicationHandlerStop
+
+    def tracked(self):
+        return len(self._users)
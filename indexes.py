@@ -0,0 +1,485 @@
+"""
+Индексы и счётчики поверх хранилища
+
+Все структуры строятся один раз при старте и дальше обновляются
+инкрементально по событиям изменения из Storage.subscribe(), поэтому
+чтение не зависит от размера базы.
+"""
+
+import heapq
+import bisect
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _join_day(user):
+    """Дата регистрации (YYYY-MM-DD) из поля joined"""
+    joined = user.get('joined') if user else None
+    return str(joined)[:10] if joined else None
+
+
+class Stats:
+    """Счётчики для админ-панели, чтение за O(1)"""
+
+    FIELDS = ('users', 'wishes', 'reserved', 'groups', 'shuffled', 'referrals', 'referrals_pending')
+
+    def __init__(self):
+        self.counters = {field: 0 for field in self.FIELDS}
+        self.joins = {}
+
+    def load(self, counts):
+        """Установка значений из Storage.counts()"""
+        self.counters = {field: counts.get(field, 0) for field in self.FIELDS}
+        self.joins = dict(counts.get('joins', {}))
+
+    def snapshot(self):
+        return dict(self.counters, joins=dict(self.joins))
+
+    def on_change(self, table, key, old, new):
+        c = self.counters
+        if table == 'users':
+            c['users'] += (new is not None) - (old is not None)
+            for record, sign in ((old, -1), (new, 1)):
+                if record is None:
+                    continue
+                wishes = record.get('wishes', [])
+                c['wishes'] += sign * len(wishes)
+                c['reserved'] += sign * sum(1 for w in wishes if w.get('reserved'))
+                day = _join_day(record)
+                if day:
+                    self.joins[day] = self.joins.get(day, 0) + sign
+                    if not self.joins[day]:
+                        del self.joins[day]
+        elif table == 'groups':
+            c['groups'] += (new is not None) - (old is not None)
+            c['shuffled'] += bool(new and new.get('shuffled')) - bool(old and old.get('shuffled'))
+        elif table == 'referrals':
+            c['referrals'] += (new is not None) - (old is not None)
+            c['referrals_pending'] += (
+                bool(new is not None and not new.get('rewarded'))
+                - bool(old is not None and not old.get('rewarded'))
+            )
+
+    def drift(self, counts):
+        """Расхождения с пересчитанными значениями: {поле: (счётчик, факт)}"""
+        drift = {}
+        for field in self.FIELDS:
+            if self.counters[field] != counts.get(field, 0):
+                drift[field] = (self.counters[field], counts.get(field, 0))
+        fresh_joins = counts.get('joins', {})
+        for day in set(self.joins) | set(fresh_joins):
+            if self.joins.get(day, 0) != fresh_joins.get(day, 0):
+                drift[f"joins {day}"] = (self.joins.get(day, 0), fresh_joins.get(day, 0))
+        return drift
+
+
+class SortedIndex:
+    """Отсортированный массив пар (ключ, id) с курсорной выборкой.
+
+    key_fn(запись) возвращает список ключей: для сортировки - один ключ,
+    для поиска по префиксу - по ключу на каждое поле (имя, username).
+    Вставка и удаление - бинарным поиском, страница - O(log n + размер).
+    """
+
+    def __init__(self, key_fn):
+        self.key_fn = key_fn
+        self._items = []
+        self._keys = {}  # id -> ключи записи
+
+    def __len__(self):
+        return len(self._items)
+
+    def _keys_of(self, record):
+        return tuple(dict.fromkeys(self.key_fn(record))) if record is not None else ()
+
+    def clear(self):
+        self._items = []
+        self._keys = {}
+
+    def append(self, uid, record):
+        """Начальное построение: clear(), append() для всех записей, затем sort()"""
+        keys = self._keys_of(record)
+        if keys:
+            self._keys[uid] = keys
+            self._items.extend((key, uid) for key in keys)
+
+    def sort(self):
+        self._items.sort()
+
+    def update(self, uid, record):
+        for key in self._keys.pop(uid, ()):
+            i = bisect.bisect_left(self._items, (key, uid))
+            if i < len(self._items) and self._items[i] == (key, uid):
+                del self._items[i]
+        keys = self._keys_of(record)
+        if keys:
+            self._keys[uid] = keys
+            for key in keys:
+                bisect.insort(self._items, (key, uid))
+
+    def _position(self, cursor):
+        """Позиция элемента курсора (id, номер ключа) или None"""
+        uid, k = cursor
+        keys = self._keys.get(uid)
+        if not keys or k >= len(keys):
+            return None
+        i = bisect.bisect_left(self._items, (keys[k], uid))
+        if i < len(self._items) and self._items[i] == (keys[k], uid):
+            return i
+        return None
+
+    def _cursor(self, i):
+        key, uid = self._items[i]
+        return uid, self._keys[uid].index(key)
+
+    def ids_from(self, key):
+        """id записей с ключом >= key, O(log n + результат)"""
+        return [uid for _, uid in self._items[bisect.bisect_left(self._items, (key,)):]]
+
+    def prefix_range(self, prefix):
+        """Границы [lo, hi) ключей, начинающихся с prefix"""
+        lo = bisect.bisect_left(self._items, (prefix,))
+        hi = bisect.bisect_left(self._items, (prefix + '\uffff',))
+        return lo, hi
+
+    def page(self, size, after=None, before=None, descending=False, bounds=None):
+        """Страница: (список курсоров, есть ли предыдущая, есть ли следующая).
+
+        after/before - курсор последнего/первого элемента соседней страницы.
+        """
+        lo, hi = bounds if bounds else (0, len(self._items))
+        count = hi - lo
+
+        def view(i):
+            # Позиция в порядке просмотра (для убывания массив читается с конца)
+            return hi - 1 - i if descending else i - lo
+
+        def real(v):
+            return hi - 1 - v if descending else lo + v
+
+        start = 0
+        for cursor, shift in ((after, 1), (before, -size)):
+            if cursor is None:
+                continue
+            i = self._position(cursor)
+            if i is not None and lo <= i < hi:
+                start = max(0, view(i) + shift)
+        stop = min(count, start + size)
+        cursors = [self._cursor(real(v)) for v in range(start, stop)]
+        return cursors, start > 0, stop < count
+
+
+def _name_key(record):
+    return [(record.get('name') or '').casefold()]
+
+
+def _search_keys(record):
+    keys = [(record.get('name') or '').casefold()]
+    if record.get('username'):
+        keys.append(record['username'].casefold())
+    return keys
+
+
+class UserBrowser:
+    """Индексы для просмотра пользователей в админке"""
+
+    SORTS = {
+        'j': ('📅 Дата', lambda r: [str(r.get('joined') or '')], True),
+        'w': ('🎁 Желания', lambda r: [len(r.get('wishes', []))], True),
+        'n': ('🔤 Имя', _name_key, False),
+    }
+
+    def __init__(self):
+        self.indexes = {sort: SortedIndex(key_fn) for sort, (_, key_fn, _) in self.SORTS.items()}
+        self.search = SortedIndex(_search_keys)
+
+    async def build(self, store):
+        indexes = (*self.indexes.values(), self.search)
+        for index in indexes:
+            index.clear()
+        async for uid, record in store.scan_users():
+            for index in indexes:
+                index.append(uid, record)
+        # Одна сортировка вместо n вставок
+        for index in indexes:
+            index.sort()
+
+    def on_change(self, table, key, old, new):
+        if table != 'users':
+            return
+        for index in (*self.indexes.values(), self.search):
+            index.update(key, new)
+
+    def page(self, sort, size, after=None, before=None):
+        _, _, descending = self.SORTS[sort]
+        return self.indexes[sort].page(size, after, before, descending)
+
+    def find(self, prefix, size, after=None, before=None):
+        bounds = self.search.prefix_range(prefix.casefold().lstrip('@'))
+        return self.search.page(size, after, before, bounds=bounds)
+
+
+class Segments:
+    """Аудитории рассылок, обновляются при каждой записи.
+
+    all - все пользователи, wishes - с непустым вишлистом, santa -
+    участники групп Тайного Санты. "Зарегистрированные с даты" берутся
+    из индекса даты UserBrowser бинарным поиском.
+    """
+
+    NAMES = ('all', 'wishes', 'santa')
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.sets = {name: set() for name in self.NAMES}
+        self._groups = {}  # участник -> число его групп
+
+    def clear(self):
+        self.sets = {name: set() for name in self.NAMES}
+        self._groups = {}
+
+    async def build(self, store):
+        self.clear()
+        async for uid, record in store.scan_users():
+            self.on_change('users', uid, None, record)
+        async for group_id, record in store.scan_groups():
+            self.on_change('groups', group_id, None, record)
+
+    def _join(self, participants, delta):
+        for uid in participants:
+            count = self._groups.get(uid, 0) + delta
+            if count > 0:
+                self._groups[uid] = count
+                self.sets['santa'].add(uid)
+            else:
+                self._groups.pop(uid, None)
+                self.sets['santa'].discard(uid)
+
+    def on_change(self, table, key, old, new):
+        if table == 'users':
+            for name, member in (('all', new is not None), ('wishes', bool(new and new.get('wishes')))):
+                if member:
+                    self.sets[name].add(key)
+                else:
+                    self.sets[name].discard(key)
+        elif table == 'groups':
+            # Повторы в списке участников не считаем дважды
+            self._join(set((old or {}).get('participants', ())), -1)
+            self._join(set((new or {}).get('participants', ())), 1)
+
+    def get(self, name):
+        return self.sets[name]
+
+    def joined_since(self, day):
+        """id пользователей, зарегистрированных начиная с day (YYYY-MM-DD)"""
+        return self.browser.indexes['j'].ids_from(day)
+
+
+class ReferralGraph:
+    """Граф приглашений: кто кого пригласил, счётчики и топ пригласивших.
+
+    Топ - куча (-число приглашённых, id) с ленивым удалением: при каждом
+    изменении в кучу кладётся новая пара, устаревшие отбрасываются при
+    чтении, а когда их накапливается много, куча пересобирается.
+    """
+
+    def __init__(self):
+        self.referees = {}  # пригласивший -> множество приглашённых
+        self.pending = {}  # приглашённый -> пригласивший, награда не выдана
+        self._heap = []
+
+    def clear(self):
+        self.referees = {}
+        self.pending = {}
+        self._heap = []
+
+    async def build(self, store):
+        self.clear()
+        async for referred, record in store.scan_referrals():
+            self.on_change('referrals', referred, None, record)
+
+    def on_change(self, table, key, old, new):
+        if table != 'referrals':
+            return
+        if old is not None:
+            referees = self.referees.get(old['referrer'])
+            if referees is not None:
+                referees.discard(key)
+                if not referees:
+                    del self.referees[old['referrer']]
+                self._push(old['referrer'])
+            self.pending.pop(key, None)
+        if new is not None:
+            self.referees.setdefault(new['referrer'], set()).add(key)
+            self._push(new['referrer'])
+            if not new.get('rewarded'):
+                self.pending[key] = new['referrer']
+
+    def count(self, referrer):
+        return len(self.referees.get(referrer, ()))
+
+    def _push(self, referrer):
+        count = self.count(referrer)
+        if count:
+            heapq.heappush(self._heap, (-count, referrer))
+        if len(self._heap) > 2 * len(self.referees) + 64:
+            self._heap = [(-len(referees), referrer) for referrer, referees in self.referees.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, k=10):
+        """k пригласивших больше всех: [(id, число приглашённых)]"""
+        result = []
+        seen = set()
+        while self._heap and len(result) < k:
+            negative, referrer = heapq.heappop(self._heap)
+            if referrer in seen or -negative != self.count(referrer):
+                continue
+            seen.add(referrer)
+            result.append((referrer, -negative))
+        for referrer, count in result:
+            heapq.heappush(self._heap, (-count, referrer))
+        return result
+
+
+class TicketCounts:
+    """Число неиспользованных билетов у каждого участника - веса розыгрыша.
+
+    Ключи - int: розыгрыш сортирует и хэширует их как массив чисел.
+    """
+
+    def __init__(self):
+        self.counts = {}
+
+    def clear(self):
+        self.counts = {}
+
+    async def build(self, store):
+        self.clear()
+        async for ticket_id, record in store.scan_tickets():
+            self.on_change('tickets', ticket_id, None, record)
+
+    def _add(self, record, delta):
+        if record is None or record.get('used_in_raffle'):
+            return
+        user_id = int(record['user_id'])
+        count = self.counts.get(user_id, 0) + delta
+        if count > 0:
+            self.counts[user_id] = count
+        else:
+            self.counts.pop(user_id, None)
+
+    def on_change(self, table, key, old, new):
+        if table != 'tickets':
+            return
+        self._add(old, -1)
+        self._add(new, 1)
+
+
+class WishIndex:
+    """Индекс желаний: (владелец, id желания) -> позиция в вишлисте.
+
+    id желаний задаёт клиент, поэтому уникален он только у владельца.
+    Плюс куча сроков резервов (срок, владелец, id желания) для снятия
+    просроченных. Куча не чистится при снятии резерва - проверку делает
+    тот, кто забирает истёкшие желания (Reservations.sweep).
+    """
+
+    def __init__(self):
+        self.positions = {}
+        self._expiry = []
+
+    def clear(self):
+        self.positions = {}
+        self._expiry = []
+
+    async def build(self, store):
+        self.clear()
+        async for uid, record in store.scan_users():
+            self.on_change('users', uid, None, record)
+
+    def on_change(self, table, key, old, new):
+        if table != 'users':
+            return
+        old_wishes = old.get('wishes', []) if old else []
+        for wish in old_wishes:
+            self.positions.pop((key, str(wish.get('id'))), None)
+        # В кучу - только новые сроки, иначе каждое сохранение вишлиста плодит дубли
+        known = {(str(w.get('id')), w.get('reserved_until')) for w in old_wishes}
+        for position, wish in enumerate(new.get('wishes', []) if new else []):
+            wish_id = str(wish.get('id'))
+            self.positions[(key, wish_id)] = position
+            until = wish.get('reserved_until')
+            if wish.get('reserved') and until and (wish_id, until) not in known:
+                heapq.heappush(self._expiry, (until, key, wish_id))
+
+    def locate(self, owner_id, wish_id):
+        """Позиция желания в вишлисте владельца или None за O(1)"""
+        return self.positions.get((str(owner_id), str(wish_id)))
+
+    def expired(self, now):
+        """(владелец, id желания), срок резерва которых (по данным кучи) истёк"""
+        due = []
+        while self._expiry and self._expiry[0][0] <= now:
+            _, owner_id, wish_id = heapq.heappop(self._expiry)
+            due.append((owner_id, wish_id))
+        return due
+
+
+class WishPreviews:
+    """Подготовленные превью желаний для inline-режима.
+
+    Превью пользователя строится при первом inline-запросе и живёт, пока
+    его вишлист не изменится (save_wishes, reserve_wish - событие записи
+    в users). Размер кэша ограничен, вытесняются давно не запрашиваемые.
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._cache = OrderedDict()
+        self._writes = 0
+
+    def on_change(self, table, key, old, new):
+        if table == 'users':
+            self._writes += 1
+            self._cache.pop(key, None)
+
+    async def get(self, store, user_id):
+        previews = self._cache.get(user_id)
+        if previews is not None:
+            self._cache.move_to_end(user_id)
+            return previews
+        writes = self._writes
+        user = await store.get_user(user_id)
+        previews = self._build(user.get('wishes', []) if user else [])
+        if writes != self._writes:
+            # Пока читали, кто-то записал - такое превью не кэшируем
+            return previews
+        self._cache[user_id] = previews
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+        return previews
+
+    @staticmethod
+    def _build(wishes):
+        """Свободные желания первыми, порядок внутри - как в вишлисте"""
+        previews = []
+        for position, wish in enumerate(wishes):
+            name = str(wish.get('name') or 'Желание')
+            price = wish.get('price')
+            description = wish.get('description') or ''
+            if price:
+                description = f"{price} {wish.get('currency') or '₽'}" + (f" · {description}" if description else '')
+            photo = wish.get('photo')
+            previews.append({
+                'id': str(wish.get('id', position))[:50],
+                'title': ('🔒 ' if wish.get('reserved') else '🎁 ') + name,
+                'description': description[:200],
+                'url': wish.get('url') or None,
+                'thumbnail_url': photo if isinstance(photo, str) and photo.startswith('http') else None,
+                'search': f"{name} {wish.get('description') or ''}".casefold(),
+                'reserved': bool(wish.get('reserved')),
+            })
+        previews.sort(key=lambda p: p['reserved'])
+        return previews
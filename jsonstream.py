@@ -0,0 +1,100 @@
+"""
+Потоковое чтение JSON-снимка
+
+data.json - объект таблиц {"таблица": {"ключ": запись, ...}, ...}.
+JsonStream читает файл кусками и разбирает по одной записи за раз
+(JSONDecoder.raw_decode по скользящему буферу), поэтому память не зависит
+от размера файла: буфер чтения и одна запись.
+"""
+
+import re
+import json
+
+CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStream:
+    """Потоковое чтение JSON вида {"таблица": {"ключ": запись, ...}, ...}"""
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """Дочитать кусок файла, отбросив разобранное начало буфера"""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Неожиданный конец JSON")
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Ожидался '{char}' в позиции {self.position}")
+        self.pos += 1
+
+    def _value(self):
+        """Следующее значение целиком (запись таблицы или ключ)"""
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise ValueError(f"Некорректный JSON в позиции {self.position}")
+            # Число на границе буфера могло оборваться - дочитываем и разбираем заново
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _items(self):
+        """Пары ключ-значение объекта, открывающая скобка уже прочитана"""
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            yield key
+            if self._peek() == ',':
+                self.pos += 1
+                continue
+            self._expect('}')
+            return
+
+    @property
+    def position(self):
+        """Прочитано байт файла (для прогресса)"""
+        return self.f.buffer.tell() if hasattr(self.f, 'buffer') else self.f.tell()
+
+    def records(self):
+        """(таблица, ключ, запись) по одной"""
+        self._expect('{')
+        for table in self._items():
+            if self._peek() != '{':
+                # Не таблица - пропускаем значение целиком
+                self._value()
+                continue
+            self.pos += 1
+            for key in self._items():
+                yield table, key, self._value()
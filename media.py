@@ -0,0 +1,122 @@
+"""
+Кэш загруженных картинок
+
+Telegram возвращает file_id для каждого загруженного фото, и дальше это
+фото можно отправлять по file_id без повторной загрузки. Кэш хранит
+file_id по sha256 содержимого картинки, поэтому одна и та же картинка
+загружается один раз - и в рассылке, и при повторных отправках.
+"""
+
+import os
+import io
+import json
+import time
+import base64
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+def decode_data_url(data):
+    """Байты картинки из base64 (с префиксом data:image/...;base64, или без)"""
+    if ',' in data:
+        data = data.split(',', 1)[1]
+    return base64.b64decode(data)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class MediaCache:
+    """file_id по хэшу содержимого с вытеснением LRU и сроком жизни TTL"""
+
+    def __init__(self, path=None, max_entries=1024, ttl=30 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # hash -> (file_id, время загрузки)
+        self._uploads = {}  # hash -> asyncio.Lock, одна загрузка на картинку
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for digest, (file_id, stored_at) in json.load(f).items():
+                    self._entries[digest] = (file_id, stored_at)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Media cache load failed: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, digest):
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        file_id, stored_at = entry
+        if time.time() - stored_at > self.ttl:
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return file_id
+
+    def put(self, digest, file_id):
+        self._entries[digest] = (file_id, time.time())
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._save()
+
+    def invalidate(self, digest):
+        if self._entries.pop(digest, None) is not None:
+            self._save()
+
+    async def send_photo(self, bot, chat_id, photo, digest=None, **kwargs):
+        """Отправка фото с загрузкой не более одного раза.
+
+        photo - байты или async-функция, возвращающая байты: тогда картинка
+        готовится только при загрузке, а ключ кэша digest задаёт вызывающий.
+        Параллельные отправки одной картинки ждут первую загрузку и
+        используют полученный file_id. Возвращает file_id.
+        """
+        if digest is None:
+            digest = content_hash(photo)
+        file_id = self.get(digest)
+        if file_id is None:
+            lock = self._uploads.setdefault(digest, asyncio.Lock())
+            async with lock:
+                file_id = self.get(digest)
+                if file_id is None:
+                    try:
+                        data = await photo() if callable(photo) else photo
+                        message = await bot.send_photo(chat_id=chat_id, photo=io.BytesIO(data), **kwargs)
+                    finally:
+                        self._uploads.pop(digest, None)
+                    file_id = message.photo[-1].file_id
+                    self.put(digest, file_id)
+                    return file_id
+
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id мог устареть - загружаем заново
+            if 'file' not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id rejected, re-uploading: {e}")
+            self.invalidate(digest)
+            return await self.send_photo(bot, chat_id, photo, digest, **kwargs)
+        return file_id
@@ -0,0 +1,366 @@
+"""
+Метрики и профилирование
+
+Метрики собираются в Registry и отдаются в текстовом формате Prometheus
+на локальном порту (GET /metrics):
+- время обработчиков (гистограммы) и их ошибки - instrument_handlers();
+- вызовы Bot API по методам с классом результата (ok, blocked,
+  retry_after, network, error) - InstrumentedRequest оборачивает транспорт,
+  поэтому учитываются все вызовы context.bot, включая рассылки;
+- очередь апдейтов, ввод-вывод хранилища, ход рассылок - снимаются
+  в момент запроса /metrics функциями-сборщиками.
+
+Семплирующий профайлер включается и выключается через тот же порт:
+GET /profile/start, затем GET /profile/stop - стеки потока event loop
+в формате folded (для flamegraph.pl или speedscope).
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+from collections import defaultdict
+from telegram.request import BaseRequest
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = defaultdict(float)  # кортеж пар метка-значение -> значение
+
+    def inc(self, value=1, **labels):
+        self.values[tuple(labels.items())] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(dict(labels))} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values = {}  # метки -> [счётчики корзин..., сумма, количество]
+
+    def observe(self, value, **labels):
+        key = tuple(labels.items())
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, data in self.values.items():
+            labels = dict(key)
+            for bound, count in zip(self.buckets, data):
+                yield f"{self.name}_bucket{_labels(dict(labels, le=bound))} {count}"
+            yield f"{self.name}_bucket{_labels(dict(labels, le='+Inf'))} {data[-1]}"
+            yield f"{self.name}_sum{_labels(labels)} {data[-2]}"
+            yield f"{self.name}_count{_labels(labels)} {data[-1]}"
+
+
+class Registry:
+    """Набор метрик и сборщиков для /metrics"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help):
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """fn() -> [(имя, тип, описание, [(метки, значение), ...]), ...]"""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for fn in self.collectors:
+            try:
+                families = fn()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+                continue
+            for name, kind, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                lines.extend(f"{name}{_labels(labels)} {value}" for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+# ===== Инструментирование =====
+
+def _error_class(error):
+    name = type(error).__name__
+    if name == 'RetryAfter':
+        return 'retry_after'
+    if name == 'Forbidden' or 'blocked' in str(error).lower() or 'deactivated' in str(error).lower():
+        return 'blocked'
+    return 'other'
+
+
+def instrument_handlers(application, registry):
+    """Обёртка всех зарегистрированных обработчиков: время и ошибки"""
+    duration = registry.histogram('giftly_handler_duration_seconds', "Время обработки апдейта")
+    errors = registry.counter('giftly_handler_errors_total', "Ошибки обработчиков по классам")
+
+    def wrap(callback):
+        name = getattr(callback, '__name__', type(callback).__name__)
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except ApplicationHandlerStop:
+                # Остановка цепочки обработчиков (FloodControl) - не ошибка
+                raise
+            except Exception as e:
+                errors.inc(handler=name, error=_error_class(e))
+                raise
+            finally:
+                duration.observe(time.perf_counter() - started, handler=name)
+        return wrapper
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = wrap(handler.callback)
+
+
+class InstrumentedRequest(BaseRequest):
+    """Транспорт Bot API со счётчиками вызовов поверх другого транспорта"""
+
+    def __init__(self, inner, registry):
+        self.inner = inner
+        self.calls = registry.counter('giftly_telegram_calls_total', "Вызовы Bot API по методам и результату")
+        self.duration = registry.histogram('giftly_telegram_duration_seconds', "Время вызова Bot API")
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        except Exception:
+            self.calls.inc(method=api_method, result='network')
+            raise
+        finally:
+            self.duration.observe(time.perf_counter() - started, method=api_method)
+        self.calls.inc(method=api_method, result=self._result(status, payload))
+        return status, payload
+
+    @staticmethod
+    def _result(status, payload):
+        if 200 <= status < 300:
+            return 'ok'
+        if status == 429:
+            return 'retry_after'
+        if status == 403:
+            return 'blocked'
+        if status == 400 and (b'blocked' in payload or b'deactivated' in payload):
+            return 'blocked'
+        return 'error'
+
+
+# ===== Сборщики =====
+
+def application_collector(application):
+    """Очередь апдейтов и число апдейтов в обработке"""
+    def collect():
+        return [
+            ('giftly_update_queue_depth', 'gauge', "Апдейтов в очереди", [({}, application.update_queue.qsize())]),
+            ('giftly_updates_in_flight', 'gauge', "Апдейтов в обработке",
+             [({}, application.update_processor.current_concurrent_updates)]),
+            ('giftly_updates_dropped_total', 'counter', "Апдейты сверх очереди одного чата",
+             [({}, getattr(application.update_processor, 'dropped', 0))]),
+        ]
+    return collect
+
+
+def flood_collector(flood):
+    """Отказы по лимитам частоты и число отслеживаемых пользователей"""
+    def collect():
+        return [
+            ('giftly_flood_rejected_total', 'counter', "Апдейты, отклонённые лимитом частоты",
+             [({'action': action}, count) for action, count in flood.rejected.items()]),
+            ('giftly_flood_tracked_users', 'gauge', "Пользователей в таблице лимитов", [({}, flood.tracked())]),
+        ]
+    return collect
+
+
+def storage_collector(store):
+    """Время и объём загрузки, сохранения и записи хранилища"""
+    def collect():
+        io = store.io
+        return [
+            ('giftly_storage_load_seconds', 'gauge', "Время загрузки данных при старте", [({}, io['load_seconds'])]),
+            ('giftly_storage_load_bytes', 'gauge', "Объём загруженного снапшота", [({}, io['load_bytes'])]),
+            ('giftly_storage_saves_total', 'counter', "Сохранения снапшота", [({}, io['saves'])]),
+            ('giftly_storage_save_seconds_total', 'counter', "Время сохранения снапшота", [({}, io['save_seconds'])]),
+            ('giftly_storage_save_bytes_total', 'counter', "Объём сохранённых снапшотов", [({}, io['save_bytes'])]),
+            ('giftly_storage_writes_total', 'counter', "Записи в хранилище", [({}, io['writes'])]),
+            ('giftly_storage_write_bytes_total', 'counter', "Объём записей журнала", [({}, io['write_bytes'])]),
+            ('giftly_storage_write_seconds_total', 'counter', "Время транзакций записи", [({}, io['write_seconds'])]),
+            ('giftly_storage_fsyncs_total', 'counter', "fsync журнала", [({}, io['fsyncs'])]),
+            ('giftly_storage_fsync_seconds_total', 'counter', "Время fsync журнала", [({}, io['fsync_seconds'])]),
+        ]
+    return collect
+
+
+def broadcast_collector(engine):
+    """Доставленные сообщения и активные рассылки"""
+    results = {'s': 'sent', 'b': 'blocked', 'd': 'deactivated', 'f': 'failed'}
+
+    def collect():
+        pending = sum(total - sum(counts.values()) for counts, total in engine.progress.values())
+        return [
+            ('giftly_broadcast_messages_total', 'counter', "Сообщения рассылок по результату",
+             [({'result': results[code]}, count) for code, count in engine.delivered.items()]),
+            ('giftly_broadcast_active_jobs', 'gauge', "Рассылок в работе", [({}, len(engine.progress))]),
+            ('giftly_broadcast_pending_recipients', 'gauge', "Получателей в очереди рассылок", [({}, pending)]),
+        ]
+    return collect
+
+
+# ===== Профайлер =====
+
+class SamplingProfiler:
+    """Семплирование стека одного потока (по умолчанию - event loop)"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = defaultdict(int)  # "файл:функция;..." -> число попаданий
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        if self.running:
+            return
+        target = thread_id or threading.get_ident()
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(target,), name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка, результат - стеки в формате folded"""
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return '\n'.join(f"{stack} {count}" for stack, count in sorted(self.samples.items())) + '\n'
+
+    def _sample(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+
+class MetricsServer:
+    """HTTP-сервер /metrics и переключателя профайлера"""
+
+    def __init__(self, registry, profiler=None):
+        self.registry = registry
+        self.profiler = profiler or SamplingProfiler()
+        self._server = None
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Metrics server listening on {host}:{port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.profiler.running:
+            self.profiler.stop()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            method, target = head.decode('latin-1').split(' ', 2)[:2]
+            status, body = self._route(method, target)
+            data = body.encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method, target):
+        if method != 'GET':
+            return '405 Method Not Allowed', ''
+        if target == '/metrics':
+            return '200 OK', self.registry.render()
+        if target == '/profile/start':
+            # Обработчик выполняется в потоке event loop - его и семплируем
+            self.profiler.start()
+            return '200 OK', 'profiler started\n'
+        if target == '/profile/stop':
+            if not self.profiler.running:
+                return '409 Conflict', 'profiler is not running\n'
+            return '200 OK', self.profiler.stop()
+        return '404 Not Found', ''
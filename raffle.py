@@ -0,0 +1,130 @@
+"""
+Розыгрыш по билетам
+
+Каждый билет - один шанс: участник с n билетами выигрывает с
+вероятностью, пропорциональной n. Веса участников лежат в дереве Фенвика
+(массив array('q'), построение O(N)), победитель находится спуском по
+дереву за O(log N), после чего его вес обнуляется - K разных победителей
+за O(K log N).
+
+Розыгрыш проверяем: участники упорядочены по id, генератор случайных
+чисел - random.Random(seed), seed и sha256 списка участников сохраняются
+вместе с результатом. По ним тот же результат получится заново.
+"""
+
+import csv
+import sys
+import hashlib
+import secrets
+import random
+from array import array
+from itertools import accumulate
+
+
+class RaffleError(Exception):
+    """Розыгрыш провести нельзя"""
+
+
+class FenwickTree:
+    """Префиксные суммы весов с изменением веса за O(log N)"""
+
+    def __init__(self, weights):
+        n = len(weights)
+        # tree[i] - сумма весов на отрезке (i - младший бит i, i], через префиксные суммы
+        prefix = list(accumulate(weights, initial=0))
+        tree = array('q', [0])
+        tree.extend([prefix[i] - prefix[i & (i - 1)] for i in range(1, n + 1)])
+        self.tree = tree
+        self.n = n
+        self.total = prefix[-1]
+        self._top = 1 << n.bit_length() if n else 0
+
+    def add(self, index, delta):
+        """Изменение веса элемента index (с нуля)"""
+        self.total += delta
+        i = index + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, r):
+        """Элемент, в отрезок которого попадает r из [0, total)"""
+        tree = self.tree
+        position = 0
+        bit = self._top
+        while bit:
+            nxt = position + bit
+            if nxt <= self.n and tree[nxt] <= r:
+                position = nxt
+                r -= tree[nxt]
+            bit >>= 1
+        return position
+
+
+def snapshot_hash(ids, weights):
+    """sha256 списка участников для протокола розыгрыша: все id, затем все
+    числа билетов - int64 little-endian"""
+    ids, weights = array('q', ids), array('q', weights)
+    if sys.byteorder != 'little':
+        ids.byteswap()
+        weights.byteswap()
+    digest = hashlib.sha256(ids.tobytes())
+    digest.update(weights.tobytes())
+    return digest.hexdigest()
+
+
+def draw_winners(weights, winners, seed):
+    """Индексы победителей в weights, без повторов, в порядке мест"""
+    if winners < 1:
+        raise RaffleError("Нужен хотя бы 1 победитель")
+    if len(weights) < winners:
+        raise RaffleError(f"Участников с билетами меньше, чем победителей: {len(weights)}")
+    tree = FenwickTree(weights)
+    rng = random.Random(seed)
+    result = []
+    for _ in range(winners):
+        index = tree.find(rng.randrange(tree.total))
+        result.append(index)
+        # Победитель выбывает: его билеты больше не участвуют
+        tree.add(index, -weights[index])
+    return result
+
+
+def run_raffle(counts, winners, seed=None):
+    """Розыгрыш по {id участника (int): число билетов > 0}.
+
+    Возвращает протокол: seed, хэш списка участников, победители.
+    """
+    # Порядок по id - часть протокола
+    ids = array('q', sorted(counts))
+    weights = array('q', map(counts.__getitem__, ids))
+    seed = secrets.randbits(64) if seed is None else seed
+    indexes = draw_winners(weights, winners, seed)
+    return {
+        'seed': seed,
+        'participants': len(ids),
+        'total_tickets': sum(weights),
+        'snapshot_sha256': snapshot_hash(ids, weights),
+        'winners': [{'user_id': str(ids[i]), 'tickets': weights[i]} for i in indexes],
+        'ids': ids,
+        'weights': weights,
+    }
+
+
+def export_csv(path, raffle_id, result):
+    """Полный протокол в CSV построчно: участник, билеты, отрезок номеров, место"""
+    places = {int(w['user_id']): place for place, w in enumerate(result['winners'], 1)}
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(f"# raffle {raffle_id} seed {result['seed']} sha256 {result['snapshot_sha256']}\n")
+        writer = csv.writer(f)
+        writer.writerow(('user_id', 'tickets', 'first_ticket', 'last_ticket', 'place'))
+        start = 0
+        for user_id, tickets in zip(result['ids'], result['weights']):
+            writer.writerow((user_id, tickets, start, start + tickets - 1, places.get(user_id, '')))
+            start += tickets
+    return path
+
+
+def protocol(result):
+    """Протокол для хранения в записи розыгрыша (без списка участников)"""
+    return {k: v for k, v in result.items() if k not in ('ids', 'weights')}
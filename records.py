@@ -0,0 +1,221 @@
+"""
+Компактные записи пользователей в памяти
+
+JournalStore держит всех пользователей в памяти, и dict на пользователя с
+dict на каждое желание стоит больше килобайта. Здесь те же данные лежат
+плотнее:
+- пользователь - объект со __slots__, ключ таблицы - int вместо строки id;
+- joined - int секунд, если строка восстанавливается из него байт в байт;
+- желания пользователя - по колонкам: кортеж на поле вместо dict на
+  желание, одинаковые наборы полей - один общий кортеж имён;
+- короткие повторяющиеся строки (имена, валюта, id резервирующих) интернируются.
+
+Записи неизменяемы, как и раньше: запись заменяется целиком, поэтому
+снимок таблицы для компакции - поверхностная копия. Наружу (get, scan,
+события) отдаётся обычный dict той же формы, что в data.json; собранные
+dict последних прочитанных пользователей лежат в LRU-кэше, поэтому частые
+чтения одного и того же пользователя не собирают запись заново.
+"""
+
+import re
+import sys
+import time
+from datetime import datetime
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+INTERN_MAX = 32
+_UTC_TIME = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\+00:00')
+
+# Нет поля (в отличие от поля со значением null)
+MISSING = object()
+
+_layouts = {}  # набор полей желаний -> общий кортеж имён
+
+
+def _intern(value):
+    if type(value) is str and len(value) <= INTERN_MAX:
+        return sys.intern(value)
+    return value
+
+
+def pack_time(value):
+    """'2025-12-08 12:28:39+00:00' (str(message.date)) -> секунды, другие форматы - None"""
+    if type(value) is not str or not _UTC_TIME.fullmatch(value):
+        return None
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return None
+
+
+def unpack_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S+00:00', time.gmtime(seconds))
+
+
+class Wishes:
+    """Вишлист по колонкам: fields - имена полей, columns - кортеж значений на поле"""
+
+    __slots__ = ('fields', 'columns', 'count')
+
+    def __init__(self, wishes):
+        fields = tuple(dict.fromkeys(key for wish in wishes for key in wish))
+        self.fields = _layouts.setdefault(fields, fields)
+        self.columns = tuple(tuple(_intern(wish.get(field, MISSING)) for wish in wishes) for field in fields)
+        self.count = len(wishes)
+
+    def __len__(self):
+        return self.count
+
+    def column(self, field):
+        try:
+            return self.columns[self.fields.index(field)]
+        except ValueError:
+            return ()
+
+    def to_list(self):
+        fields = self.fields
+        return [
+            {field: value for field, value in zip(fields, row) if value is not MISSING}
+            for row in zip(*self.columns)
+        ] if fields else [{} for _ in range(self.count)]
+
+
+class CompactUser:
+    """Запись пользователя. Поля, которые не ложатся в слоты, - в extra"""
+
+    __slots__ = ('name', 'username', 'wishes', 'joined', 'privacy', 'extra')
+
+    FIELDS = ('name', 'username', 'wishes', 'joined', 'privacy')
+    _FIELD_SET = frozenset(FIELDS)
+
+    @classmethod
+    def pack(cls, record):
+        user = cls()
+        extra = {}
+        user.name = _intern(record.get('name', MISSING))
+        user.username = record.get('username', MISSING)
+        user.privacy = _intern(record.get('privacy', MISSING))
+        user.joined = MISSING
+        if 'joined' in record:
+            seconds = pack_time(record['joined'])
+            if seconds is None:
+                extra['joined'] = record['joined']
+            else:
+                user.joined = seconds
+        user.wishes = MISSING
+        wishes = record.get('wishes', MISSING)
+        if type(wishes) is list and all(type(w) is dict for w in wishes):
+            # Пустой вишлист (у большинства) - общий пустой кортеж
+            user.wishes = Wishes(wishes) if wishes else ()
+        elif wishes is not MISSING:
+            extra['wishes'] = wishes
+        if not cls._FIELD_SET.issuperset(record):
+            extra.update((key, value) for key, value in record.items() if key not in cls._FIELD_SET)
+        user.extra = extra or None
+        return user
+
+    def to_dict(self):
+        record = {}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is MISSING:
+                continue
+            if field == 'wishes':
+                value = value.to_list() if value else []
+            elif field == 'joined':
+                value = unpack_time(value)
+            record[field] = value
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    # Быстрые счётчики без сборки dict (Storage.counts)
+
+    def wish_count(self):
+        wishes = self.wishes
+        return len(wishes) if wishes and wishes is not MISSING else 0
+
+    def reserved_count(self):
+        if not self.wish_count():
+            return 0
+        return sum(1 for value in self.wishes.column('reserved') if value and value is not MISSING)
+
+    def joined_day(self):
+        if self.joined is not MISSING:
+            return time.strftime('%Y-%m-%d', time.gmtime(self.joined))
+        joined = (self.extra or {}).get('joined')
+        return str(joined)[:10] if joined else None
+
+
+def _table_key(user_id):
+    """Числовой id без ведущих нулей -> int, остальные остаются строками"""
+    if type(user_id) is str and user_id.isascii() and user_id.isdigit() and (user_id == '0' or user_id[0] != '0'):
+        return int(user_id)
+    return user_id
+
+
+class UserTable(MutableMapping):
+    """Таблица users: id (строка) -> dict записи, внутри - CompactUser по int-ключу.
+
+    Отданный dict - общий для всех читателей (как и записи других таблиц),
+    менять его нельзя: новая запись кладётся целиком через set.
+    """
+
+    def __init__(self, items=(), cache_size=10000):
+        self._data = {}
+        self._cache = OrderedDict()  # ключ -> собранный dict, последние прочитанные
+        self.cache_size = cache_size
+        self.update(items)
+
+    def _record(self, key, user):
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        record = self._cache[key] = user.to_dict()
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return record
+
+    def __getitem__(self, user_id):
+        key = _table_key(user_id)
+        return self._record(key, self._data[key])
+
+    def get(self, user_id, default=None):
+        key = _table_key(user_id)
+        user = self._data.get(key)
+        return self._record(key, user) if user is not None else default
+
+    def __setitem__(self, user_id, record):
+        key = _table_key(user_id)
+        self._data[key] = CompactUser.pack(record)
+        self._cache.pop(key, None)
+
+    def __delitem__(self, user_id):
+        key = _table_key(user_id)
+        del self._data[key]
+        self._cache.pop(key, None)
+
+    def __contains__(self, user_id):
+        return _table_key(user_id) in self._data
+
+    def __iter__(self):
+        return (str(key) for key in self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def compact_values(self):
+        return self._data.values()
+
+    def snapshot(self):
+        """Поверхностная копия для компакции: записи неизменяемы"""
+        return dict(self._data)
+
+
+def to_json(value):
+    """default= для json.dump снимка с компактными записями"""
+    if isinstance(value, CompactUser):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
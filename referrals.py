@@ -0,0 +1,103 @@
+"""
+Награды за приглашения
+
+Приглашения без награды берутся из ReferralGraph.pending и
+обрабатываются пачками. Пригласивший получает билеты розыгрыша
+(user_tickets) с id "ref:<приглашённый>:<номер>": сначала пишутся билеты,
+потом отметка rewarded, поэтому повторный запуск после сбоя не начислит
+их второй раз. Приглашение с несуществующим пригласившим закрывается без
+билетов, ошибка одного приглашения не останавливает остальные.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timezone
+from santa import notify_all
+
+logger = logging.getLogger(__name__)
+
+
+def parse_user_id(value):
+    """id пользователя из deep link ('ref_<id>'): '123' -> '123', не число - None"""
+    value = str(value)
+    if value.isascii() and value.isdigit() and len(value) <= 18:
+        return str(int(value))
+    return None
+
+
+class ReferralRewards:
+    def __init__(self, store, locks, graph, tickets_per_referral=1, chunk=500, interval=600, bucket=None):
+        self.store = store
+        self.locks = locks
+        self.graph = graph
+        self.tickets_per_referral = tickets_per_referral
+        self.chunk = chunk
+        self.interval = interval
+        self.bucket = bucket
+        self._running = asyncio.Lock()
+
+    async def _reward(self, referred):
+        """Награда за одно приглашение: (пригласивший, новых билетов) или None"""
+        async with self.locks('referrals', referred):
+            referral = await self.store.get_referral(referred)
+            if referral is None or referral.get('rewarded'):
+                return None
+            referrer = parse_user_id(referral.get('referrer'))
+            if referrer is None or referrer == referred or await self.store.get_user(referrer) is None:
+                # Записи, сохранённые до проверки в /start: без билетов, но и не в очереди
+                logger.warning(f"Referral {referred}: unknown referrer {referral.get('referrer')!r}, skipped")
+                await self.store.put_referral(referred, dict(referral, rewarded=True))
+                return None
+            created_at = datetime.now(timezone.utc).isoformat()
+            created = 0
+            for n in range(self.tickets_per_referral):
+                ticket_id = f"ref:{referred}:{n}"
+                if await self.store.get_ticket(ticket_id) is None:
+                    await self.store.put_ticket(ticket_id, {
+                        'user_id': referrer,
+                        'source': 'referral',
+                        'created_at': created_at,
+                        'used_in_raffle': None
+                    })
+                    created += 1
+            await self.store.put_referral(referred, dict(referral, rewarded=True))
+            return referrer, created
+
+    async def reward_pending(self, bot=None):
+        """Обработка всех приглашений без награды: {пригласивший: билетов}.
+
+        Если передан bot, пригласившим приходит уведомление.
+        """
+        credited = {}
+        async with self._running:
+            pending = list(self.graph.pending)
+            for start in range(0, len(pending), self.chunk):
+                for referred in pending[start:start + self.chunk]:
+                    try:
+                        rewarded = await self._reward(referred)
+                    except Exception as e:
+                        logger.error(f"Referral reward for {referred} failed: {e}")
+                        continue
+                    if rewarded and rewarded[1]:
+                        referrer, created = rewarded
+                        credited[referrer] = credited.get(referrer, 0) + created
+                # Между пачками отдаём управление обработке апдейтов
+                await asyncio.sleep(0)
+        if credited:
+            logger.info(f"Referral rewards: {sum(credited.values())} tickets to {len(credited)} users")
+        if bot and credited:
+            messages = {
+                referrer: f"🎟️ +{tickets} билетик(ов) за приглашённых друзей!\n\nСпасибо, что зовёшь друзей в Giftly 🎁"
+                for referrer, tickets in credited.items()
+            }
+            await notify_all(bot, messages, bucket=self.bucket)
+        return credited
+
+    async def run(self, bot):
+        """Фоновая задача: периодический reward_pending()"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reward_pending(bot)
+            except Exception as e:
+                logger.error(f"Referral rewards failed: {e}")
@@ -0,0 +1,277 @@
+"""
+Напоминания о дате обмена в Тайном Санте
+
+У каждой группы с датой обмена есть один таймер - ближайший шаг из STEPS:
+за неделю, за 3 дня, накануне, в день обмена. Что отправить, решается в
+момент срабатывания по текущей записи группы: если жеребьёвка проведена,
+напоминание получают участники, если нет - админу приходит просьба
+провести жеребьёвку (шаг 'draw' - только она).
+
+Таймеры лежат в куче (срок, id группы), актуальный таймер группы - в
+timers; устаревшие записи кучи (дату поменяли) отбрасываются при снятии.
+Тик снимает только истёкшие таймеры - O(k log n), группы целиком не
+обходятся. Уведомления уходят пачками через общий token bucket.
+
+Таймеры хранятся в журнале JSON-строк: [группа, день, шаг] - следующий
+шаг группы, [группа] - таймеров больше нет. При старте журнал
+проигрывается (последняя строка группы побеждает) и куча собирается за
+O(n); журнал переписывается, когда в нём в несколько раз больше строк,
+чем таймеров. Нет журнала - таймеры строятся обходом групп один раз.
+"""
+
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+from datetime import date, datetime, timedelta, timezone
+from datetime import time as day_time
+from santa import notify_all
+
+logger = logging.getLogger(__name__)
+
+# Шаги: (имя, дней до обмена)
+STEPS = (('week', 7), ('draw', 3), ('day', 1), ('today', 0))
+
+WHEN = {'week': "через неделю", 'draw': "через 3 дня", 'day': "завтра", 'today': "сегодня"}
+
+
+def exchange_day(group):
+    """Дата обмена группы (ordinal) или None"""
+    value = group.get('date') if group else None
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10]).toordinal()
+    except ValueError:
+        return None
+
+
+class SantaReminders:
+    def __init__(self, path, store, bucket=None, status=None, hour=10, utc_offset=3,
+                 interval=60, batch=1000, max_late=12 * 3600):
+        self.path = path
+        self.store = store
+        self.bucket = bucket
+        self.status = status
+        self.hour = hour
+        self.tz = timezone(timedelta(hours=utc_offset))
+        self.interval = interval
+        self.batch = batch
+        self.max_late = max_late
+        self.timers = {}  # id группы -> (срок, шаг, день обмена)
+        self._days = {}  # день (ordinal) -> unix-время напоминания в этот день
+        self._heap = []
+        self._log = None
+        self._log_lines = 0
+        self._pending = None
+        self.sent = 0
+
+    # ===== Таймеры =====
+
+    def due(self, day, step):
+        """Unix-время шага step для обмена в день day (ordinal)"""
+        key = day - STEPS[step][1]
+        due = self._days.get(key)
+        if due is None:
+            # Различных дней мало - срок считается один раз на день
+            due = self._days[key] = int(datetime.combine(date.fromordinal(key), day_time(self.hour), self.tz).timestamp())
+        return due
+
+    def _next_step(self, day, step, now):
+        """Первый шаг начиная со step, срок которого ещё не прошёл"""
+        while step < len(STEPS) and self.due(day, step) <= now:
+            step += 1
+        return step
+
+    def _set(self, group_id, day, step):
+        if step < len(STEPS):
+            due = self.due(day, step)
+            self.timers[group_id] = (due, step, day)
+            heapq.heappush(self._heap, (due, group_id))
+            record = [group_id, day, step]
+        elif self.timers.pop(group_id, None) is not None:
+            record = [group_id]
+        else:
+            return
+        self._append(record)
+
+    def schedule(self, group_id, group, now=None):
+        """Таймер группы по её дате обмена (без даты - без таймера)"""
+        now = time.time() if now is None else now
+        day = exchange_day(group)
+        if day is None:
+            self._set(group_id, 0, len(STEPS))
+        else:
+            self._set(group_id, day, self._next_step(day, 0, now))
+
+    def on_change(self, table, key, old, new):
+        if table != 'groups' or exchange_day(old) == exchange_day(new):
+            return
+        self.schedule(key, new)
+
+    def pop_due(self, now, limit):
+        """До limit истёкших таймеров: [(id группы, таймер)]"""
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now and len(due) < limit:
+            when, group_id = heapq.heappop(heap)
+            timer = self.timers.get(group_id)
+            # Устаревшая запись кучи: таймер группы переставлен или снят
+            if timer is not None and timer[0] == when:
+                due.append((group_id, timer))
+        return due
+
+    # ===== Журнал =====
+
+    async def open(self):
+        """Загрузка журнала таймеров, без него - обход групп"""
+        if self.path and os.path.exists(self.path):
+            await asyncio.to_thread(self._load)
+        else:
+            self.timers, self._heap = {}, []
+            now = time.time()
+            async for group_id, group in self.store.scan_groups():
+                self.schedule(group_id, group, now)
+            self._compact()
+        logger.info(f"Santa reminders: {len(self.timers)} groups scheduled")
+
+    def _load(self):
+        steps = {}
+        lines = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                lines += 1
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная при падении последняя строка
+                    continue
+                if len(record) == 3:
+                    steps[record[0]] = (record[1], record[2])
+                else:
+                    steps.pop(record[0], None)
+        self.timers = {group_id: (self.due(day, step), step, day) for group_id, (day, step) in steps.items()}
+        self._heap = [(timer[0], group_id) for group_id, timer in self.timers.items()]
+        heapq.heapify(self._heap)
+        self._log_lines = lines
+        if lines > 2 * len(self.timers) + 1000:
+            self._compact()
+
+    def _append(self, record):
+        if self._pending is not None:
+            # Идёт компакция - строки допишутся в новый журнал
+            self._pending.append(record)
+            return
+        if self._log is None:
+            if not self.path:
+                return
+            self._log = open(self.path, 'a', encoding='utf-8')
+        self._log.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._log_lines += 1
+
+    def _write_snapshot(self, timers):
+        """Журнал заново: одна строка на таймер, замена атомарная"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for group_id, (_, step, day) in timers:
+                f.write(json.dumps([group_id, day, step], ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _compact(self):
+        if self.path:
+            self.close()
+            self._write_snapshot(self.timers.items())
+            self._log_lines = len(self.timers)
+
+    async def _compact_async(self):
+        """Компакция в потоке: снимок таймеров здесь, новые строки ждут в памяти"""
+        timers = list(self.timers.items())
+        self.close()
+        self._pending = []
+        try:
+            await asyncio.to_thread(self._write_snapshot, timers)
+            self._log_lines = len(timers)
+        finally:
+            pending, self._pending = self._pending, None
+            for record in pending:
+                self._append(record)
+
+    def flush(self):
+        if self._log is not None:
+            self._log.flush()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    # ===== Отправка =====
+
+    def _messages(self, group, step):
+        """{получатель: текст} для шага по текущей записи группы"""
+        name = group.get('name') or "Тайный Санта"
+        when = WHEN[STEPS[step][0]]
+        if not group.get('shuffled'):
+            admin_id = group.get('admin_id')
+            if not admin_id:
+                return {}
+            return {admin_id: f"🎅 В группе \"{name}\" обмен подарками {when}, а жеребьёвка ещё не проведена!\n\n"
+                              f"Открой приложение и проведи жеребьёвку 🎲"}
+        if STEPS[step][0] == 'draw':
+            return {}
+        budget = f"\nБюджет: {group['budget']}" if group.get('budget') else ""
+        if STEPS[step][0] == 'today':
+            text = f"🎁 Сегодня обмен подарками в группе \"{name}\"!{budget}\n\nСчастливого Тайного Санты 🎄"
+        else:
+            text = (f"🎄 Обмен подарками в группе \"{name}\" {when}!{budget}\n\n"
+                    f"Открой приложение, чтобы посмотреть желания своего получателя 🎁")
+        givers = group.get('assignments') or {}
+        return {giver_id: text for giver_id in givers}
+
+    async def fire(self, bot, now=None):
+        """Отправка всех истёкших напоминаний пачками, возвращает число сообщений"""
+        now = time.time() if now is None else now
+        sent = 0
+        while True:
+            due = self.pop_due(now, self.batch)
+            if not due:
+                break
+            messages = {}
+            for group_id, timer in due:
+                when, step, day = timer
+                group = await self.store.get_group(group_id)
+                # Пока читали группу, таймер могли переставить - тогда он уже новый
+                if self.timers.get(group_id) is not timer:
+                    continue
+                if group is None or exchange_day(group) != day:
+                    self._set(group_id, 0, len(STEPS))
+                    continue
+                # Пропущенное при простое бота дольше max_late не отправляется
+                if now - when <= self.max_late:
+                    for chat_id, text in self._messages(group, step).items():
+                        chat_id = str(chat_id)
+                        messages[chat_id] = f"{messages[chat_id]}\n\n{text}" if chat_id in messages else text
+                self._set(group_id, day, self._next_step(day, step + 1, now))
+            if self.status is not None:
+                messages = {chat_id: messages[chat_id] for chat_id in self.status.reachable(messages)}
+            if messages:
+                failed = await notify_all(bot, messages, bucket=self.bucket)
+                sent += len(messages) - len(failed)
+            self.flush()
+        if self.path and self._log_lines > 2 * len(self.timers) + 1000:
+            await self._compact_async()
+        if sent:
+            logger.info(f"Santa reminders sent: {sent}")
+        self.sent += sent
+        return sent
+
+    async def run(self, bot):
+        """Фоновая задача: fire() раз в interval секунд"""
+        while True:
+            try:
+                await self.fire(bot)
+            except Exception as e:
+                logger.error(f"Santa reminders failed: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,118 @@
+"""
+Резервирование желаний
+
+Желание находится по WishIndex за O(1), а резерв ставится как
+compare-and-set под блокировкой владельца вишлиста: уже занятое желание
+зарезервировать нельзя, снять резерв может только тот, кто его поставил.
+Резерв живёт ttl секунд, просроченные снимает фоновая задача run().
+"""
+
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationError(Exception):
+    """Резерв не удался - текст для пользователя"""
+
+
+def _is_active(wish, now):
+    until = wish.get('reserved_until')
+    return bool(wish.get('reserved')) and not (until and until <= now)
+
+
+def _released(wish):
+    released = {k: v for k, v in wish.items() if k not in ('reserved_by', 'reserved_at', 'reserved_until')}
+    released['reserved'] = False
+    return released
+
+
+class Reservations:
+    def __init__(self, store, locks, index, ttl=None, sweep_interval=600):
+        self.store = store
+        self.locks = locks
+        self.index = index
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+
+    async def _update(self, owner_id, wish_id, change):
+        """Чтение-изменение-запись желания под блокировкой владельца.
+
+        change(wish) возвращает новую запись желания или бросает ReservationError.
+        """
+        owner_id, wish_id = str(owner_id), str(wish_id)
+        if self.index.locate(owner_id, wish_id) is None:
+            raise ReservationError("Желание не найдено")
+        async with self.locks('users', owner_id):
+            # Пока ждали блокировку, вишлист мог измениться - позиция берётся заново
+            position = self.index.locate(owner_id, wish_id)
+            owner = await self.store.get_user(owner_id)
+            if position is None or owner is None:
+                raise ReservationError("Желание не найдено")
+            wishes = owner.get('wishes', [])
+            if position >= len(wishes) or str(wishes[position].get('id')) != wish_id:
+                raise ReservationError("Желание не найдено")
+            wish = change(wishes[position])
+            # Только это желание: бэкенд не переписывает весь вишлист
+            await self.store.patch_user(owner_id, {'put': [wish]})
+            return wish
+
+    async def reserve(self, owner_id, wish_id, user_id):
+        """Резерв свободного желания, возвращает новую запись желания"""
+        if str(user_id) == str(owner_id):
+            raise ReservationError("Свой подарок зарезервировать нельзя")
+
+        def change(wish):
+            now = time.time()
+            if _is_active(wish, now):
+                if wish.get('reserved_by') == user_id:
+                    raise ReservationError("Ты уже зарезервировал(а) этот подарок")
+                raise ReservationError("Этот подарок уже кто-то зарезервировал")
+            reserved = dict(_released(wish), reserved=True, reserved_by=user_id,
+                            reserved_at=datetime.now(timezone.utc).isoformat())
+            if self.ttl:
+                reserved['reserved_until'] = now + self.ttl
+            return reserved
+        return await self._update(owner_id, wish_id, change)
+
+    async def unreserve(self, owner_id, wish_id, user_id):
+        """Снятие своего резерва"""
+        def change(wish):
+            if not _is_active(wish, time.time()):
+                raise ReservationError("Подарок не зарезервирован")
+            if wish.get('reserved_by') != user_id:
+                raise ReservationError("Снять резерв может только тот, кто его поставил")
+            return _released(wish)
+        return await self._update(owner_id, wish_id, change)
+
+    async def sweep(self, now=None):
+        """Снятие просроченных резервов, возвращает их число"""
+        now = now or time.time()
+        released = 0
+        for owner_id, wish_id in self.index.expired(now):
+            def change(wish):
+                # Срок в куче мог устареть: резерв сняли или поставили заново
+                until = wish.get('reserved_until')
+                if not wish.get('reserved') or not until or until > now:
+                    raise ReservationError("Резерв не просрочен")
+                return _released(wish)
+            try:
+                await self._update(owner_id, wish_id, change)
+                released += 1
+            except ReservationError:
+                pass
+        if released:
+            logger.info(f"Expired reservations released: {released}")
+        return released
+
+    async def run(self):
+        """Фоновая задача: периодический sweep()"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Reservation sweep failed: {e}")
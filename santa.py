@@ -0,0 +1,148 @@
+"""
+Тайный Санта: жеребьёвка и уведомления участников
+
+Жеребьёвка - это перестановка без неподвижных точек (никто не дарит сам
+себе), которая обходит запрещённые пары: пары (couples) не дарят друг
+другу, прошлогодние пары не повторяются.
+
+Маленькие группы перебираются поиском с возвратом - так мы точно знаем,
+что допустимой жеребьёвки нет. Большие группы выстраиваются в один
+случайный цикл (каждый дарит следующему), а запрещённые рёбра цикла
+исправляются случайными обменами - в среднем O(n) для тысяч участников.
+"""
+
+import re
+import random
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# До этого размера группы - точный перебор
+EXACT_SEARCH_LIMIT = 10
+
+# id группы входит в ссылку-приглашение ?start=santa_<id>, а параметр /start -
+# до 64 символов из A-Z, a-z, 0-9, _ и -
+GROUP_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,58}')
+
+
+class SantaDrawError(Exception):
+    """Допустимую жеребьёвку найти не удалось"""
+
+
+def valid_group_id(group_id):
+    return isinstance(group_id, str) and GROUP_ID_RE.fullmatch(group_id) is not None
+
+
+def build_exclusions(couples=(), previous=None):
+    """Множество запрещённых пар (даритель, получатель)"""
+    excluded = set()
+    for pair in couples:
+        if len(pair) == 2:
+            a, b = str(pair[0]), str(pair[1])
+            excluded.add((a, b))
+            excluded.add((b, a))
+    for giver, receiver in (previous or {}).items():
+        excluded.add((str(giver), str(receiver)))
+    return excluded
+
+
+def draw(participants, excluded=frozenset(), rng=None, attempts=50):
+    """Жеребьёвка: словарь даритель -> получатель"""
+    rng = rng or random.SystemRandom()
+    people = list(dict.fromkeys(str(p) for p in participants))
+    if len(people) < 2:
+        raise SantaDrawError("Нужно хотя бы 2 участника")
+    if len(people) <= EXACT_SEARCH_LIMIT:
+        return _draw_exact(people, excluded, rng)
+    for _ in range(attempts):
+        result = _draw_cycle(people, excluded, rng)
+        if result is not None:
+            return result
+    raise SantaDrawError("Слишком много ограничений для жеребьёвки")
+
+
+def _allowed(giver, receiver, excluded):
+    return giver != receiver and (giver, receiver) not in excluded
+
+
+def _draw_exact(people, excluded, rng):
+    """Поиск с возвратом по всем перестановкам в случайном порядке"""
+    givers = people[:]
+    rng.shuffle(givers)
+    result = {}
+    taken = set()
+
+    def assign(i):
+        if i == len(givers):
+            return True
+        giver = givers[i]
+        candidates = [p for p in people if p not in taken and _allowed(giver, p, excluded)]
+        rng.shuffle(candidates)
+        for receiver in candidates:
+            result[giver] = receiver
+            taken.add(receiver)
+            if assign(i + 1):
+                return True
+            taken.discard(receiver)
+        result.pop(giver, None)
+        return False
+
+    if not assign(0):
+        raise SantaDrawError("Допустимой жеребьёвки не существует")
+    return result
+
+
+def _draw_cycle(people, excluded, rng):
+    """Случайный цикл с починкой запрещённых рёбер обменами"""
+    order = people[:]
+    rng.shuffle(order)
+    n = len(order)
+
+    def edge_ok(i):
+        return _allowed(order[i], order[(i + 1) % n], excluded)
+
+    for i in range(n):
+        if edge_ok(i):
+            continue
+        # Меняем получателя order[i+1] с случайной позицией j, пока
+        # все четыре затронутых ребра не станут допустимыми
+        k = (i + 1) % n
+        for _ in range(4 * n):
+            j = rng.randrange(n)
+            if j == k:
+                continue
+            order[k], order[j] = order[j], order[k]
+            touched = {(k - 1) % n, k, (j - 1) % n, j}
+            if all(edge_ok(t) for t in touched):
+                break
+            order[k], order[j] = order[j], order[k]
+        else:
+            return None
+
+    # Обмены могли испортить уже проверенные рёбра - финальная проверка
+    if not all(edge_ok(i) for i in range(n)):
+        return None
+    return {order[i]: order[(i + 1) % n] for i in range(n)}
+
+
+async def notify_all(bot, messages, concurrency=10, bucket=None):
+    """Параллельная отправка уведомлений: {chat_id: текст}.
+
+    Возвращает список chat_id, которым отправить не удалось.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def send(chat_id, text):
+        async with semaphore:
+            if bucket:
+                await bucket.acquire()
+            try:
+                await bot.send_message(chat_id=int(chat_id), text=text)
+            except Exception as e:
+                logger.error(f"Failed to notify user {chat_id}: {e}")
+                failed.append(chat_id)
+
+    await asyncio.gather(*(send(chat_id, text) for chat_id, text in messages.items()))
+    return failed
@@ -0,0 +1,1347 @@
+"""
+Хранилище данных бота
+
+Два бэкенда с общим асинхронным интерфейсом Storage:
+
+JournalStore - данные загружаются в память один раз при старте. Каждое
+изменение дописывается в журнал (append-only), fsync выполняется пачками
+в фоне, а снапшот data.json периодически пересобирается из памяти
+(компакция). После падения состояние восстанавливается: снапшот + повтор
+журнала. Формат записи журнала - одна JSON-строка на операцию:
+    {"p": ["users", "123"], "v": {...}}   - установить значение по пути
+    {"p": ["users", "123"], "d": 1}       - удалить значение по пути
+
+SqliteStore - индексированная SQLite-база по схеме supabase-schema.sql
+(users, wishes, santa_groups, santa_participants, referrals). Запросы
+выполняются в пуле потоков, event loop не блокируется.
+
+Выбор бэкенда: переменная окружения STORAGE ("journal" или "sqlite:путь").
+"""
+
+import os
+import json
+import itertools
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from jsonstream import JsonStream
+from records import UserTable, to_json
+
+logger = logging.getLogger(__name__)
+
+TABLES = ('users', 'groups', 'referrals', 'tickets', 'raffles')
+# Таблица -> имя записи в методах get_<имя>, put_<имя>
+RECORD_NAMES = {'users': 'user', 'groups': 'group', 'referrals': 'referral', 'tickets': 'ticket', 'raffles': 'raffle'}
+
+
+def _fsync_dir(path):
+    """fsync каталога, чтобы переименование файла пережило сбой питания"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class Storage:
+    """Интерфейс хранилища.
+
+    Идентификаторы - строки (telegram id пользователя, id группы), записи -
+    словари в формате data.json. Все методы доступа - корутины, чтобы
+    бэкенды с дисковым I/O не блокировали event loop.
+
+    После каждой записи подписчики получают событие изменения
+    listener(table, key, old, new) - по нему индексы и счётчики
+    обновляются инкрементально, без пересчёта по всей базе.
+    """
+
+    # Счётчики ввода-вывода для метрик: время в секундах, объём в байтах
+    IO_FIELDS = ('load_seconds', 'load_bytes', 'save_seconds', 'save_bytes', 'saves',
+                 'write_bytes', 'writes', 'write_seconds', 'fsync_seconds', 'fsyncs')
+
+    def __init__(self):
+        self._listeners = []
+        self.io = dict.fromkeys(self.IO_FIELDS, 0)
+
+    def subscribe(self, listener):
+        """Подписка на изменения: listener(table, key, old, new)"""
+        self._listeners.append(listener)
+
+    def _emit(self, table, key, old, new):
+        for listener in self._listeners:
+            try:
+                listener(table, key, old, new)
+            except Exception as e:
+                logger.error(f"Storage listener failed on {table}/{key}: {e}")
+
+    def open(self):
+        return self
+
+    def close(self):
+        pass
+
+    async def get_user(self, user_id):
+        raise NotImplementedError
+
+    async def put_user(self, user_id, record):
+        raise NotImplementedError
+
+    async def get_users(self, user_ids):
+        """Пакетное чтение: словарь id -> запись для найденных пользователей"""
+        raise NotImplementedError
+
+    async def patch_user(self, user_id, delta):
+        """Изменение части записи (см. apply_user_delta), возвращает новую запись.
+
+        Бэкенды пишут только изменённое, здесь - полной перезаписью.
+        """
+        record = apply_user_delta(await self.get_user(user_id), delta)
+        await self.put_user(user_id, record)
+        return record
+
+    async def get_group(self, group_id):
+        raise NotImplementedError
+
+    async def put_group(self, group_id, record):
+        raise NotImplementedError
+
+    async def get_referral(self, user_id):
+        raise NotImplementedError
+
+    async def put_referral(self, user_id, record):
+        raise NotImplementedError
+
+    async def get_ticket(self, ticket_id):
+        raise NotImplementedError
+
+    async def put_ticket(self, ticket_id, record):
+        """Билет розыгрыша: {'user_id', 'source', 'created_at', 'used_in_raffle'}"""
+        raise NotImplementedError
+
+    async def get_raffle(self, raffle_id):
+        raise NotImplementedError
+
+    async def put_many(self, table, items):
+        """Запись пачки [(ключ, запись)] одной таблицы (импорт данных)"""
+        put = getattr(self, f"put_{RECORD_NAMES[table]}")
+        for key, record in items:
+            await put(key, record)
+
+    async def put_raffle(self, raffle_id, record):
+        """Розыгрыш: {'title', 'status', 'winner_id', 'created_at', ...протокол}"""
+        raise NotImplementedError
+
+    async def complete_raffle(self, raffle_id, record, counts):
+        """Запись розыгрыша и отметка used_in_raffle у его билетов - атомарно.
+
+        counts - снимок {id участника (int): билетов}, по которому шёл
+        розыгрыш: у участника расходуется столько неиспользованных билетов,
+        сколько было в снимке, выданные позже остаются на следующий.
+        """
+        raise NotImplementedError
+
+    async def user_ids(self):
+        """Список id всех пользователей"""
+        raise NotImplementedError
+
+    def scan_users(self, batch=1000):
+        """Асинхронный обход всех пользователей: пары (id, запись)"""
+        raise NotImplementedError
+
+    def scan_groups(self, batch=1000):
+        """Асинхронный обход групп Тайного Санты: пары (id, запись)"""
+        raise NotImplementedError
+
+    def scan_referrals(self, batch=1000):
+        """Асинхронный обход рефералов: пары (id приглашённого, запись)"""
+        raise NotImplementedError
+
+    def scan_tickets(self, batch=1000):
+        """Асинхронный обход билетов: пары (id билета, запись)"""
+        raise NotImplementedError
+
+    def scan_raffles(self, batch=1000):
+        """Асинхронный обход розыгрышей: пары (id, запись)"""
+        raise NotImplementedError
+
+    async def counts(self):
+        """Статистика, посчитанная с нуля по всей базе (для сверки счётчиков).
+
+        Ключи: users, wishes, reserved, groups, shuffled, referrals,
+        referrals_pending, joins (словарь дата -> число регистраций).
+        """
+        raise NotImplementedError
+
+
+def apply_user_delta(record, delta):
+    """Новая запись пользователя после изменения delta (старая не меняется).
+
+    delta: set - поля записи; put - желания целиком (замена по id, новые -
+    в начало списка в том же порядке); delete - id удаляемых желаний;
+    order - новый порядок id (не перечисленные остаются в конце).
+    """
+    record = dict(record or {'wishes': []}, **delta.get('set', {}))
+    wishes = record.get('wishes', [])
+    puts = {str(w['id']): w for w in delta.get('put', ())}
+    deleted = {str(wish_id) for wish_id in delta.get('delete', ())}
+    existing = {str(w.get('id')) for w in wishes}
+    result = [w for wish_id, w in puts.items() if wish_id not in existing and wish_id not in deleted]
+    result += [puts.get(str(w.get('id')), w) for w in wishes if str(w.get('id')) not in deleted]
+    if delta.get('order'):
+        rank = {str(wish_id): i for i, wish_id in enumerate(delta['order'])}
+        result.sort(key=lambda w: rank.get(str(w.get('id')), len(rank)))
+    record['wishes'] = result
+    return record
+
+
+def create_storage(spec, data_file):
+    """Создание бэкенда по строке STORAGE"""
+    if spec.startswith('sqlite:'):
+        return SqliteStore(spec[len('sqlite:'):])
+    if spec == 'journal':
+        return JournalStore(data_file)
+    raise ValueError(f"Unknown storage backend: {spec}")
+
+
+class JournalStore(Storage):
+    """In-memory хранилище с журналом изменений.
+
+    Записи считаются неизменяемыми: чтобы поменять запись, соберите новый
+    объект и передайте его в set(). Так компакция может безопасно
+    сериализовать снимок таблиц без долгой блокировки.
+    """
+
+    def __init__(self, path, fsync_interval=0.05, compact_bytes=4 * 1024 * 1024, compact_ratio=0.5):
+        super().__init__()
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self.compact_ratio = compact_ratio
+        self.data = {}
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_size = 0
+        self._snapshot_size = 0
+        self._unused_tickets = {}  # id пользователя (int) -> {id билета: None} в порядке выдачи
+        self._dirty = False
+        self._compacting = False
+        self._stop = threading.Event()
+        self._flusher = None
+
+    # ===== Жизненный цикл =====
+
+    def open(self):
+        """Загрузка снапшота и повтор журнала"""
+        started = time.perf_counter()
+        # Пользователи хранятся компактно (records.py), снапшот читается
+        # по записи, чтобы не держать весь документ в dict при старте
+        self.data = {table: {} for table in TABLES}
+        self.data['users'] = UserTable()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for table, key, record in JsonStream(f).records():
+                    self.data.setdefault(table, {})[key] = record
+                self._snapshot_size = f.buffer.tell()
+                self.io['load_bytes'] += self._snapshot_size
+        except FileNotFoundError:
+            pass
+
+        # Журнал незавершённой компакции идёт раньше текущего
+        replayed = self._replay(self.journal_path + '.old')
+        replayed += self._replay(self.journal_path)
+        if replayed:
+            logger.info(f"Journal replayed: {replayed} ops")
+        for ticket_id, ticket in self.data['tickets'].items():
+            self._index_ticket(ticket_id, None, ticket)
+        self.io['load_seconds'] += time.perf_counter() - started
+
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal_size = self._journal.tell()
+        self._flusher = threading.Thread(target=self._flush_loop, name='journal-flusher', daemon=True)
+        self._flusher.start()
+        return self
+
+    def close(self):
+        """Остановка фонового потока, fsync и финальная компакция"""
+        self._stop.set()
+        if self._flusher:
+            self._flusher.join()
+        self.compact()
+        with self._lock:
+            self._journal.close()
+            self._journal = None
+
+    def _replay(self, path):
+        """Применение операций журнала к данным в памяти"""
+        applied = 0
+        good_offset = 0
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # Оборванная запись в конце журнала после падения
+                    logger.warning(f"Journal {path}: torn record at offset {good_offset}, truncating")
+                    break
+                self._apply(op)
+                applied += 1
+                good_offset += len(line)
+        if os.path.getsize(path) != good_offset:
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+        return applied
+
+    def _apply(self, op):
+        path = op['p']
+        node = self.data
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        if op.get('d'):
+            node.pop(path[-1], None)
+        elif 'w' in op:
+            node[path[-1]] = apply_user_delta(node.get(path[-1]), op['w'])
+        else:
+            node[path[-1]] = op['v']
+
+    # ===== Чтение и запись =====
+
+    def get(self, table, key, default=None):
+        """Чтение записи за O(1)"""
+        return self.data[table].get(key, default)
+
+    def table(self, table):
+        """Таблица целиком (только для чтения)"""
+        return self.data[table]
+
+    def set(self, path, value):
+        """Установка значения по пути, например ('users', '123')"""
+        self._write({'p': list(path), 'v': value})
+
+    def delete(self, path):
+        """Удаление значения по пути"""
+        self._write({'p': list(path), 'd': 1})
+
+    def _write(self, op):
+        self._write_many([op])
+
+    def _write_many(self, ops):
+        """Операции подряд одним куском журнала"""
+        lines = ''.join(json.dumps(op, ensure_ascii=False) + '\n' for op in ops)
+        with self._lock:
+            for op in ops:
+                self._apply(op)
+            # Запись уходит в ОС сразу, fsync - пачкой в фоне
+            self._journal.write(lines)
+            self._journal.flush()
+            self._journal_size += len(lines)
+            self._dirty = True
+            self.io['writes'] += len(ops)
+            self.io['write_bytes'] += len(lines)
+
+    # ===== Интерфейс Storage =====
+
+    async def get_user(self, user_id):
+        return self.get('users', user_id)
+
+    async def put_user(self, user_id, record):
+        old = self.get('users', user_id)
+        self.set(('users', user_id), record)
+        self._emit('users', user_id, old, record)
+
+    async def patch_user(self, user_id, delta):
+        # В журнал уходит только изменение, а не весь вишлист
+        old = self.get('users', user_id)
+        self._write({'p': ['users', user_id], 'w': delta})
+        record = self.get('users', user_id)
+        self._emit('users', user_id, old, record)
+        return record
+
+    async def get_users(self, user_ids):
+        users = self.data['users']
+        return {uid: users[uid] for uid in user_ids if uid in users}
+
+    async def get_group(self, group_id):
+        return self.get('groups', group_id)
+
+    async def put_group(self, group_id, record):
+        old = self.get('groups', group_id)
+        self.set(('groups', group_id), record)
+        self._emit('groups', group_id, old, record)
+
+    async def get_referral(self, user_id):
+        return self.get('referrals', user_id)
+
+    async def put_referral(self, user_id, record):
+        old = self.get('referrals', user_id)
+        self.set(('referrals', user_id), record)
+        self._emit('referrals', user_id, old, record)
+
+    async def get_ticket(self, ticket_id):
+        return self.get('tickets', ticket_id)
+
+    async def put_ticket(self, ticket_id, record):
+        old = self.get('tickets', ticket_id)
+        self.set(('tickets', ticket_id), record)
+        self._index_ticket(ticket_id, old, record)
+        self._emit('tickets', ticket_id, old, record)
+
+    def _index_ticket(self, ticket_id, old, new):
+        """Неиспользованные билеты по пользователям - розыгрыш не обходит все билеты"""
+        if old is not None and not old.get('used_in_raffle'):
+            tickets = self._unused_tickets.get(int(old['user_id']))
+            if tickets is not None:
+                tickets.pop(ticket_id, None)
+                if not tickets:
+                    del self._unused_tickets[int(old['user_id'])]
+        if new is not None and not new.get('used_in_raffle'):
+            self._unused_tickets.setdefault(int(new['user_id']), {})[ticket_id] = None
+
+    async def get_raffle(self, raffle_id):
+        return self.get('raffles', raffle_id)
+
+    async def put_raffle(self, raffle_id, record):
+        old = self.get('raffles', raffle_id)
+        self.set(('raffles', raffle_id), record)
+        self._emit('raffles', raffle_id, old, record)
+
+    async def complete_raffle(self, raffle_id, record, counts):
+        spent = []
+        for user_id, count in counts.items():
+            for ticket_id in itertools.islice(self._unused_tickets.get(int(user_id), ()), count):
+                ticket = self.data['tickets'][ticket_id]
+                spent.append((ticket_id, ticket, dict(ticket, used_in_raffle=raffle_id)))
+        old = self.get('raffles', raffle_id)
+        # Без await между записями, в журнал - одним куском
+        self._write_many([{'p': ['tickets', ticket_id], 'v': new} for ticket_id, _, new in spent]
+                         + [{'p': ['raffles', raffle_id], 'v': record}])
+        for ticket_id, ticket, new in spent:
+            self._index_ticket(ticket_id, ticket, new)
+            self._emit('tickets', ticket_id, ticket, new)
+        self._emit('raffles', raffle_id, old, record)
+
+    async def user_ids(self):
+        return list(self.data['users'])
+
+    async def scan_users(self, batch=1000):
+        async for item in self._scan('users', batch):
+            yield item
+
+    async def scan_groups(self, batch=1000):
+        async for item in self._scan('groups', batch):
+            yield item
+
+    async def scan_referrals(self, batch=1000):
+        async for item in self._scan('referrals', batch):
+            yield item
+
+    async def scan_tickets(self, batch=1000):
+        async for item in self._scan('tickets', batch):
+            yield item
+
+    async def scan_raffles(self, batch=1000):
+        async for item in self._scan('raffles', batch):
+            yield item
+
+    async def _scan(self, table, batch):
+        # Записи собираются по ключу во время обхода: у users это dict из компактной записи
+        data = self.data[table]
+        keys = list(data)
+        for start in range(0, len(keys), batch):
+            for key in keys[start:start + batch]:
+                record = data.get(key)
+                if record is not None:
+                    yield key, record
+            # Отдаём управление event loop между пачками
+            await asyncio.sleep(0)
+
+    async def counts(self):
+        users = self.data['users']
+        groups = self.data['groups']
+        referrals = self.data['referrals']
+        joins = {}
+        wishes = reserved = 0
+        for user in users.compact_values():
+            wishes += user.wish_count()
+            reserved += user.reserved_count()
+            day = user.joined_day()
+            if day:
+                joins[day] = joins.get(day, 0) + 1
+        return {
+            'users': len(users),
+            'wishes': wishes,
+            'reserved': reserved,
+            'groups': len(groups),
+            'shuffled': sum(1 for g in groups.values() if g.get('shuffled')),
+            'referrals': len(referrals),
+            'referrals_pending': sum(1 for r in referrals.values() if not r.get('rewarded')),
+            'joins': joins,
+        }
+
+    # ===== Фоновые задачи =====
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            self.sync()
+            if self._journal_size >= self.compact_threshold():
+                self.compact()
+
+    def compact_threshold(self):
+        """Размер журнала для компакции: доля снапшота, но не меньше compact_bytes.
+
+        Компакция переписывает весь снапшот, поэтому порог растёт вместе с ним -
+        на каждый байт журнала приходится не больше 1/compact_ratio байт перезаписи.
+        """
+        return max(self.compact_bytes, self._snapshot_size * self.compact_ratio)
+
+    def sync(self):
+        """fsync журнала, если были записи"""
+        with self._lock:
+            if not self._dirty or self._journal is None:
+                return
+            self._dirty = False
+            fd = self._journal.fileno()
+        started = time.perf_counter()
+        try:
+            os.fsync(fd)
+            self.io['fsyncs'] += 1
+            self.io['fsync_seconds'] += time.perf_counter() - started
+        except OSError:
+            # Журнал успели закрыть при компакции - снапшот сделает fsync сам
+            pass
+
+    def compact(self):
+        """Пересборка снапшота и обрезка журнала"""
+        with self._lock:
+            if self._compacting or self._journal is None:
+                return
+            self._compacting = True
+            # Поверхностная копия таблиц: записи неизменяемы, поэтому этого достаточно
+            snapshot = {
+                name: table.snapshot() if isinstance(table, UserTable) else dict(table)
+                for name, table in self.data.items()
+            }
+            self._journal.close()
+            old_path = self.journal_path + '.old'
+            if os.path.exists(old_path):
+                # Прошлая компакция не завершилась - дописываем журнал к старому
+                with open(self.journal_path, 'rb') as src, open(old_path, 'ab') as dst:
+                    dst.write(src.read())
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, old_path)
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            self._journal_size = 0
+            self._dirty = False
+
+        started = time.perf_counter()
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2, default=to_json)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            os.replace(tmp_path, self.path)
+            _fsync_dir(self.path)
+            os.remove(old_path)
+            self._snapshot_size = size
+            self.io['saves'] += 1
+            self.io['save_bytes'] += size
+            self.io['save_seconds'] += time.perf_counter() - started
+        except Exception as e:
+            # Журнал .old останется и будет повторён при следующем старте
+            logger.error(f"Compaction failed: {e}")
+        finally:
+            self._compacting = False
+
+
+# ===== SQLite =====
+
+# Схема повторяет supabase-schema.sql. Отличие: ссылки на пользователей
+# хранят telegram_id (бот работает именно с ним), а не UUID.
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    privacy TEXT DEFAULT 'public',
+    created_at TEXT,
+    extra TEXT
+);
+
+-- id желания задаёт клиент, поэтому он уникален только у своего владельца
+CREATE TABLE IF NOT EXISTS wishes (
+    id TEXT NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(telegram_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    description TEXT,
+    price,
+    currency TEXT,
+    url TEXT,
+    photo_url TEXT,
+    reserved INTEGER DEFAULT 0,
+    reserved_by TEXT,
+    created_at,
+    extra TEXT,
+    PRIMARY KEY (user_id, id)
+);
+
+CREATE TABLE IF NOT EXISTS santa_groups (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    admin_id INTEGER,
+    budget,
+    event_date TEXT,
+    shuffled INTEGER DEFAULT 0,
+    assignments TEXT DEFAULT '{}',
+    invite_code TEXT UNIQUE,
+    extra TEXT
+);
+
+CREATE TABLE IF NOT EXISTS santa_participants (
+    group_id TEXT NOT NULL REFERENCES santa_groups(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    assigned_to INTEGER,
+    UNIQUE(group_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS referrals (
+    referred_id INTEGER PRIMARY KEY,
+    referrer_id INTEGER NOT NULL,
+    rewarded INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS user_tickets (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    source TEXT,
+    created_at TEXT,
+    used_in_raffle TEXT
+);
+
+CREATE TABLE IF NOT EXISTS raffles (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    status TEXT DEFAULT 'active',
+    winner_id INTEGER,
+    created_at TEXT,
+    extra TEXT
+);
+
+-- Лента изменений для нескольких процессов (SqliteStore.follow_changes)
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin INTEGER,
+    tbl TEXT NOT NULL,
+    key TEXT NOT NULL,
+    old TEXT,
+    new TEXT,
+    created_at REAL
+);
+
+-- Воркеры: статус доставки сообщений и общий лимит отправки (одна строка)
+CREATE TABLE IF NOT EXISTS delivery_status (
+    user_id INTEGER PRIMARY KEY,
+    flags INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS send_bucket (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_wishes_user_id ON wishes(user_id, position);
+CREATE INDEX IF NOT EXISTS idx_wishes_reserved ON wishes(reserved);
+CREATE INDEX IF NOT EXISTS idx_santa_participants_group ON santa_participants(group_id, position);
+CREATE INDEX IF NOT EXISTS idx_santa_participants_user ON santa_participants(user_id);
+CREATE INDEX IF NOT EXISTS idx_santa_groups_invite_code ON santa_groups(invite_code);
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+CREATE INDEX IF NOT EXISTS idx_user_tickets_user ON user_tickets(user_id);
+"""
+
+# Поля желания, у которых есть отдельная колонка (ключ в JSON -> колонка)
+WISH_COLUMNS = {
+    'name': 'name',
+    'description': 'description',
+    'price': 'price',
+    'currency': 'currency',
+    'url': 'url',
+    'photo': 'photo_url',
+    'reserved': 'reserved',
+    'reserved_by': 'reserved_by',
+    'createdAt': 'created_at',
+}
+
+USER_COLUMNS = {
+    'username': 'username',
+    'name': 'first_name',
+    'privacy': 'privacy',
+    'joined': 'created_at',
+}
+
+RAFFLE_COLUMNS = {
+    'title': 'title',
+    'status': 'status',
+    'winner_id': 'winner_id',
+    'created_at': 'created_at',
+}
+
+GROUP_COLUMNS = {
+    'name': 'name',
+    'admin_id': 'admin_id',
+    'budget': 'budget',
+    'date': 'event_date',
+    'shuffled': 'shuffled',
+    'invite_code': 'invite_code',
+}
+
+SQL_SELECT_USER = "SELECT telegram_id, username, first_name, privacy, created_at, extra FROM users WHERE telegram_id = ?"
+SQL_SELECT_WISHES = (
+    "SELECT id, name, description, price, currency, url, photo_url, reserved, reserved_by, created_at, extra "
+    "FROM wishes WHERE user_id = ? ORDER BY position"
+)
+SQL_SCAN_USERS = (
+    "SELECT telegram_id, username, first_name, privacy, created_at, extra FROM users "
+    "WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?"
+)
+SQL_SCAN_WISHES = (
+    "SELECT id, name, description, price, currency, url, photo_url, reserved, reserved_by, created_at, extra, user_id "
+    "FROM wishes WHERE user_id BETWEEN ? AND ? ORDER BY user_id, position"
+)
+SQL_UPSERT_USER = (
+    "INSERT INTO users (telegram_id, username, first_name, privacy, created_at, extra) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(telegram_id) DO UPDATE SET username = excluded.username, first_name = excluded.first_name, "
+    "privacy = excluded.privacy, created_at = excluded.created_at, extra = excluded.extra"
+)
+SQL_DELETE_WISHES = "DELETE FROM wishes WHERE user_id = ?"
+SQL_INSERT_WISH = (
+    "INSERT OR REPLACE INTO wishes (id, user_id, position, name, description, price, currency, url, photo_url, "
+    "reserved, reserved_by, created_at, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_UPDATE_WISH = (
+    "UPDATE wishes SET name = ?, description = ?, price = ?, currency = ?, url = ?, photo_url = ?, "
+    "reserved = ?, reserved_by = ?, created_at = ?, extra = ? WHERE id = ? AND user_id = ?"
+)
+SQL_DELETE_WISH = "DELETE FROM wishes WHERE id = ? AND user_id = ?"
+SQL_MIN_WISH_POSITION = "SELECT MIN(position) FROM wishes WHERE user_id = ?"
+SQL_UPDATE_WISH_POSITION = "UPDATE wishes SET position = ? WHERE id = ? AND user_id = ?"
+SQL_SELECT_GROUP = (
+    "SELECT id, name, admin_id, budget, event_date, shuffled, assignments, invite_code, extra "
+    "FROM santa_groups WHERE id = ?"
+)
+SQL_SCAN_GROUP_IDS = "SELECT id FROM santa_groups WHERE id > ? ORDER BY id LIMIT ?"
+SQL_SELECT_PARTICIPANTS = "SELECT user_id FROM santa_participants WHERE group_id = ? ORDER BY position"
+SQL_UPSERT_GROUP = (
+    "INSERT INTO santa_groups (id, name, admin_id, budget, event_date, shuffled, assignments, invite_code, extra) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET name = excluded.name, "
+    "admin_id = excluded.admin_id, budget = excluded.budget, event_date = excluded.event_date, "
+    "shuffled = excluded.shuffled, assignments = excluded.assignments, invite_code = excluded.invite_code, "
+    "extra = excluded.extra"
+)
+SQL_DELETE_PARTICIPANTS = "DELETE FROM santa_participants WHERE group_id = ?"
+SQL_INSERT_PARTICIPANT = (
+    "INSERT OR REPLACE INTO santa_participants (group_id, user_id, position, assigned_to) VALUES (?, ?, ?, ?)"
+)
+SQL_SELECT_REFERRAL = "SELECT referrer_id, rewarded FROM referrals WHERE referred_id = ?"
+SQL_SCAN_REFERRALS = (
+    "SELECT referred_id, referrer_id, rewarded FROM referrals WHERE referred_id > ? ORDER BY referred_id LIMIT ?"
+)
+SQL_SELECT_TICKET = "SELECT user_id, source, created_at, used_in_raffle FROM user_tickets WHERE id = ?"
+SQL_SELECT_UNUSED_TICKETS = (
+    "SELECT id, source, created_at FROM user_tickets "
+    "WHERE user_id = ? AND (used_in_raffle IS NULL OR used_in_raffle = '') ORDER BY created_at, id LIMIT ?"
+)
+SQL_USE_TICKET = "UPDATE user_tickets SET used_in_raffle = ? WHERE id = ?"
+SQL_UPSERT_TICKET = (
+    "INSERT INTO user_tickets (id, user_id, source, created_at, used_in_raffle) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET user_id = excluded.user_id, source = excluded.source, "
+    "created_at = excluded.created_at, used_in_raffle = excluded.used_in_raffle"
+)
+SQL_SCAN_TICKETS = (
+    "SELECT id, user_id, source, created_at, used_in_raffle FROM user_tickets WHERE id > ? ORDER BY id LIMIT ?"
+)
+SQL_SCAN_RAFFLES = (
+    "SELECT id, title, status, winner_id, created_at, extra FROM raffles WHERE id > ? ORDER BY id LIMIT ?"
+)
+SQL_SELECT_RAFFLE = "SELECT title, status, winner_id, created_at, extra FROM raffles WHERE id = ?"
+SQL_UPSERT_RAFFLE = (
+    "INSERT INTO raffles (id, title, status, winner_id, created_at, extra) VALUES (?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT(id) DO UPDATE SET title = excluded.title, status = excluded.status, "
+    "winner_id = excluded.winner_id, created_at = excluded.created_at, extra = excluded.extra"
+)
+SQL_UPSERT_REFERRAL = (
+    "INSERT INTO referrals (referred_id, referrer_id, rewarded) VALUES (?, ?, ?) "
+    "ON CONFLICT(referred_id) DO UPDATE SET referrer_id = excluded.referrer_id, rewarded = excluded.rewarded"
+)
+SQL_INSERT_CHANGE = "INSERT INTO changes (origin, tbl, key, old, new, created_at) VALUES (?, ?, ?, ?, ?, ?)"
+SQL_SELECT_CHANGES = "SELECT seq, tbl, key, old, new FROM changes WHERE seq > ? ORDER BY seq LIMIT ?"
+SQL_LAST_CHANGE = "SELECT COALESCE(MAX(seq), 0) FROM changes"
+SQL_UPSERT_DELIVERY = (
+    "INSERT INTO delivery_status (user_id, flags, delivered) VALUES (?, ?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET flags = excluded.flags, delivered = excluded.delivered"
+)
+SQL_SCAN_DELIVERY = "SELECT user_id, flags, delivered FROM delivery_status WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_SELECT_BUCKET = "SELECT tokens, updated, paused_until FROM send_bucket WHERE id = 0"
+SQL_UPSERT_BUCKET = "INSERT OR REPLACE INTO send_bucket (id, tokens, updated, paused_until) VALUES (0, ?, ?, ?)"
+SQL_PRUNE_CHANGES = "DELETE FROM changes WHERE created_at < ?"
+
+
+def _split_columns(record, columns, stored=()):
+    """Разделение записи на значения колонок и остаток для колонки extra.
+
+    stored - поля, которые хранятся не в extra (желания, участники группы).
+    NULL в колонке значит "поля нет", поэтому явный None уходит ещё и в
+    extra - запись читается обратно (и экспортируется) такой же, как была.
+    """
+    values = [record.get(key) for key in columns]
+    extra = {k: v for k, v in record.items() if k not in stored and (k not in columns or v is None)}
+    return values, extra
+
+
+def _merge_columns(record, columns, values, extra):
+    """Обратная сборка записи из колонок и extra"""
+    for key, value in zip(columns, values):
+        if value is not None:
+            record[key] = value
+    if extra:
+        record.update(json.loads(extra))
+    return record
+
+
+class SqliteStore(Storage):
+    """SQLite-хранилище в режиме WAL.
+
+    Запись идёт через один поток (SQLite допускает одного писателя),
+    чтение - через пул потоков со своими соединениями. Все SQL-запросы -
+    константы, поэтому sqlite3 переиспользует подготовленные выражения
+    из кэша соединения.
+
+    Если базу пишут несколько процессов (воркеры), follow_changes()
+    включает ленту изменений: каждая запись той же транзакцией добавляет
+    строку (таблица, ключ, старое, новое) в changes, а события подписчикам
+    всех процессов выдаются из ленты в порядке коммитов - индексы в памяти
+    каждого процесса видят одну и ту же последовательность изменений.
+    """
+
+    def __init__(self, path, readers=4):
+        super().__init__()
+        self.path = path
+        self.origin = None  # номер процесса в ленте изменений, None - лента выключена
+        self._seq = 0
+        self._sync_lock = None
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='sqlite-reader')
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def open(self):
+        conn = self._connection()
+        conn.executescript(SQLITE_SCHEMA)
+        if self.origin is not None:
+            # Изменения до старта уже в базе - индексы строятся по ней
+            self._seq = conn.execute(SQL_LAST_CHANGE).fetchone()[0]
+        return self
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def _connection(self):
+        """Соединение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, lambda: fn(self._connection(), *args))
+
+    async def _write(self, fn, *args):
+        def run():
+            conn = self._connection()
+            started = time.perf_counter()
+            try:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    return fn(conn, *args)
+            finally:
+                # Пишет только поток writer - счётчики без блокировки
+                self.io['writes'] += 1
+                self.io['write_seconds'] += time.perf_counter() - started
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, run)
+
+    # ===== Лента изменений =====
+
+    def follow_changes(self, origin):
+        """Режим нескольких процессов (до open): события - из ленты changes"""
+        self.origin = origin
+        self._sync_lock = asyncio.Lock()
+
+    def _logged(self, table, put):
+        """put(conn, key, record) -> old, плюс строка ленты в той же транзакции"""
+        if self.origin is None:
+            return put
+
+        def run(conn, key, record):
+            old = put(conn, key, record)
+            self._log_change(conn, table, key, old, record)
+            return old
+        return run
+
+    def _log_change(self, conn, table, key, old, new):
+        conn.execute(SQL_INSERT_CHANGE, (
+            self.origin, table, str(key),
+            json.dumps(old, ensure_ascii=False), json.dumps(new, ensure_ascii=False), time.time(),
+        ))
+
+    async def _changed(self, table, key, old, new):
+        """Событие об изменении: сразу или, в режиме ленты, по порядку из неё"""
+        if self.origin is None:
+            self._emit(table, key, old, new)
+        else:
+            await self.sync_changes()
+
+    async def sync_changes(self, batch=1000):
+        """События по новым строкам ленты (своим и чужим) в порядке seq"""
+        async with self._sync_lock:
+            while True:
+                rows = await self._read(lambda conn: conn.execute(SQL_SELECT_CHANGES, (self._seq, batch)).fetchall())
+                for seq, table, key, old, new in rows:
+                    self._seq = seq
+                    self._emit(table, key, json.loads(old), json.loads(new))
+                if len(rows) < batch:
+                    return
+
+    async def run_changes(self, interval=0.05, keep=600):
+        """Фоновая задача: чужие изменения из ленты, старые строки ленты удаляются"""
+        pruned = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync_changes()
+                if time.monotonic() - pruned > keep / 10:
+                    pruned = time.monotonic()
+                    await self._write(lambda conn: conn.execute(SQL_PRUNE_CHANGES, (time.time() - keep,)))
+            except Exception as e:
+                logger.error(f"Change feed sync failed: {e}")
+
+    # ===== Общее состояние воркеров =====
+
+    async def put_delivery(self, items):
+        """Статус доставки пачкой [(id пользователя, флаги, время доставки)].
+
+        Событие 'delivery' с новой записью {'flags', 'delivered'} получают
+        все процессы - так DeliveryStatus воркеров видят одни и те же флаги.
+        """
+        def run(conn):
+            conn.executemany(SQL_UPSERT_DELIVERY, [(int(uid), flags, delivered) for uid, flags, delivered in items])
+            if self.origin is not None:
+                for uid, flags, delivered in items:
+                    self._log_change(conn, 'delivery', uid, None, {'flags': flags, 'delivered': delivered})
+        await self._write(run)
+        if self.origin is not None:
+            await self.sync_changes()
+            return
+        for uid, flags, delivered in items:
+            self._emit('delivery', str(uid), None, {'flags': flags, 'delivered': delivered})
+
+    async def scan_delivery(self, batch=10000):
+        """Обход статусов доставки: (id пользователя, флаги, время доставки)"""
+        after = -2 ** 63
+        while True:
+            rows = await self._read(lambda conn: conn.execute(SQL_SCAN_DELIVERY, (after, batch)).fetchall())
+            if not rows:
+                return
+            for user_id, flags, delivered in rows:
+                yield str(user_id), flags, delivered
+            after = rows[-1][0]
+
+    async def take_token(self, rate, capacity):
+        """Токен общего token bucket: 0 - взят, иначе - сколько секунд ждать"""
+        def run(conn):
+            now = time.time()
+            row = conn.execute(SQL_SELECT_BUCKET).fetchone()
+            tokens, updated, paused_until = row or (capacity, now, 0.0)
+            if now < paused_until:
+                return paused_until - now
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            conn.execute(SQL_UPSERT_BUCKET, (tokens - 1, now, paused_until))
+            return 0
+        return await self._write(run)
+
+    async def pause_tokens(self, seconds):
+        """Пауза общего token bucket (после RetryAfter) для всех процессов"""
+        def run(conn):
+            now = time.time()
+            row = conn.execute(SQL_SELECT_BUCKET).fetchone()
+            paused_until = max(row[2] if row else 0.0, now + seconds)
+            conn.execute(SQL_UPSERT_BUCKET, (0.0, now, paused_until))
+        await self._write(run)
+
+    # ===== Пользователи и желания =====
+
+    @staticmethod
+    def _wish_from_row(row):
+        wish = _merge_columns({'id': row[0]}, WISH_COLUMNS, row[1:10], row[10])
+        if 'reserved' in wish:
+            wish['reserved'] = bool(wish['reserved'])
+        return wish
+
+    @classmethod
+    def _get_user(cls, conn, user_id):
+        row = conn.execute(SQL_SELECT_USER, (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        record = _merge_columns({}, USER_COLUMNS, row[1:5], row[5])
+        record['wishes'] = [cls._wish_from_row(w) for w in conn.execute(SQL_SELECT_WISHES, (int(user_id),))]
+        return record
+
+    @classmethod
+    def _scan_users_batch(cls, conn, after, batch):
+        """Пачка пользователей с telegram_id > after вместе с желаниями"""
+        rows = conn.execute(SQL_SCAN_USERS, (after, batch)).fetchall()
+        if not rows:
+            return []
+        records = {row[0]: _merge_columns({'wishes': []}, USER_COLUMNS, row[1:5], row[5]) for row in rows}
+        for w in conn.execute(SQL_SCAN_WISHES, (rows[0][0], rows[-1][0])):
+            records[w[11]]['wishes'].append(cls._wish_from_row(w))
+        return [(str(uid), record) for uid, record in records.items()]
+
+    @classmethod
+    def _put_user(cls, conn, user_id, record):
+        """Запись пользователя с желаниями, возвращает прежнюю запись"""
+        old = cls._get_user(conn, user_id)
+        uid = int(user_id)
+        values, extra = _split_columns(record, USER_COLUMNS, ('wishes',))
+        conn.execute(SQL_UPSERT_USER, (uid, *values, json.dumps(extra, ensure_ascii=False) if extra else None))
+        conn.execute(SQL_DELETE_WISHES, (uid,))
+        rows = []
+        for position, wish in enumerate(record.get('wishes', [])):
+            values, extra = _split_columns(wish, WISH_COLUMNS, ('id',))
+            # Желание без id получает стабильный ключ по позиции
+            wish_id = wish.get('id') or f"{uid}:{position}"
+            rows.append((str(wish_id), uid, position, *values,
+                         json.dumps(extra, ensure_ascii=False) if extra else None))
+        conn.executemany(SQL_INSERT_WISH, rows)
+        return old
+
+    @classmethod
+    def _patch_user(cls, conn, user_id, delta):
+        """Построчная запись изменения, возвращает (прежнюю запись, новую)"""
+        old = cls._get_user(conn, user_id)
+        record = apply_user_delta(old, delta)
+        if old is None:
+            cls._put_user(conn, user_id, record)
+            return old, record
+        uid = int(user_id)
+        if delta.get('set'):
+            values, extra = _split_columns(record, USER_COLUMNS, ('wishes',))
+            conn.execute(SQL_UPSERT_USER, (uid, *values, json.dumps(extra, ensure_ascii=False) if extra else None))
+        existing = {str(w.get('id')) for w in old.get('wishes', [])}
+        deleted = {str(wish_id) for wish_id in delta.get('delete', ())}
+        conn.executemany(SQL_DELETE_WISH, [(wish_id, uid) for wish_id in deleted])
+        added = []
+        for wish in delta.get('put', ()):
+            wish_id = str(wish['id'])
+            values, extra = _split_columns(wish, WISH_COLUMNS, ('id',))
+            values = (*values, json.dumps(extra, ensure_ascii=False) if extra else None)
+            if wish_id in existing:
+                if wish_id not in deleted:
+                    conn.execute(SQL_UPDATE_WISH, (*values, wish_id, uid))
+            elif wish_id not in deleted:
+                added.append((wish_id, values))
+        if added:
+            # Новые желания - в начало списка, перед текущим первым
+            first = conn.execute(SQL_MIN_WISH_POSITION, (uid,)).fetchone()[0] or 0
+            conn.executemany(SQL_INSERT_WISH, [
+                (wish_id, uid, first - len(added) + i, *values) for i, (wish_id, values) in enumerate(added)
+            ])
+        if delta.get('order'):
+            conn.executemany(SQL_UPDATE_WISH_POSITION, [
+                (position, str(w['id']), uid) for position, w in enumerate(record['wishes'])
+            ])
+        return old, record
+
+    async def get_user(self, user_id):
+        return await self._read(self._get_user, user_id)
+
+    async def patch_user(self, user_id, delta):
+        def patch(conn):
+            old, record = self._patch_user(conn, user_id, delta)
+            if self.origin is not None:
+                self._log_change(conn, 'users', user_id, old, record)
+            return old, record
+        old, record = await self._write(patch)
+        await self._changed('users', user_id, old, record)
+        return record
+
+    async def put_user(self, user_id, record):
+        old = await self._write(self._logged('users', self._put_user), user_id, record)
+        await self._changed('users', user_id, old, record)
+
+    async def get_users(self, user_ids):
+        def query(conn):
+            found = {}
+            for uid in user_ids:
+                record = self._get_user(conn, uid)
+                if record is not None:
+                    found[uid] = record
+            return found
+        return await self._read(query)
+
+    # ===== Группы Санты =====
+
+    @staticmethod
+    def _get_group(conn, group_id):
+        row = conn.execute(SQL_SELECT_GROUP, (group_id,)).fetchone()
+        if row is None:
+            return None
+        values = list(row[1:6]) + [row[7]]
+        record = _merge_columns({}, GROUP_COLUMNS, values, row[8])
+        if 'admin_id' in record:
+            record['admin_id'] = str(record['admin_id'])
+        record['shuffled'] = bool(row[5])
+        record['assignments'] = json.loads(row[6] or '{}')
+        record['participants'] = [str(r[0]) for r in conn.execute(SQL_SELECT_PARTICIPANTS, (group_id,))]
+        return record
+
+    @classmethod
+    def _put_group(cls, conn, group_id, record):
+        """Запись группы с участниками, возвращает прежнюю запись"""
+        old = cls._get_group(conn, group_id)
+        values, extra = _split_columns(record, GROUP_COLUMNS, ('participants', 'assignments'))
+        assignments = record.get('assignments') or {}
+        conn.execute(SQL_UPSERT_GROUP, (
+            group_id, values[0], values[1], values[2], values[3], int(bool(values[4])),
+            json.dumps(assignments, ensure_ascii=False), values[5],
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        ))
+        conn.execute(SQL_DELETE_PARTICIPANTS, (group_id,))
+        conn.executemany(SQL_INSERT_PARTICIPANT, [
+            (group_id, uid, position, assignments.get(uid))
+            for position, uid in enumerate(record.get('participants', []))
+        ])
+        return old
+
+    async def get_group(self, group_id):
+        return await self._read(self._get_group, group_id)
+
+    async def put_group(self, group_id, record):
+        old = await self._write(self._logged('groups', self._put_group), group_id, record)
+        await self._changed('groups', group_id, old, record)
+
+    # ===== Рефералы =====
+
+    @staticmethod
+    def _get_referral(conn, user_id):
+        row = conn.execute(SQL_SELECT_REFERRAL, (int(user_id),)).fetchone()
+        if row is None:
+            return None
+        return {'referrer': str(row[0]), 'rewarded': bool(row[1])}
+
+    async def get_referral(self, user_id):
+        return await self._read(self._get_referral, user_id)
+
+    @classmethod
+    def _put_referral(cls, conn, user_id, record):
+        old = cls._get_referral(conn, user_id)
+        conn.execute(SQL_UPSERT_REFERRAL, (int(user_id), record['referrer'], int(bool(record.get('rewarded')))))
+        return old
+
+    async def put_referral(self, user_id, record):
+        old = await self._write(self._logged('referrals', self._put_referral), user_id, record)
+        await self._changed('referrals', user_id, old, record)
+
+    # ===== Билеты =====
+
+    @staticmethod
+    def _get_ticket(conn, ticket_id):
+        row = conn.execute(SQL_SELECT_TICKET, (ticket_id,)).fetchone()
+        if row is None:
+            return None
+        return {'user_id': str(row[0]), 'source': row[1], 'created_at': row[2], 'used_in_raffle': row[3]}
+
+    async def get_ticket(self, ticket_id):
+        return await self._read(self._get_ticket, ticket_id)
+
+    @classmethod
+    def _put_ticket(cls, conn, ticket_id, record):
+        old = cls._get_ticket(conn, ticket_id)
+        conn.execute(SQL_UPSERT_TICKET, (
+            ticket_id, int(record['user_id']), record.get('source'),
+            record.get('created_at'), record.get('used_in_raffle')
+        ))
+        return old
+
+    async def put_ticket(self, ticket_id, record):
+        old = await self._write(self._logged('tickets', self._put_ticket), ticket_id, record)
+        await self._changed('tickets', ticket_id, old, record)
+
+    # ===== Розыгрыши =====
+
+    @staticmethod
+    def _get_raffle(conn, raffle_id):
+        row = conn.execute(SQL_SELECT_RAFFLE, (raffle_id,)).fetchone()
+        if row is None:
+            return None
+        return _merge_columns({}, RAFFLE_COLUMNS, row[:4], row[4])
+
+    async def get_raffle(self, raffle_id):
+        return await self._read(self._get_raffle, raffle_id)
+
+    @classmethod
+    def _put_raffle(cls, conn, raffle_id, record):
+        old = cls._get_raffle(conn, raffle_id)
+        values, extra = _split_columns(record, RAFFLE_COLUMNS)
+        conn.execute(SQL_UPSERT_RAFFLE, (raffle_id, *values, json.dumps(extra, ensure_ascii=False) if extra else None))
+        return old
+
+    async def put_raffle(self, raffle_id, record):
+        old = await self._write(self._logged('raffles', self._put_raffle), raffle_id, record)
+        await self._changed('raffles', raffle_id, old, record)
+
+    async def complete_raffle(self, raffle_id, record, counts):
+        def run(conn):
+            spent = []
+            for user_id, tickets in counts.items():
+                for ticket_id, source, created_at in conn.execute(SQL_SELECT_UNUSED_TICKETS, (int(user_id), tickets)):
+                    ticket = {'user_id': str(user_id), 'source': source, 'created_at': created_at, 'used_in_raffle': None}
+                    spent.append((ticket_id, ticket, dict(ticket, used_in_raffle=raffle_id)))
+            conn.executemany(SQL_USE_TICKET, [(raffle_id, ticket_id) for ticket_id, _, _ in spent])
+            old = self._put_raffle(conn, raffle_id, record)
+            if self.origin is not None:
+                for ticket_id, ticket, new in spent:
+                    self._log_change(conn, 'tickets', ticket_id, ticket, new)
+                self._log_change(conn, 'raffles', raffle_id, old, record)
+            return spent, old
+        spent, old = await self._write(run)
+        if self.origin is not None:
+            await self.sync_changes()
+            return
+        for ticket_id, ticket, new in spent:
+            self._emit('tickets', ticket_id, ticket, new)
+        self._emit('raffles', raffle_id, old, record)
+
+    async def put_many(self, table, items):
+        # Вся пачка - одна транзакция
+        put = self._logged(table, getattr(self, f"_put_{RECORD_NAMES[table]}"))
+        olds = await self._write(lambda conn: [put(conn, key, record) for key, record in items])
+        if self.origin is not None:
+            await self.sync_changes()
+            return
+        for (key, record), old in zip(items, olds):
+            self._emit(table, key, old, record)
+
+    # ===== Выборки =====
+
+    async def user_ids(self):
+        def query(conn):
+            return [str(r[0]) for r in conn.execute("SELECT telegram_id FROM users")]
+        return await self._read(query)
+
+    async def scan_users(self, batch=1000):
+        after = -2 ** 63
+        while True:
+            rows = await self._read(self._scan_users_batch, after, batch)
+            if not rows:
+                return
+            for item in rows:
+                yield item
+            after = int(rows[-1][0])
+
+    async def scan_groups(self, batch=1000):
+        def query(conn, after):
+            ids = [r[0] for r in conn.execute(SQL_SCAN_GROUP_IDS, (after, batch))]
+            return [(group_id, self._get_group(conn, group_id)) for group_id in ids]
+        after = ''
+        while True:
+            rows = await self._read(query, after)
+            if not rows:
+                return
+            for item in rows:
+                yield item
+            after = rows[-1][0]
+
+    async def scan_referrals(self, batch=1000):
+        after = -2 ** 63
+        while True:
+            rows = await self._read(lambda conn: conn.execute(SQL_SCAN_REFERRALS, (after, batch)).fetchall())
+            if not rows:
+                return
+            for referred, referrer, rewarded in rows:
+                yield str(referred), {'referrer': str(referrer), 'rewarded': bool(rewarded)}
+            after = rows[-1][0]
+
+    async def scan_tickets(self, batch=1000):
+        after = ''
+        while True:
+            rows = await self._read(lambda conn: conn.execute(SQL_SCAN_TICKETS, (after, batch)).fetchall())
+            if not rows:
+                return
+            for ticket_id, user_id, source, created_at, used_in_raffle in rows:
+                yield ticket_id, {'user_id': str(user_id), 'source': source, 'created_at': created_at,
+                                  'used_in_raffle': used_in_raffle}
+            after = rows[-1][0]
+
+    async def scan_raffles(self, batch=1000):
+        after = ''
+        while True:
+            rows = await self._read(lambda conn: conn.execute(SQL_SCAN_RAFFLES, (after, batch)).fetchall())
+            if not rows:
+                return
+            for row in rows:
+                yield row[0], _merge_columns({}, RAFFLE_COLUMNS, row[1:5], row[5])
+            after = rows[-1][0]
+
+    async def counts(self):
+        def query(conn):
+            wishes, reserved = conn.execute("SELECT COUNT(*), COALESCE(SUM(reserved), 0) FROM wishes").fetchone()
+            groups, shuffled = conn.execute("SELECT COUNT(*), COALESCE(SUM(shuffled), 0) FROM santa_groups").fetchone()
+            referrals, rewarded = conn.execute("SELECT COUNT(*), COALESCE(SUM(rewarded), 0) FROM referrals").fetchone()
+            joins = dict(conn.execute(
+                "SELECT substr(created_at, 1, 10), COUNT(*) FROM users WHERE created_at IS NOT NULL GROUP BY 1"
+            ))
+            return {
+                'users': conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+                'wishes': wishes,
+                'reserved': reserved,
+                'groups': groups,
+                'shuffled': shuffled,
+                'referrals': referrals,
+                'referrals_pending': referrals - rewarded,
+                'joins': joins,
+            }
+        return await self._read(query)
@@ -0,0 +1,140 @@
+"""
+Картинки для Stories на сервере
+
+Картинка собирается из шаблона story-bg.svg и вишлиста пользователя и
+растеризуется в PNG в отдельном процессе, поэтому цикл событий не ждёт
+работы с изображением. Готовый PNG хранится на диске под ключом
+sha256(версия шаблона, содержимое картинки), а file_id загруженного фото -
+в MediaCache под тем же ключом: пока вишлист не изменился, картинка не
+рисуется и не загружается заново.
+
+Растеризация требует cairosvg (pip install cairosvg). Без него
+StoryRenderer.available == False и бот отправляет картинку из приложения.
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+logger = logging.getLogger(__name__)
+
+# Меняется вместе с разметкой render_svg - старые картинки перестают совпадать
+RENDERER_VERSION = 1
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'story-bg.svg')
+
+STORY_WISHES = 5  # сколько желаний показывать на картинке
+MAX_NAME_LENGTH = 40
+
+
+def _rasterize(svg):
+    """SVG -> PNG, выполняется в процессе пула"""
+    return cairosvg.svg2png(bytestring=svg.encode('utf-8'))
+
+
+def _truncate(text, limit):
+    text = ' '.join(str(text or '').split())
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def story_content(user):
+    """Данные вишлиста, которые попадают на картинку"""
+    wishes = (user or {}).get('wishes', [])
+    return {
+        'name': _truncate((user or {}).get('name'), MAX_NAME_LENGTH),
+        'wishes': [_truncate(w.get('name') or 'Желание', MAX_NAME_LENGTH) for w in wishes[:STORY_WISHES]],
+        'more': max(0, len(wishes) - STORY_WISHES),
+    }
+
+
+class StoryRenderer:
+    """Отрисовка картинок Stories в пуле процессов с кэшем по содержимому"""
+
+    def __init__(self, cache_dir, media, workers=2, max_files=1000, template_path=TEMPLATE_FILE):
+        self.cache_dir = cache_dir
+        self.media = media
+        self.workers = workers
+        self.max_files = max_files
+        self._executor = None
+        with open(template_path, 'r', encoding='utf-8') as f:
+            self.template = f.read()
+        self.version = f"{RENDERER_VERSION}:{hashlib.sha256(self.template.encode('utf-8')).hexdigest()[:16]}"
+
+    @property
+    def available(self):
+        return cairosvg is not None
+
+    def key(self, content):
+        payload = json.dumps([self.version, content], ensure_ascii=False, sort_keys=True)
+        return 'story:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def render_svg(self, content):
+        """Шаблон с именем и списком желаний"""
+        subtitle = f"Вишлист {content['name']}" if content['name'] else 'Мой вишлист'
+        svg = self.template.replace('>Мой вишлист<', f">{escape(subtitle)}<", 1)
+        lines = [f"🎁 {name}" for name in content['wishes']]
+        if content['more']:
+            lines.append(f"и ещё {content['more']}…")
+        items = ''.join(
+            f'\n  <text x="540" y="{1320 + i * 80}" text-anchor="middle" fill="white" '
+            f'font-size="44" font-family="system-ui">{escape(line)}</text>'
+            for i, line in enumerate(lines)
+        )
+        return svg.replace('</svg>', items + '\n</svg>', 1)
+
+    async def _png(self, key, content):
+        """PNG с диска или из пула процессов"""
+        path = os.path.join(self.cache_dir, key.split(':', 1)[1] + '.png')
+        try:
+            return await asyncio.to_thread(_read_file, path)
+        except FileNotFoundError:
+            pass
+        if self._executor is None:
+            # spawn, а не fork: в боте уже работают потоки (SQLite, журнал, пулы),
+            # копия их блокировок в дочернем процессе может остаться занятой навсегда
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        loop = asyncio.get_running_loop()
+        png = await loop.run_in_executor(self._executor, _rasterize, self.render_svg(content))
+        try:
+            await asyncio.to_thread(self._store, path, png)
+        except OSError as e:
+            logger.error(f"Story cache write failed: {e}")
+        return png
+
+    def _store(self, path, png):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+        # Самые старые картинки удаляем, когда их больше max_files
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.png')]
+        if len(files) > self.max_files:
+            files.sort(key=os.path.getmtime)
+            for old in files[:len(files) - self.max_files]:
+                os.remove(old)
+
+    async def send(self, bot, chat_id, user, **kwargs):
+        """Отправка картинки вишлиста, возвращает file_id"""
+        content = story_content(user)
+        key = self.key(content)
+        return await self.media.send_photo(bot, chat_id, lambda: self._png(key, content), digest=key, **kwargs)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
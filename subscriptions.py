@@ -0,0 +1,92 @@
+"""
+Проверка подписки на каналы
+
+Статус участника канала кэшируется: подписка - надолго, её отсутствие и
+ошибки (канал не найден, бот не админ) - ненадолго, чтобы пользователь,
+который только что подписался, не ждал. Одновременные проверки одной
+пары (канал, пользователь) ждут один общий запрос get_chat_member.
+Запросы к Telegram идут под общим token bucket.
+"""
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from broadcast import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
+
+class SubscriptionCache:
+    """TTL-кэш статусов подписки с общим запросом на ключ"""
+
+    def __init__(self, ttl=600, negative_ttl=15, error_ttl=60, max_entries=100000, rate=20):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self.bucket = TokenBucket(rate)
+        self._entries = OrderedDict()  # (канал, user_id) -> (подписан или исключение, истекает)
+        self._inflight = {}  # (канал, user_id) -> задача запроса
+
+    def invalidate(self, channel, user_id):
+        self._entries.pop((channel, user_id), None)
+
+    async def is_subscribed(self, bot, channel, user_id):
+        """True/False; ошибку Telegram пробрасывает (тоже из кэша)"""
+        key = (channel, user_id)
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                if isinstance(value, Exception):
+                    raise value
+                return value
+            del self._entries[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(bot, channel, user_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос для остальных
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, channel, user_id):
+        await self.bucket.acquire()
+        try:
+            member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+        except Exception as e:
+            self._store((channel, user_id), e, self.error_ttl)
+            raise
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        self._store((channel, user_id), subscribed, self.ttl if subscribed else self.negative_ttl)
+        return subscribed
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def verify_many(self, bot, user_id, channels, concurrency=5):
+        """Проверка одного пользователя по списку каналов параллельно.
+
+        Возвращает {канал: True/False/None}, None - ошибка проверки.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def check(channel):
+            async with semaphore:
+                try:
+                    return await self.is_subscribed(bot, channel, user_id)
+                except Exception as e:
+                    logger.error(f"Check subscription error for {channel}: {e}")
+                    return None
+
+        channels = list(dict.fromkeys(channels))
+        results = await asyncio.gather(*(check(channel) for channel in channels))
+        return dict(zip(channels, results))
@@ -0,0 +1,56 @@
+"""
+Проверки ограничения частоты запросов
+
+    python -m unittest test_flood
+"""
+
+import unittest
+from flood import FloodControl
+
+
+class FloodControlTest(unittest.TestCase):
+
+    def test_burst_then_rejection(self):
+        flood = FloodControl(rate=1.0, burst=3)
+        self.assertEqual([flood.acquire(1, 'message', now=0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(flood.acquire(1, 'message', now=0), 1.0)
+        # Лимит другого пользователя не тронут
+        self.assertEqual(flood.acquire(2, 'message', now=0), 0)
+
+    def test_refill(self):
+        flood = FloodControl(rate=2.0, burst=2)
+        flood.acquire(1, 'message', now=0)
+        flood.acquire(1, 'message', now=0)
+        self.assertAlmostEqual(flood.acquire(1, 'message', now=0.25), 0.25)
+        self.assertEqual(flood.acquire(1, 'message', now=0.5), 0)
+        # Больше burst не накапливается
+        for _ in range(2):
+            self.assertEqual(flood.acquire(1, 'message', now=100), 0)
+        self.assertGreater(flood.acquire(1, 'message', now=100), 0)
+
+    def test_expensive_action_has_own_bucket(self):
+        flood = FloodControl(rate=1.0, burst=10, costs={'share': 6})
+        self.assertEqual(flood.acquire(1, 'share', now=0), 0)
+        self.assertAlmostEqual(flood.acquire(1, 'share', now=0), 2.0)
+        # Отказ в дорогом действии не мешает обычным сообщениям
+        self.assertEqual(flood.acquire(1, 'message', now=0), 0)
+        self.assertEqual(flood.acquire(1, 'share', now=2), 0)
+
+    def test_warns_once_per_wait(self):
+        flood = FloodControl(rate=1.0, burst=1)
+        flood.acquire(1, 'message', now=0)
+        wait = flood.acquire(1, 'message', now=0)
+        self.assertTrue(flood.should_warn(1, wait, now=0))
+        self.assertFalse(flood.should_warn(1, wait, now=0.5))
+        self.assertTrue(flood.should_warn(1, wait, now=wait))
+
+    def test_evicts_oldest_users(self):
+        flood = FloodControl(max_users=2)
+        for user_id in (1, 2, 3):
+            flood.acquire(user_id, 'message', now=0)
+        self.assertEqual(flood.tracked(), 2)
+        self.assertNotIn(1, flood._users)
+
+
+if __name__ == '__main__':
+    unittest.main()
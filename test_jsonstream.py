@@ -0,0 +1,56 @@
+"""
+Проверки потокового чтения JSON-снимка
+
+    python -m unittest test_jsonstream
+"""
+
+import io
+import json
+import unittest
+from jsonstream import JsonStream
+
+SNAPSHOT = {
+    'users': {
+        '1': {'name': 'Аня', 'wishes': [{'id': 'w1', 'name': 'Книга "Сад"', 'price': 1234567}]},
+        '22': {'name': 'B', 'wishes': [], 'score': -0.125e3},
+    },
+    'version': 3,
+    'groups': {},
+    'tickets': {'t1': {'user_id': 1, 'used': False, 'note': None}},
+}
+
+
+def read_all(text, chunk_size):
+    return list(JsonStream(io.StringIO(text), chunk_size=chunk_size).records())
+
+
+class JsonStreamTest(unittest.TestCase):
+
+    def expected(self):
+        return [(table, key, record)
+                for table, records in SNAPSHOT.items() if isinstance(records, dict)
+                for key, record in records.items()]
+
+    def test_every_chunk_boundary(self):
+        # Граница куска попадает внутрь строк, чисел, ключей и пробелов
+        for text in (json.dumps(SNAPSHOT, ensure_ascii=False),
+                     json.dumps(SNAPSHOT, ensure_ascii=False, indent=2)):
+            for chunk_size in range(1, 40):
+                self.assertEqual(read_all(text, chunk_size), self.expected(), chunk_size)
+
+    def test_number_at_end_of_chunk(self):
+        text = '{"users": {"1": 12345, "2": 6}}'
+        for chunk_size in range(1, len(text) + 1):
+            self.assertEqual(read_all(text, chunk_size), [('users', '1', 12345), ('users', '2', 6)])
+
+    def test_empty_snapshot(self):
+        self.assertEqual(read_all(' { } ', 1), [])
+
+    def test_truncated_file(self):
+        text = json.dumps(SNAPSHOT)[:-10]
+        with self.assertRaises(ValueError):
+            read_all(text, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Проверки розыгрыша по билетам
+
+    python -m unittest test_raffle
+"""
+
+import random
+import unittest
+from raffle import FenwickTree, RaffleError, draw_winners, run_raffle
+
+
+class FenwickTreeTest(unittest.TestCase):
+
+    def test_find_matches_linear_scan(self):
+        rng = random.Random(0)
+        weights = [rng.randrange(0, 5) for _ in range(200)]
+        tree = FenwickTree(weights)
+        for _ in range(30):
+            index = rng.randrange(len(weights))
+            tree.add(index, -weights[index])
+            weights[index] = 0
+            self.assertEqual(tree.total, sum(weights))
+            # r из отрезка [начало, конец) элемента i находит i
+            start = 0
+            for i, weight in enumerate(weights):
+                if weight:
+                    self.assertEqual(tree.find(start), i)
+                    self.assertEqual(tree.find(start + weight - 1), i)
+                start += weight
+
+    def test_removed_element_is_never_found(self):
+        tree = FenwickTree([3, 1, 2])
+        tree.add(0, -3)
+        self.assertEqual(tree.total, 3)
+        self.assertEqual([tree.find(r) for r in range(tree.total)], [1, 2, 2])
+
+
+class DrawWinnersTest(unittest.TestCase):
+
+    def test_same_seed_same_result(self):
+        weights = [5, 1, 0, 7, 3, 2]
+        first = draw_winners(weights, 3, seed=42)
+        self.assertEqual(first, draw_winners(weights, 3, seed=42))
+        self.assertEqual(len(set(first)), 3)
+        self.assertNotIn(2, first)
+
+    def test_all_participants_win_once(self):
+        self.assertEqual(sorted(draw_winners([1, 2, 3], 3, seed=7)), [0, 1, 2])
+
+    def test_too_many_winners(self):
+        with self.assertRaises(RaffleError):
+            draw_winners([1, 2], 3, seed=0)
+        with self.assertRaises(RaffleError):
+            draw_winners([1, 2], 0, seed=0)
+
+    def test_protocol_is_reproducible(self):
+        counts = {30: 2, 10: 5, 20: 1}
+        result = run_raffle(counts, 2, seed=123)
+        again = run_raffle(dict(reversed(list(counts.items()))), 2, seed=result['seed'])
+        self.assertEqual(result['winners'], again['winners'])
+        self.assertEqual(result['snapshot_sha256'], again['snapshot_sha256'])
+        self.assertEqual(result['total_tickets'], 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
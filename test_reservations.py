@@ -0,0 +1,86 @@
+"""
+Проверки резервирования желаний
+
+    python -m unittest test_reservations
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+import unittest
+import storage
+from concurrency import KeyedLocks
+from indexes import WishIndex
+from reservations import ReservationError, Reservations
+
+
+class ReservationsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = storage.JournalStore(os.path.join(self.tmp.name, 'data.json')).open()
+        self.index = WishIndex()
+        self.store.subscribe(self.index.on_change)
+        await self.store.put_user('1', {'name': 'A', 'wishes': [
+            {'id': 'w1', 'name': 'Книга', 'reserved': False},
+            {'id': 'w2', 'name': 'Чай', 'reserved': False},
+        ]})
+        self.reservations = Reservations(self.store, KeyedLocks(), self.index, ttl=60)
+
+    async def asyncTearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    async def wish(self, wish_id):
+        user = await self.store.get_user('1')
+        return next(w for w in user['wishes'] if w['id'] == wish_id)
+
+    async def test_only_one_concurrent_reserve_wins(self):
+        results = await asyncio.gather(
+            *(self.reservations.reserve('1', 'w1', user_id) for user_id in (2, 3, 4, 5)),
+            return_exceptions=True,
+        )
+        winners = [r for r in results if not isinstance(r, ReservationError)]
+        self.assertEqual(len(winners), 1)
+        wish = await self.wish('w1')
+        self.assertEqual(wish['reserved_by'], winners[0]['reserved_by'])
+        # Соседнее желание не тронуто
+        self.assertFalse((await self.wish('w2'))['reserved'])
+
+    async def test_cannot_reserve_own_or_missing_wish(self):
+        with self.assertRaises(ReservationError):
+            await self.reservations.reserve('1', 'w1', 1)
+        with self.assertRaises(ReservationError):
+            await self.reservations.reserve('1', 'w9', 2)
+        with self.assertRaises(ReservationError):
+            await self.reservations.reserve('7', 'w1', 2)
+
+    async def test_unreserve(self):
+        await self.reservations.reserve('1', 'w1', 2)
+        with self.assertRaises(ReservationError):
+            await self.reservations.unreserve('1', 'w1', 3)
+        await self.reservations.unreserve('1', 'w1', 2)
+        wish = await self.wish('w1')
+        self.assertFalse(wish['reserved'])
+        self.assertNotIn('reserved_by', wish)
+        with self.assertRaises(ReservationError):
+            await self.reservations.unreserve('1', 'w1', 2)
+        # Снятый резерв можно поставить заново
+        await self.reservations.reserve('1', 'w1', 3)
+
+    async def test_expired_reservation_is_swept(self):
+        await self.reservations.reserve('1', 'w1', 2)
+        self.assertEqual(await self.reservations.sweep(time.time()), 0)
+        self.assertEqual(await self.reservations.sweep(time.time() + 61), 1)
+        self.assertFalse((await self.wish('w1'))['reserved'])
+        # Просроченный, но ещё не снятый резерв не мешает новому
+        await self.reservations.reserve('1', 'w2', 2)
+        wish = dict(await self.wish('w2'), reserved_until=time.time() - 1)
+        await self.store.put_user('1', {'name': 'A', 'wishes': [await self.wish('w1'), wish]})
+        await self.reservations.reserve('1', 'w2', 3)
+        self.assertEqual((await self.wish('w2'))['reserved_by'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Проверки жеребьёвки Тайного Санты
+
+    python -m unittest test_santa
+"""
+
+import random
+import unittest
+from santa import EXACT_SEARCH_LIMIT, SantaDrawError, build_exclusions, draw, valid_group_id
+
+
+class DrawTest(unittest.TestCase):
+
+    def check(self, participants, assignments, excluded=frozenset()):
+        people = {str(p) for p in participants}
+        self.assertEqual(set(assignments), people)
+        self.assertEqual(set(assignments.values()), people)
+        for giver, receiver in assignments.items():
+            self.assertNotEqual(giver, receiver)
+            self.assertNotIn((giver, receiver), excluded)
+
+    def test_small_group_honours_exclusions(self):
+        participants = ['1', '2', '3', '4']
+        excluded = build_exclusions([['1', '2'], [3, 4]], previous={'1': '3'})
+        for seed in range(50):
+            self.check(participants, draw(participants, excluded, random.Random(seed)), excluded)
+
+    def test_large_group_honours_exclusions(self):
+        participants = [str(i) for i in range(500)]
+        couples = [[str(i), str(i + 1)] for i in range(0, 500, 2)]
+        previous = {str(i): str((i + 7) % 500) for i in range(500)}
+        excluded = build_exclusions(couples, previous)
+        self.assertGreater(len(participants), EXACT_SEARCH_LIMIT)
+        self.check(participants, draw(participants, excluded, random.Random(1)), excluded)
+
+    def test_infeasible_constraints(self):
+        # Пара из двух человек может дарить только друг другу
+        with self.assertRaises(SantaDrawError):
+            draw(['1', '2'], build_exclusions([['1', '2']]), random.Random(0))
+        # Первый не может дарить никому
+        excluded = build_exclusions(previous={'1': '2'}) | {('1', '3')}
+        with self.assertRaises(SantaDrawError):
+            draw(['1', '2', '3'], excluded, random.Random(0))
+
+    def test_too_few_participants(self):
+        with self.assertRaises(SantaDrawError):
+            draw(['1', '1'])
+
+    def test_group_id(self):
+        self.assertTrue(valid_group_id('bench42_a-b'))
+        for group_id in (None, '', 42, 'a b', 'x' * 59, 'группа'):
+            self.assertFalse(valid_group_id(group_id), group_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Проверки хранилищ
+
+    python -m unittest test_storage
+"""
+
+import os
+import tempfile
+import unittest
+import storage
+
+
+class WishIdCollisionTest(unittest.IsolatedAsyncioTestCase):
+    """id желаний задаёт клиент - одинаковые id у разных пользователей не пересекаются"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def check_collision(self, store):
+        events = []
+        store.subscribe(lambda table, key, old, new: events.append(key))
+        await store.put_user('1', {'name': 'A', 'wishes': [{'id': 'w1', 'name': 'Книга'}]})
+        await store.put_user('2', {'name': 'B', 'wishes': [{'id': 'w1', 'name': 'Чай'}]})
+        await store.patch_user('2', {'put': [{'id': 'w1', 'name': 'Кофе'}]})
+
+        user_a = await store.get_user('1')
+        user_b = await store.get_user('2')
+        self.assertEqual(user_a['wishes'], [{'id': 'w1', 'name': 'Книга'}])
+        self.assertEqual(user_b['wishes'], [{'id': 'w1', 'name': 'Кофе'}])
+        self.assertEqual(events, ['1', '2', '2'])
+
+    async def test_sqlite(self):
+        store = storage.SqliteStore(os.path.join(self.tmp.name, 'giftly.db')).open()
+        try:
+            await self.check_collision(store)
+        finally:
+            store.close()
+
+    async def test_journal(self):
+        store = storage.JournalStore(os.path.join(self.tmp.name, 'data.json')).open()
+        try:
+            await self.check_collision(store)
+        finally:
+            store.close()
+
+
+class CompleteRaffleTest(unittest.IsolatedAsyncioTestCase):
+    """Розыгрыш тратит билеты из снимка, выданные позже остаются"""
+
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    async def asyncTearDown(self):
+        self.tmp.cleanup()
+
+    async def check_spent(self, store):
+        for i in range(6):
+            await store.put_ticket(f"t{i}", {'user_id': str(i % 2 + 1), 'source': 'referral',
+                                             'created_at': i, 'used_in_raffle': None})
+        counts = {1: 3, 2: 3}
+        await store.put_ticket('late', {'user_id': '1', 'source': 'referral', 'created_at': 9, 'used_in_raffle': None})
+        await store.complete_raffle('r1', {'title': 'Розыгрыш', 'status': 'completed'}, counts)
+
+        unused = [key async for key, ticket in store.scan_tickets() if not ticket.get('used_in_raffle')]
+        self.assertEqual(unused, ['late'])
+        self.assertEqual((await store.get_raffle('r1'))['status'], 'completed')
+
+    async def test_sqlite(self):
+        store = storage.SqliteStore(os.path.join(self.tmp.name, 'giftly.db')).open()
+        try:
+            await self.check_spent(store)
+        finally:
+            store.close()
+
+    async def test_journal(self):
+        path = os.path.join(self.tmp.name, 'data.json')
+        store = storage.JournalStore(path).open()
+        try:
+            await self.check_spent(store)
+        finally:
+            store.close()
+        # Индекс неиспользованных билетов строится заново при загрузке
+        store = storage.JournalStore(path).open()
+        try:
+            self.assertEqual(store._unused_tickets, {1: {'late': None}})
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
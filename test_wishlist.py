@@ -0,0 +1,78 @@
+"""
+Проверки синхронизации вишлиста операциями
+
+    python -m unittest test_wishlist
+"""
+
+import unittest
+from storage import apply_user_delta
+from wishlist import APPLIED, CONFLICT, DUPLICATE, INVALID, plan_ops
+
+
+def user(*wishes):
+    return {'name': 'A', 'wishes': list(wishes)}
+
+
+class PlanOpsTest(unittest.TestCase):
+
+    def test_update_with_current_version(self):
+        record = user({'id': 'w1', 'name': 'Книга', 'version': 2})
+        delta, results = plan_ops(record, [
+            {'op_id': 'o1', 'op': 'update', 'wish_id': 'w1', 'version': 2, 'fields': {'name': 'Альбом'}},
+        ])
+        self.assertEqual(results, [{'op_id': 'o1', 'status': APPLIED, 'version': 3}])
+        self.assertEqual(apply_user_delta(record, delta)['wishes'],
+                         [{'id': 'w1', 'name': 'Альбом', 'version': 3, 'op_id': 'o1'}])
+
+    def test_stale_version_conflicts(self):
+        record = user({'id': 'w1', 'name': 'Книга', 'version': 3})
+        delta, results = plan_ops(record, [
+            {'op_id': 'o1', 'op': 'update', 'wish_id': 'w1', 'version': 2, 'fields': {'name': 'Альбом'}},
+            {'op_id': 'o2', 'op': 'delete', 'wish_id': 'w1', 'version': 1},
+        ])
+        self.assertEqual(delta, {})
+        self.assertEqual([r['status'] for r in results], [CONFLICT, CONFLICT])
+        self.assertEqual([r['version'] for r in results], [3, 3])
+
+    def test_repeated_op_id_is_not_applied_twice(self):
+        record = user()
+        ops = [{'op_id': 'o1', 'op': 'add', 'wish': {'id': 'w1', 'name': 'Книга'}}]
+        delta, results = plan_ops(record, ops)
+        self.assertEqual(results[0]['status'], APPLIED)
+        record = apply_user_delta(record, delta)
+
+        delta, results = plan_ops(record, ops)
+        self.assertEqual(delta, {})
+        self.assertEqual(results, [{'op_id': 'o1', 'status': DUPLICATE, 'version': 1}])
+
+        update = {'op_id': 'o2', 'op': 'update', 'wish_id': 'w1', 'version': 1, 'fields': {'price': 500}}
+        record = apply_user_delta(record, plan_ops(record, [update])[0])
+        delta, results = plan_ops(record, [update])
+        self.assertEqual(delta, {})
+        self.assertEqual(results[0]['status'], DUPLICATE)
+
+    def test_server_fields_are_ignored(self):
+        delta, _ = plan_ops(user(), [
+            {'op_id': 'o1', 'op': 'add', 'wish': {'id': 'w1', 'name': 'Книга', 'reserved': True, 'version': 9}},
+        ])
+        self.assertEqual(delta['put'], [{'id': 'w1', 'name': 'Книга', 'version': 1, 'op_id': 'o1', 'reserved': False}])
+
+    def test_malformed_ops_are_rejected(self):
+        record = user({'id': 'w1', 'name': 'Книга', 'version': 1})
+        delta, results = plan_ops(record, [
+            'not an op',
+            {'op': 'add', 'wish': {'id': 'w2'}},
+            {'op_id': 'o1', 'op': 'add', 'wish': 'Книга'},
+            {'op_id': 'o2', 'op': 'update', 'wish_id': 'w1', 'version': 1, 'fields': ['name']},
+            {'op_id': 'o3', 'op': 'reorder', 'order': 'w1'},
+            {'op_id': 'o4', 'op': 'rename'},
+        ])
+        self.assertEqual(delta, {})
+        self.assertEqual([r['status'] for r in results], [INVALID] * 6)
+
+    def test_ops_is_not_a_list(self):
+        self.assertEqual(plan_ops(user(), {'op': 'add'}), ({}, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
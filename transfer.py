@@ -0,0 +1,144 @@
+"""
+Перенос данных data.json <-> SQL
+
+    python bot.py import data.json sqlite:giftly.db
+    python bot.py export sqlite:giftly.db backup.json
+
+data.json читается потоком: разбирается по одной записи таблицы за раз,
+записи уходят в хранилище пачками (Storage.put_many - одна транзакция на
+пачку, запись - upsert). Экспорт обходит таблицы пачками (scan_*) и пишет
+JSON того же формата, что снапшот JournalStore. Память не зависит от
+размера данных: буфер чтения, одна запись и одна пачка.
+"""
+
+import os
+import json
+import time
+import asyncio
+from storage import TABLES, create_storage
+from jsonstream import JsonStream
+
+BATCH_SIZE = 1000
+
+
+class TransferError(Exception):
+    """Перенос невозможен - текст для консоли"""
+
+
+class Progress:
+    """Отчёт о ходе переноса не чаще раза в interval секунд"""
+
+    def __init__(self, total_bytes=None, interval=1.0, report=print):
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.report = report
+        self.counts = {}
+        self.started = time.perf_counter()
+        self._reported = self.started
+
+    def add(self, table, n, position=None):
+        self.counts[table] = self.counts.get(table, 0) + n
+        now = time.perf_counter()
+        if now - self._reported >= self.interval:
+            self._reported = now
+            self.report(self._line(now, position))
+
+    def _line(self, now, position=None):
+        rows = sum(self.counts.values())
+        elapsed = max(now - self.started, 1e-9)
+        line = f"{rows} записей, {rows / elapsed:.0f}/с"
+        if position is not None and self.total_bytes:
+            line += f", {position / 2 ** 20:.1f}/{self.total_bytes / 2 ** 20:.1f} МБ"
+        return line
+
+    def finish(self):
+        now = time.perf_counter()
+        tables = ', '.join(f"{table}: {n}" for table, n in self.counts.items()) or "нет данных"
+        self.report(f"Готово за {now - self.started:.1f} с - {self._line(now)} ({tables})")
+        return self.counts
+
+
+async def import_json(path, store, batch=BATCH_SIZE, report=print):
+    """data.json -> хранилище пачками по batch записей, возвращает {таблица: записей}"""
+    progress = Progress(os.path.getsize(path), report=report)
+    pending = []
+    pending_table = None
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = JsonStream(f)
+        for table, key, record in stream.records():
+            if table not in TABLES:
+                continue
+            if pending and (table != pending_table or len(pending) >= batch):
+                await store.put_many(pending_table, pending)
+                progress.add(pending_table, len(pending), stream.position)
+                pending = []
+            pending_table = table
+            pending.append((key, record))
+        if pending:
+            await store.put_many(pending_table, pending)
+            progress.add(pending_table, len(pending), stream.position)
+    return progress.finish()
+
+
+async def export_json(store, path, batch=BATCH_SIZE, report=print):
+    """Хранилище -> JSON формата data.json, файл заменяется атомарно"""
+    progress = Progress(report=report)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('{')
+        for t, table in enumerate(TABLES):
+            f.write(f'{"," if t else ""}\n  {json.dumps(table)}: {{')
+            lines = []
+            separator = '\n'
+            async for key, record in getattr(store, f"scan_{table}")(batch):
+                lines.append(f'{separator}    {json.dumps(key)}: {json.dumps(record, ensure_ascii=False)}')
+                separator = ',\n'
+                if len(lines) >= batch:
+                    f.write(''.join(lines))
+                    progress.add(table, len(lines))
+                    lines = []
+            f.write(''.join(lines))
+            progress.add(table, len(lines))
+            f.write('\n  }' if separator != '\n' else '}')
+        f.write('\n}\n')
+    os.replace(tmp_path, path)
+    return progress.finish()
+
+
+def _sql_store(spec):
+    if not spec.startswith('sqlite:'):
+        raise TransferError(f"Нужна SQL-база вида sqlite:путь, а не {spec}")
+    return create_storage(spec, None)
+
+
+def _check_journal(path):
+    """Снапшот без журнала - иначе часть изменений осталась бы в журнале"""
+    for journal in (path + '.journal', path + '.journal.old'):
+        if os.path.exists(journal) and os.path.getsize(journal):
+            raise TransferError(f"{journal} не пуст - остановите бота, чтобы он записал снапшот")
+
+
+def run_command(argv, report=print):
+    """Подкоманды import/export для bot.py"""
+    if len(argv) != 3 or argv[0] not in ('import', 'export'):
+        raise TransferError(
+            "Использование:\n"
+            "  python bot.py import data.json sqlite:giftly.db\n"
+            "  python bot.py export sqlite:giftly.db backup.json"
+        )
+    command, source, target = argv
+    if not os.path.exists(source.removeprefix('sqlite:')):
+        raise TransferError(f"Файл не найден: {source}")
+    if command == 'import':
+        _check_journal(source)
+        store = _sql_store(target).open()
+        work = import_json(source, store, report=report)
+    else:
+        store = _sql_store(source).open()
+        work = export_json(store, target, report=report)
+    try:
+        return asyncio.run(work)
+    except ValueError as e:
+        raise TransferError(f"Не удалось разобрать {source}: {e}")
+    finally:
+        store.close()
@@ -0,0 +1,232 @@
+"""
+Приём апдейтов через webhook
+
+Встроенный асинхронный HTTP-сервер (без сторонних зависимостей):
+- проверяет секрет из заголовка X-Telegram-Bot-Api-Secret-Token (без
+  секрета сервер не запускается: иначе любой, кто достучится до порта,
+  пришлёт поддельный апдейт, хоть от имени админа);
+- кладёт апдейты в ограниченную очередь application.update_queue;
+  если очередь заполнена дольше queue_timeout, отвечает 503 и Telegram
+  повторит доставку позже (backpressure);
+- GET /healthz отвечает 200 - для балансировщика.
+
+Локальная проверка - отправить записанный апдейт:
+    curl -X POST -H 'X-Telegram-Bot-Api-Secret-Token: <секрет>' \\
+         --data @update.json http://localhost:8443/telegram
+"""
+
+import json
+import hmac
+import secrets
+import signal
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import (
+    CallbackQueryHandler, ChatMemberHandler, ChosenInlineResultHandler, CommandHandler,
+    InlineQueryHandler, MessageHandler, PollAnswerHandler, PollHandler,
+    PreCheckoutQueryHandler, ShippingQueryHandler, TypeHandler,
+)
+
+logger = logging.getLogger(__name__)
+
+# Типы апдейтов, которые получает каждый вид обработчика
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: [Update.MESSAGE],
+    MessageHandler: [Update.MESSAGE],
+    CallbackQueryHandler: [Update.CALLBACK_QUERY],
+    InlineQueryHandler: [Update.INLINE_QUERY],
+    ChosenInlineResultHandler: [Update.CHOSEN_INLINE_RESULT],
+    ChatMemberHandler: [Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER],
+    PollHandler: [Update.POLL],
+    PollAnswerHandler: [Update.POLL_ANSWER],
+    PreCheckoutQueryHandler: [Update.PRE_CHECKOUT_QUERY],
+    ShippingQueryHandler: [Update.SHIPPING_QUERY],
+    # TypeHandler (middleware) получает то, что пришло для остальных
+    TypeHandler: [],
+}
+
+MAX_BODY = 1024 * 1024
+
+
+def allowed_updates_for(application):
+    """allowed_updates по зарегистрированным обработчикам.
+
+    Для неизвестного типа обработчика - все типы апдейтов.
+    """
+    allowed = []
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            types = next((t for cls, t in HANDLER_UPDATE_TYPES.items() if isinstance(handler, cls)), None)
+            if types is None:
+                return Update.ALL_TYPES
+            allowed.extend(t for t in types if t not in allowed)
+    return allowed
+
+
+class WebhookServer:
+    """HTTP/1.1 сервер одного эндпоинта для апдейтов Telegram"""
+
+    def __init__(self, application, path, secret_token, queue_timeout=5.0):
+        if not secret_token:
+            raise ValueError("webhook secret token is required")
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.queue_timeout = queue_timeout
+        self._server = None
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            # keep-alive: несколько запросов в одном соединении
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                status, keep_alive = await self._handle_request(head, reader)
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, head, reader):
+        """Обработка одного запроса, возвращает (статус, keep-alive)"""
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            return '400 Bad Request', False
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close'
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            return '400 Bad Request', False
+        if length > MAX_BODY:
+            return '413 Payload Too Large', False
+        body = await reader.readexactly(length) if length else b''
+
+        if method == 'GET' and target == '/healthz':
+            return ('200 OK' if self.healthy() else '503 Service Unavailable'), keep_alive
+        if target != self.path:
+            return '404 Not Found', keep_alive
+        if method != 'POST':
+            return '405 Method Not Allowed', keep_alive
+        token = headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+            return '403 Forbidden', keep_alive
+
+        try:
+            accepted = await self.submit(body)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Bad webhook payload: {e}")
+            return '400 Bad Request', keep_alive
+        if not accepted:
+            return '503 Service Unavailable', keep_alive
+        return '200 OK', keep_alive
+
+    def healthy(self):
+        return True
+
+    async def submit(self, body):
+        """Апдейт в очередь приложения; False - очередь полна, Telegram повторит позже"""
+        update = Update.de_json(json.loads(body), self.application.bot)
+        try:
+            await asyncio.wait_for(self.application.update_queue.put(update), self.queue_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Update queue is full, asking Telegram to retry")
+            return False
+        return True
+
+
+def stop_signal():
+    """Событие, которое выставляют SIGINT и SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def serve_application(application, start_server, stop_server, before_start=None):
+    """Жизненный цикл приложения со своим приёмом апдейтов (аналог run_polling).
+
+    start_server/stop_server - корутины-функции запуска и остановки приёма.
+    """
+    stop = stop_signal()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if before_start:
+            await before_start()
+        await start_server()
+        await application.start()
+        await stop.wait()
+    finally:
+        await stop_server()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def webhook_secret(secret_token, webhook_url):
+    """Секрет webhook: заданный или случайный, если setWebhook вызывает сам бот.
+
+    Без WEBHOOK_URL webhook регистрирует кто-то другой - тогда секрет
+    должен быть задан явно, иначе ValueError.
+    """
+    if secret_token:
+        return secret_token
+    if webhook_url:
+        return secrets.token_urlsafe(32)
+    raise ValueError("WEBHOOK_SECRET is required when WEBHOOK_URL is not set")
+
+
+async def set_webhook(bot, webhook_url, path, secret_token, allowed_updates=None):
+    await bot.set_webhook(
+        url=webhook_url.rstrip('/') + path,
+        secret_token=secret_token,
+        allowed_updates=allowed_updates,
+    )
+
+
+async def serve_webhook(application, listen, port, path, secret_token, webhook_url=None,
+                        allowed_updates=None, queue_timeout=5.0):
+    """Режим webhook: HTTP-сервер кладёт апдейты в очередь приложения"""
+    server = WebhookServer(application, path, secret_token, queue_timeout)
+
+    async def register():
+        if webhook_url:
+            await set_webhook(application.bot, webhook_url, path, secret_token, allowed_updates)
+
+    await serve_application(application, lambda: server.start(listen, port), server.stop, register)
@@ -0,0 +1,126 @@
+"""
+Синхронизация вишлиста изменениями
+
+Приложение присылает не весь список, а операции (действие patch_wishes):
+    {"op_id": "...", "op": "add", "wish": {...}}
+    {"op_id": "...", "op": "update", "wish_id": "...", "version": 3, "fields": {...}}
+    {"op_id": "...", "op": "delete", "wish_id": "...", "version": 3}
+    {"op_id": "...", "op": "reorder", "order": ["id1", "id2", ...]}
+
+У каждого желания есть version: update и delete применяются, только если
+присланная версия совпадает с текущей, поэтому правка из второй вкладки
+со старой версией отклоняется как конфликт, а не затирает первую.
+op_id последней операции хранится в желании - повтор той же операции
+(переотправка после обрыва связи) второй раз не применяется.
+
+Результат - изменение для Storage.patch_user: пишутся только затронутые
+желания.
+"""
+
+import uuid
+
+# Поля, которые ведёт сервер: из данных приложения они не принимаются
+SERVER_FIELDS = ('id', 'version', 'op_id', 'reserved', 'reserved_by', 'reserved_at', 'reserved_until')
+MAX_OPS = 100
+
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+CONFLICT = 'conflict'
+INVALID = 'invalid'
+
+
+def _client_fields(fields):
+    return {k: v for k, v in fields.items() if k not in SERVER_FIELDS} if isinstance(fields, dict) else {}
+
+
+def plan_ops(record, ops):
+    """Изменение и результаты операций: (delta, [{op_id, status, version}])"""
+    current = {str(w.get('id')): w for w in (record or {}).get('wishes', [])}
+    ops = ops if isinstance(ops, list) else []
+    puts = {}
+    deleted = set()
+    order = None
+    results = []
+
+    for op in ops[:MAX_OPS]:
+        op_id = str(op.get('op_id') or '') if isinstance(op, dict) else ''
+        kind = op.get('op') if op_id else None
+        wish_id = str(op.get('wish_id') or '') if op_id else ''
+        result = {'op_id': op_id, 'status': APPLIED}
+        results.append(result)
+        wish = current.get(wish_id)
+
+        # Операции неверной формы (не тот тип wish/fields) отклоняются целиком
+        if kind == 'add' and isinstance(op.get('wish'), dict):
+            fields = _client_fields(op['wish'])
+            wish_id = str(op['wish'].get('id') or uuid.uuid4().hex)
+            existing = current.get(wish_id)
+            if existing is not None:
+                result['status'] = DUPLICATE if existing.get('op_id') == op_id else CONFLICT
+                result['version'] = existing.get('version', 0)
+                continue
+            wish = dict(fields, id=wish_id, version=1, op_id=op_id, reserved=False)
+            deleted.discard(wish_id)
+            if order is not None:
+                order.insert(0, wish_id)
+        elif kind == 'delete' or (kind == 'update' and isinstance(op.get('fields'), dict)):
+            if wish is None:
+                # Удалённое желание: повтор удаления - не ошибка, правка - конфликт
+                result['status'] = APPLIED if kind == 'delete' else CONFLICT
+                continue
+            if wish.get('op_id') == op_id:
+                result['status'] = DUPLICATE
+                result['version'] = wish.get('version', 0)
+                continue
+            if op.get('version') != wish.get('version', 0):
+                result['status'] = CONFLICT
+                result['version'] = wish.get('version', 0)
+                continue
+            if kind == 'delete':
+                del current[wish_id]
+                puts.pop(wish_id, None)
+                deleted.add(wish_id)
+                if order is not None and wish_id in order:
+                    order.remove(wish_id)
+                continue
+            wish = dict(wish, **_client_fields(op['fields']), version=wish.get('version', 0) + 1, op_id=op_id)
+        elif kind == 'reorder' and isinstance(op.get('order'), list):
+            listed = [str(i) for i in op['order'] if str(i) in current]
+            order = list(dict.fromkeys(listed))
+            continue
+        else:
+            result['status'] = INVALID
+            continue
+
+        current[wish_id] = wish
+        puts[wish_id] = wish
+        result['version'] = wish['version']
+
+    delta = {}
+    if puts:
+        delta['put'] = list(puts.values())
+    if deleted:
+        delta['delete'] = sorted(deleted)
+    if order is not None:
+        delta['order'] = order
+    return delta, results
+
+
+def merge_full_list(old_wishes, new_wishes):
+    """Старый протокол save_wishes (весь список): серверные поля сохраняются,
+    версия растёт у изменившихся желаний"""
+    old = {str(w.get('id')): w for w in old_wishes}
+    merged = []
+    for wish in new_wishes:
+        fields = _client_fields(wish)
+        wish_id = str(wish.get('id') or uuid.uuid4().hex) if isinstance(wish, dict) else uuid.uuid4().hex
+        before = old.get(wish_id)
+        if before is None:
+            merged.append(dict(fields, id=wish_id, version=1, reserved=False))
+            continue
+        kept = {k: before[k] for k in SERVER_FIELDS if k in before}
+        if _client_fields(before) != fields:
+            kept['version'] = before.get('version', 0) + 1
+            kept.pop('op_id', None)
+        merged.append(dict(fields, **kept))
+    return merged
@@ -0,0 +1,346 @@
+"""
+Несколько процессов-воркеров
+
+    WORKERS=4 STORAGE=sqlite:giftly.db python bot.py
+
+Главный процесс - диспетчер: принимает апдейты (webhook или polling), но
+не обрабатывает их, а передаёт одному из WORKERS процессов по id
+отправителя (нет отправителя - по id чата): id % WORKERS. Апдейты одного
+пользователя всегда попадают в один воркер и там идут по порядку. id
+достаётся регулярным выражением из начала тела, JSON целиком разбирает
+только воркер.
+
+Воркер - тот же bot.py с WORKER_ID: апдейты приходят кадрами по
+unix-сокету в очередь его Application. Общая база - SQLite (WAL):
+"прочитать - изменить - записать" идёт под межпроцессными блокировками
+(ProcessKeyedLocks), индексы в памяти каждого воркера обновляются из
+ленты изменений базы (SqliteStore.follow_changes). Фоновые задачи
+(сроки резервов, награды за приглашения, напоминания) выполняет воркер 0.
+
+Здоровье: воркер раз в heartbeat_interval секунд шлёт диспетчеру пульс.
+Завершившийся воркер и воркер без пульса дольше heartbeat_timeout
+(завис цикл событий) перезапускаются с растущей паузой. Пока воркер не
+поднялся или не успевает читать, его апдейты получают 503 и Telegram
+повторяет их позже. /healthz диспетчера - 200, только если живы все.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import struct
+import signal
+import asyncio
+import logging
+import tempfile
+from telegram import Update
+from telegram.error import TelegramError
+from webhook import WebhookServer, serve_application, set_webhook, stop_signal
+
+logger = logging.getLogger(__name__)
+
+# Кадр: длина данных, тип, данные
+_FRAME = struct.Struct('>IB')
+UPDATE = 1
+HEARTBEAT = 2
+
+# Отправитель или чат в первых байтах апдейта: Telegram пишет "id" первым полем
+_SENDER = re.compile(rb'"from"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+_CHAT = re.compile(rb'"chat"\s*:\s*\{\s*"id"\s*:\s*(-?\d+)')
+ROUTE_SCAN_BYTES = 4096
+
+
+def frame(kind, payload=b''):
+    return _FRAME.pack(len(payload), kind) + payload
+
+
+async def read_frame(reader):
+    length, kind = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return kind, await reader.readexactly(length)
+
+
+def route_key(body):
+    """id отправителя (или чата) апдейта, 0 - если их нет"""
+    for pattern in (_SENDER, _CHAT):
+        match = pattern.search(body, 0, ROUTE_SCAN_BYTES)
+        if match:
+            return int(match.group(1))
+    # Поля в другом порядке или далеко от начала - разбираем JSON
+    update = json.loads(body)
+    for value in update.values():
+        if isinstance(value, dict):
+            for field in ('from', 'user', 'chat'):
+                if isinstance(value.get(field), dict) and 'id' in value[field]:
+                    return int(value[field]['id'])
+            message = value.get('message')
+            if isinstance(message, dict) and isinstance(message.get('chat'), dict):
+                return int(message['chat']['id'])
+    return 0
+
+
+# ===== Сторона воркера =====
+
+class WorkerChannel:
+    """Приём апдейтов от диспетчера в очередь приложения и пульс обратно"""
+
+    def __init__(self, application, path, heartbeat_interval=2.0):
+        self.application = application
+        self.path = path
+        self.heartbeat_interval = heartbeat_interval
+        self._server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        logger.info(f"Worker listening on {self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _heartbeat(self, writer):
+        while True:
+            stats = {
+                'pid': os.getpid(),
+                'queue': self.application.update_queue.qsize(),
+                'in_flight': self.application.update_processor.current_concurrent_updates,
+            }
+            writer.write(frame(HEARTBEAT, json.dumps(stats).encode()))
+            await writer.drain()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def _handle_connection(self, reader, writer):
+        heartbeat = asyncio.create_task(self._heartbeat(writer))
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind != UPDATE:
+                    continue
+                try:
+                    update = Update.de_json(json.loads(payload), self.application.bot)
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning(f"Bad update from dispatcher: {e}")
+                    continue
+                # Очередь полна - не читаем сокет, диспетчер увидит заполненный буфер
+                await self.application.update_queue.put(update)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            heartbeat.cancel()
+            writer.close()
+
+
+async def serve_worker(application, socket_path):
+    """Жизненный цикл воркера: апдейты только от диспетчера"""
+    channel = WorkerChannel(application, socket_path)
+    await serve_application(application, channel.start, channel.stop)
+
+
+# ===== Сторона диспетчера =====
+
+class Worker:
+    """Процесс-воркер глазами диспетчера"""
+
+    def __init__(self, index, socket_path):
+        self.index = index
+        self.socket_path = socket_path
+        self.process = None
+        self.writer = None
+        self.heartbeat = 0.0  # time.monotonic() последнего пульса
+        self.stats = {}
+        self.restarts = 0
+
+    @property
+    def ready(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+
+class Dispatcher:
+    """Запуск воркеров, маршрутизация апдейтов, проверка пульса и перезапуск"""
+
+    def __init__(self, count, command, env=None, heartbeat_timeout=30.0, buffer_limit=4 * 1024 * 1024,
+                 start_timeout=300.0):
+        self.command = command
+        self.env = dict(os.environ if env is None else env)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.buffer_limit = buffer_limit
+        self.start_timeout = start_timeout
+        self.socket_dir = tempfile.mkdtemp(prefix='giftly-workers-')
+        self.workers = [Worker(i, os.path.join(self.socket_dir, f"worker-{i}.sock")) for i in range(count)]
+        self.routed = [0] * count
+        self.rejected = [0] * count
+        self._tasks = []
+        self._stopping = False
+
+    def route(self, body):
+        return self.workers[route_key(body) % len(self.workers)]
+
+    async def submit(self, body):
+        """Апдейт воркеру; False - воркер недоступен или не успевает (503)"""
+        worker = self.route(body)
+        if not worker.ready or worker.writer.transport.get_write_buffer_size() > self.buffer_limit:
+            self.rejected[worker.index] += 1
+            return False
+        worker.writer.write(frame(UPDATE, body))
+        self.routed[worker.index] += 1
+        return True
+
+    def healthy(self):
+        now = time.monotonic()
+        return all(w.ready and now - w.heartbeat <= self.heartbeat_timeout for w in self.workers)
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._supervise(w)) for w in self.workers]
+        self._tasks.append(asyncio.create_task(self._watchdog()))
+
+    async def stop(self, timeout=15.0):
+        """SIGTERM воркерам (они штатно сохраняют данные), по таймауту - SIGKILL"""
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        for worker in self.workers:
+            if worker.writer:
+                worker.writer.close()
+            if worker.process and worker.process.returncode is None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process and worker.process.returncode is None:
+                try:
+                    await asyncio.wait_for(worker.process.wait(), timeout)
+                except asyncio.TimeoutError:
+                    worker.process.kill()
+                    await worker.process.wait()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+    async def _supervise(self, worker):
+        delay = 1.0
+        while not self._stopping:
+            started = time.monotonic()
+            env = dict(self.env, WORKER_ID=str(worker.index), WORKER_SOCKET=worker.socket_path)
+            # Своя группа процессов: Ctrl+C получает диспетчер и останавливает воркеров сам
+            worker.process = await asyncio.create_subprocess_exec(*self.command, env=env, start_new_session=True)
+            logger.info(f"Worker {worker.index} started, pid {worker.process.pid}")
+            reader = await self._connect(worker)
+            if reader is not None:
+                heartbeats = asyncio.create_task(self._read_heartbeats(worker, reader))
+            code = await worker.process.wait()
+            if reader is not None:
+                heartbeats.cancel()
+            if worker.writer:
+                worker.writer.close()
+                worker.writer = None
+            if self._stopping:
+                return
+            worker.restarts += 1
+            # Падает сразу после старта - паузы растут, проработал долго - снова с 1 с
+            delay = 1.0 if time.monotonic() - started > 60 else min(delay * 2, 60.0)
+            logger.error(f"Worker {worker.index} exited with code {code}, restarting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+    async def _connect(self, worker):
+        """Подключение к сокету воркера, пока он загружает данные; None - процесс завершился"""
+        deadline = time.monotonic() + self.start_timeout
+        while worker.process.returncode is None and time.monotonic() < deadline:
+            try:
+                reader, writer = await asyncio.open_unix_connection(worker.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.2)
+                continue
+            worker.writer = writer
+            worker.heartbeat = time.monotonic()
+            logger.info(f"Worker {worker.index} connected")
+            return reader
+        if worker.process.returncode is None:
+            logger.error(f"Worker {worker.index} did not start in {self.start_timeout:.0f}s, killing")
+            worker.process.kill()
+        return None
+
+    async def _read_heartbeats(self, worker, reader):
+        try:
+            while True:
+                kind, payload = await read_frame(reader)
+                if kind == HEARTBEAT:
+                    worker.heartbeat = time.monotonic()
+                    worker.stats = json.loads(payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+
+    async def _watchdog(self, interval=1.0):
+        """Воркер без пульса (завис цикл событий) - SIGKILL, _supervise перезапустит"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                process = worker.process
+                if worker.ready and process and process.returncode is None \
+                        and now - worker.heartbeat > self.heartbeat_timeout:
+                    logger.error(f"Worker {worker.index} missed heartbeats for {now - worker.heartbeat:.0f}s "
+                                 f"(last: {worker.stats}), killing")
+                    worker.writer.close()
+                    process.send_signal(signal.SIGKILL)
+
+
+class DispatchServer(WebhookServer):
+    """Webhook диспетчера: тело запроса уходит воркеру без разбора"""
+
+    def __init__(self, dispatcher, path, secret_token):
+        super().__init__(None, path, secret_token)
+        self.dispatcher = dispatcher
+
+    def healthy(self):
+        return self.dispatcher.healthy()
+
+    async def submit(self, body):
+        return await self.dispatcher.submit(body)
+
+
+async def poll_updates(bot, dispatcher, allowed_updates=None, timeout=30):
+    """getUpdates в диспетчере: апдейт подтверждается, когда его принял воркер"""
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+        except TelegramError as e:
+            logger.error(f"getUpdates failed: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            body = json.dumps(update.to_dict(), ensure_ascii=False).encode()
+            while not await dispatcher.submit(body):
+                await asyncio.sleep(1)
+            offset = update.update_id + 1
+
+
+async def serve_dispatcher(dispatcher, bot, mode, listen, port, path, secret_token, webhook_url=None,
+                           allowed_updates=None):
+    """Жизненный цикл диспетчера: воркеры, приём апдейтов, остановка по сигналу"""
+    stop = stop_signal()
+    await bot.initialize()
+    await dispatcher.start()
+    server = poller = None
+    try:
+        if mode == 'webhook':
+            server = DispatchServer(dispatcher, path, secret_token)
+            await server.start(listen, port)
+            if webhook_url:
+                await set_webhook(bot, webhook_url, path, secret_token, allowed_updates)
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(poll_updates(bot, dispatcher, allowed_updates))
+        await stop.wait()
+    finally:
+        if poller:
+            poller.cancel()
+        if server:
+            await server.stop()
+        await dispatcher.stop()
+        await bot.shutdown()
+
+
+def worker_command(script):
+    """Команда запуска воркера: тот же интерпретатор и скрипт"""
+    return [sys.executable, os.path.abspath(script)]